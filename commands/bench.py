@@ -0,0 +1,98 @@
+from time import time
+from bson.objectid import ObjectId
+from commands import Command
+from uengine.cache_codec import CacheCodec, msgpack, lz4
+from uengine.db import ObjectsCursor
+from uengine.json_encoder import create_json_backend, orjson, DATETIME_FORMATS
+from uengine.utils import now
+
+
+def gen_user_docs(count):
+    created_at = now()
+    return [{
+        "_id": ObjectId(),
+        "ext_id": None,
+        "username": f"user{i}",
+        "first_name": "First",
+        "last_name": "Last",
+        "email": f"user{i}@example.com",
+        "avatar_url": "",
+        "created_at": created_at,
+        "updated_at": created_at,
+        "supervisor": False,
+    } for i in range(count)]
+
+
+def measure(func, rows):
+    t1 = time()
+    func()
+    elapsed = time() - t1
+    return rows / elapsed if elapsed else float("inf")
+
+
+class Bench(Command):
+
+    DESCRIPTION = "Run micro-benchmarks"
+
+    def init_argument_parser(self, parser):
+        parser.add_argument("-r", "--rows", type=int, default=100000, help="number of documents to process")
+
+    def bench_cursor(self, docs):
+        from testapp.models import User
+
+        def constructor():
+            for _ in ObjectsCursor(docs, User):
+                pass
+
+        def from_data():
+            for _ in ObjectsCursor(docs, User.from_data):
+                pass
+
+        print(f"ObjectsCursor, {len(docs)} rows")
+        print("  User(**doc):         %10.0f rows/s" % measure(constructor, len(docs)))
+        print("  User.from_data(doc): %10.0f rows/s" % measure(from_data, len(docs)))
+
+    def bench_json(self, docs):
+        from testapp.models import User
+
+        users = [User.from_data(**doc) for doc in docs]
+        dicts = [user.to_dict() for user in users]
+        backends = ["json"]
+        if orjson is not None:
+            backends.append("orjson")
+
+        print(f"JSON serialization, {len(docs)} rows")
+        for name in backends:
+            for datetime_format in DATETIME_FORMATS:
+                backend = create_json_backend(name, datetime_format)
+                title = f"{name}, {datetime_format} dates"
+                print("  %-20s models: %10.0f rows/s" % (title, measure(lambda: backend.dumps(users), len(users))))
+                print("  %-20s dicts:  %10.0f rows/s" % (title, measure(lambda: backend.dumps(dicts), len(dicts))))
+
+    def bench_cache_codec(self, docs):
+        serializers = ["pickle", "bson"]
+        if msgpack is not None:
+            serializers.append("msgpack")
+        compressions = [None, "zlib"]
+        if lz4 is not None:
+            compressions.append("lz4")
+
+        print(f"Cache codecs, {len(docs)} model documents")
+        for serializer in serializers:
+            for compression in compressions:
+                codec = CacheCodec(serializer, compression)
+                encoded = [codec.encode(doc) for doc in docs]
+                size = sum(len(data) for data in encoded) / len(docs)
+                title = f"{serializer}, {compression or 'no'} compression"
+                print("  %-28s %6.0f bytes/doc, encode: %10.0f docs/s, decode: %10.0f docs/s" % (
+                    title, size,
+                    measure(lambda: [codec.encode(doc) for doc in docs], len(docs)),
+                    measure(lambda: [codec.decode(data) for data in encoded], len(docs))
+                ))
+
+    def run(self):
+        docs = gen_user_docs(self.args.rows)
+        self.bench_cursor(docs)
+        self.bench_json(docs)
+        self.bench_cache_codec(docs)
+        return 0
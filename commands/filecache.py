@@ -0,0 +1,20 @@
+from commands import Command
+from uengine import ctx
+
+
+class Filecache(Command):
+
+    DESCRIPTION = "Remove expired file cache entries and evict the least recently used ones"
+
+    def init_argument_parser(self, parser):
+        parser.add_argument("-s", "--max-size", type=int, default=None,
+                            help="cache size limit in bytes, filecache_max_size setting by default")
+        parser.add_argument("--clear", action="store_true", default=False, help="remove all the entries")
+
+    def run(self):
+        if self.args.clear:
+            return 0 if ctx.filecache.clear() else 1
+        stats = ctx.filecache.sweep(max_size=self.args.max_size)
+        print("%d files, %d bytes, %d expired, %d evicted" % (
+            stats["files"], stats["size"], stats["expired"], stats["evicted"]))
+        return 0
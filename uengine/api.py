@@ -1,9 +1,13 @@
 import functools
 import re
 
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+from bson import json_util
 from collections import namedtuple
 from math import ceil
-from flask import request, json, make_response
+from flask import request, make_response, Response, stream_with_context
+from itertools import islice
 
 from . import ctx
 
@@ -11,6 +15,8 @@ ArithmeticExpression = namedtuple(
     '_ArithmeticExpression', field_names=["op", "value"])
 
 DEFAULT_DOCUMENTS_PER_PAGE = 10
+DEFAULT_COUNT_STRATEGY = "exact"
+STREAM_CHUNK_SIZE = 100  # documents per chunk written to the socket
 ARITHMETIC_OPS = (
     "eq",
     "lt",
@@ -66,7 +72,80 @@ def get_boolean_request_param(param_name):
     return boolean(request.values.get(param_name))
 
 
-def paginated(data, page=None, limit=None, extra=None, transform=None):
+def count_documents(data, strategy=None):
+    """
+    Counts a cursor using a count strategy (see db.COUNT_STRATEGIES),
+    count_strategy, count_cap and count_cache_ttl settings are used by default
+
+    :return: tuple (count, capped)
+    """
+    if not hasattr(data, "count_with"):
+        return data.count(), False
+    if strategy is None:
+        strategy = ctx.cfg.get("count_strategy", DEFAULT_COUNT_STRATEGY)
+    kwargs = {}
+    if "count_cap" in ctx.cfg:
+        kwargs["cap"] = ctx.cfg["count_cap"]
+    if "count_cache_ttl" in ctx.cfg:
+        kwargs["ttl"] = ctx.cfg["count_cache_ttl"]
+    return data.count_with(strategy, **kwargs)
+
+
+def encode_keyset_token(sort, values):
+    token = json_util.dumps({"s": [field for field, _ in sort], "v": values})
+    return urlsafe_b64encode(token.encode()).decode()
+
+
+def decode_keyset_token(token, sort):
+    from .errors import InputDataError
+    try:
+        data = json_util.loads(urlsafe_b64decode(token.encode()))
+        fields, values = data["s"], data["v"]
+    except (Base64Error, ValueError, TypeError, KeyError):
+        raise InputDataError("invalid _after token")
+    if fields != [field for field, _ in sort] or len(values) != len(fields):
+        raise InputDataError("_after token doesn't match the sort order")
+    return values
+
+
+def keyset_paginated(data, after, limit, extra=None, transform=None, count_strategy=None):
+    """
+    Seek-based pagination. Instead of a page number the client passes the next
+    token from the previous response as _after (an empty _after starts from the
+    beginning). The total count is only calculated if _count is set
+    """
+    count, capped = None, False
+    if get_boolean_request_param("_count"):
+        count, capped = count_documents(data, count_strategy)
+    sort = data.keyset_sort
+    after = decode_keyset_token(after, sort) if after else None
+    cursor = data.keyset(after).limit(limit + 1)
+
+    objs = list(cursor)
+    next_token = None
+    if len(objs) > limit:
+        objs = objs[:limit]
+        next_token = encode_keyset_token(sort, cursor.keyset_values(objs[-1]))
+
+    if transform is not None:
+        objs = [transform(x) for x in objs]
+
+    result = {
+        "next": next_token,
+        "count": count,
+        "count_capped": capped,
+        "data": objs
+    }
+
+    if extra is not None and hasattr(extra, "items"):
+        for k, v in extra.items():
+            if k not in result:
+                result[k] = v
+
+    return result
+
+
+def paginated(data, page=None, limit=None, extra=None, transform=None, count_strategy=None):
 
     nopaging = get_boolean_request_param("_nopaging")
     if page is None:
@@ -74,12 +153,17 @@ def paginated(data, page=None, limit=None, extra=None, transform=None):
     if limit is None:
         limit = get_limit()
 
+    after = request.values.get("_after")
+    if after is not None and not nopaging and hasattr(data, "keyset"):
+        return keyset_paginated(data, after, limit, extra, transform, count_strategy)
+
+    capped = False
     if isinstance(data, list):
         count = len(data)
         if limit is not None and page is not None:
             data = data[(page - 1) * limit:page * limit]
     elif hasattr(data, "count"):
-        count = data.count()
+        count, capped = count_documents(data, count_strategy)
         if limit is not None and page is not None:
             data = data.skip((page-1)*limit).limit(limit)
     else:
@@ -87,7 +171,11 @@ def paginated(data, page=None, limit=None, extra=None, transform=None):
             "paginated() accepts either cursor objects or lists")
 
     if transform is not None:
-        data = [transform(x) for x in data]
+        if hasattr(transform, "fields") and hasattr(data, "as_dicts"):
+            # default_transform() can be served without creating model objects
+            data = list(data.as_dicts(get_request_fields(transform.fields)))
+        else:
+            data = [transform(x) for x in data]
 
     total_pages = ceil(count / limit) if limit is not None else None
 
@@ -95,6 +183,7 @@ def paginated(data, page=None, limit=None, extra=None, transform=None):
         "page": page,
         "total_pages": total_pages,
         "count": count,
+        "count_capped": capped,
         "data": data
     }
 
@@ -109,6 +198,7 @@ def paginated(data, page=None, limit=None, extra=None, transform=None):
 def default_transform(fields=None):
     def transform(x):
         return x.to_dict(fields=get_request_fields(fields))
+    transform.fields = fields
     return transform
 
 
@@ -147,7 +237,45 @@ def json_body_required(func):
 
 
 def json_response(data, code=200):
-    json_kwargs = {}
-    if ctx.cfg.get("debug"):
-        json_kwargs["indent"] = 4
-    return make_response(json.dumps(data, **json_kwargs), code, {'Content-Type': 'application/json'})
+    from .json_encoder import json_dumps
+    indent = 4 if ctx.cfg.get("debug") else None
+    return make_response(json_dumps(data, indent=indent), code, {'Content-Type': 'application/json'})
+
+
+def _json_stream(items, ndjson, chunk_size):
+    from .json_encoder import json_dumps
+    items = iter(items)
+    if not ndjson:
+        yield "["
+    separator = "\n" if ndjson else ","
+    first = True
+    while True:
+        chunk = [json_dumps(x) for x in islice(items, chunk_size)]
+        if not chunk:
+            break
+        if ndjson:
+            yield separator.join(chunk) + separator
+        else:
+            yield ("" if first else separator) + separator.join(chunk)
+        first = False
+    if not ndjson:
+        yield "]"
+
+
+def json_stream_response(data, code=200, transform=None, ndjson=False, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Streams a cursor or any iterable as a JSON array (or newline delimited JSON
+    if ndjson is set) without building the whole response in memory. Items are
+    encoded the same way json_response() does
+
+    :param transform: callable applied to every item, default_transform() is
+                      served from projected dicts when the cursor supports it
+    :param chunk_size: number of items encoded per chunk written
+    """
+    if transform is not None:
+        if hasattr(transform, "fields") and hasattr(data, "as_dicts"):
+            data = data.as_dicts(get_request_fields(transform.fields))
+        else:
+            data = (transform(x) for x in data)
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(stream_with_context(_json_stream(data, ndjson, chunk_size)), code, mimetype=mimetype)
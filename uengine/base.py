@@ -5,6 +5,7 @@ import logging
 
 from flask import Flask, g, request
 from datetime import timedelta
+from time import time
 from logging.handlers import WatchedFileHandler
 from cachelib import MemcachedCache, SimpleCache
 from uuid import uuid4
@@ -13,8 +14,12 @@ from . import ctx
 from .db import DB
 from .errors import handle_api_error, handle_other_errors, ApiError
 from .sessions import MongoSessionInterface
-from .json_encoder import MongoJSONEncoder
+from .json_encoder import MongoJSONEncoder, json_dumps
 from .file_cache import FileCache
+from .cache_codec import create_codec_cache
+from .memcached import create_memcached_cache
+from .redis_cache import create_redis_cache
+from .local_cache import create_local_cache
 from .queue import RedisQueue, MongoQueue, DummyQueue
 
 ENVIRONMENT_TYPES = ("development", "testing", "production")
@@ -70,6 +75,7 @@ class Base:
         self.flask = self.__setup_flask()  # requires ctx.cfg and ctx.log
         self.__setup_error_handling()  # requires self.flask
         ctx.cache = self.__setup_cache()  # requires ctx.cfg and ctx.log
+        ctx.local_cache = self.__setup_local_cache()  # requires ctx.cfg and ctx.db
         ctx.filecache = self.__setup_filecache()  # requires ctx.cfg and ctx.log
         self.__setup_sessions()
         self.configure_routes()
@@ -91,18 +97,38 @@ class Base:
     @staticmethod
     def __setup_cache():
         ctx.log.debug("Setting up a cache")
-        if "memcache_backends" in ctx.cfg:
-            return MemcachedCache(ctx.cfg.get("memcache_backends"))
+        if "redis_cache" in ctx.cfg:
+            cache = create_redis_cache(ctx.cfg["redis_cache"])
+        elif "memcached" in ctx.cfg:
+            cache = create_memcached_cache(ctx.cfg["memcached"])
+        elif "memcache_backends" in ctx.cfg:
+            cache = MemcachedCache(ctx.cfg.get("memcache_backends"))
+        else:
+            from .cache import patch_delete_many
+            SimpleCache.delete_many = patch_delete_many
+            cache = SimpleCache()
+
+        if "cache_codec" in ctx.cfg:
+            ctx.log.debug("Setting up a cache codec")
+            cache = create_codec_cache(cache, ctx.cfg["cache_codec"])
+        return cache
 
-        from .cache import patch_delete_many
-        SimpleCache.delete_many = patch_delete_many
-        return SimpleCache()
+    @staticmethod
+    def __setup_local_cache():
+        if "local_cache" not in ctx.cfg:
+            return None
+        ctx.log.debug("Setting up a local cache")
+        return create_local_cache(ctx.cfg["local_cache"])
 
     @staticmethod
     def __setup_filecache():
         ctx.log.debug("Setting up a filecache")
         filecache_dir = ctx.cfg.get("filecache_dir", DEFAULT_FILECACHE_DIR)
-        return FileCache(filecache_dir)
+        return FileCache(
+            filecache_dir,
+            max_size=ctx.cfg.get("filecache_max_size"),
+            sweep_interval=ctx.cfg.get("filecache_sweep_interval")
+        )
 
     @staticmethod
     def __setup_queue():
@@ -177,6 +203,14 @@ class Base:
         @flask.before_request
         def add_request_local_cache():
             g.request_local_cache = {}
+            g.request_identity_map = {}
+
+        request_timeout = ctx.cfg.get("request_timeout")
+        if request_timeout:
+            # mongo retries never sleep beyond the request deadline
+            @flask.before_request
+            def add_request_deadline():
+                g.request_deadline = time() + request_timeout
 
         if ctx.cfg.get("debug"):
             ctx.log.info("Setting up request logging due to debug setting")
@@ -196,17 +230,17 @@ class Base:
 
             @flask.before_request
             def log_all_requests():
-                msg = "REQ_%s %s data=%s" % (
-                    request.method, request.path, request.json)
-                ctx.log.debug(msg)
+                ctx.log.debug("REQ_%s %s data=%s", request.method, request.path,
+                              json_dumps(request.get_json(silent=True)))
 
             @flask.after_request
             def log_all_responses(response):
-                if response.content_type == 'application/json':
+                # streamed responses are not buffered for the sake of logging
+                if response.content_type == 'application/json' and not response.is_streamed:
                     ctx.log.debug(" ".join(map(str, [
                         response.status,
                         str(response.headers).rstrip('\r\n'),
-                        response.get_data(),
+                        response.get_data(as_text=True),
                     ])))
                 else:
                     ctx.log.debug(
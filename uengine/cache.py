@@ -1,21 +1,102 @@
 import functools
 
-from datetime import datetime
-from hashlib import md5
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, date
+from decimal import Decimal
+from hashlib import md5, blake2b
 from flask import g, has_app_context
-from random import randint
+from math import log
+from random import randint, random
+from threading import Lock
+from time import time, sleep
+from uuid import UUID
+from bson.objectid import ObjectId
 from . import ctx
-from .db import ObjectsCursor
+from .db import ObjectsCursor, ShardsCursor
+from .identity_map import identity_map_merge
+from .models.abstract_model import AbstractModel
 
 
 DEFAULT_CACHE_PREFIX = 'uengine'
+TAG_GENERATION_PREFIX = 'tag_gen'
 DEFAULT_CACHE_TIMEOUT = 3600
+# expired values are kept that long to be served while one caller recomputes
+DEFAULT_STALE_TTL = 60
+# > 1 favours earlier refreshes, see "Optimal Probabilistic Cache Stampede Prevention"
+EARLY_REFRESH_BETA = 1.0
+DISTRIBUTED_LOCK_TIMEOUT = 30
+DISTRIBUTED_LOCK_POLL_INTERVAL = 0.05
+
+HIT = "HIT"
+MISS = "MISS"
+STALE = "STALE"
+REFRESH = "REFRESH"
+
+# value stored along with the time it expires at and the time it took to compute
+CacheEntry = namedtuple("CacheEntry", ["value", "expires_at", "delta"])
+
+
+class _FlightLocks:
+    """Per-key locks which are dropped as soon as nobody uses them"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._locks = {}
+
+    def acquire(self, key, blocking=True):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [Lock(), 0]
+            entry[1] += 1
+        if entry[0].acquire(blocking):
+            return True
+        self._unref(key, entry)
+        return False
+
+    def release(self, key):
+        entry = self._locks[key]
+        entry[0].release()
+        self._unref(key, entry)
+
+    def _unref(self, key, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+_flights = _FlightLocks()
 
 
-def req_cache_get(key):
+@contextmanager
+def flight_lock(key):
+    """Makes concurrent threads computing the same key wait for each other"""
+    _flights.acquire(key)
+    try:
+        yield
+    finally:
+        _flights.release(key)
+
+
+class _NotFound:
+
+    def __repr__(self):
+        return "NOT_FOUND"
+
+    def __bool__(self):
+        return False
+
+
+# returned by getters instead of the default to tell a cached None from a miss
+NOT_FOUND = _NotFound()
+
+
+def req_cache_get(key, default=None):
     if not has_app_context():
-        return None
-    return g.request_local_cache.get(key)
+        return default
+    return g.request_local_cache.get(key, default)
 
 
 def req_cache_set(key, value):
@@ -40,51 +121,302 @@ def req_cache_has_key(key):
     return key in g.request_local_cache
 
 
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None), bytes, ObjectId, datetime, date, Decimal, UUID))
+
+
+def _encode_key_part(value, parts):
+    value_type = type(value)
+    if value_type in _SCALAR_TYPES:
+        # repr keeps the type, i.e. 1 and "1" produce different keys
+        parts.append(repr(value))
+    elif isinstance(value, AbstractModel):
+        # model's repr is verbose and changes along with any field
+        parts.append(f"<{value_type.__module__}.{value_type.__qualname__} ")
+        if value._id is None:
+            # unsaved models have nothing but their fields to tell them apart
+            _encode_key_part(value.to_dict(include_restricted=True), parts)
+        else:
+            parts.append(repr(value._id))
+        parts.append(">")
+    elif isinstance(value, (list, tuple)):
+        parts.append("[" if isinstance(value, list) else "(")
+        for item in value:
+            _encode_key_part(item, parts)
+            parts.append(",")
+        parts.append("]" if isinstance(value, list) else ")")
+    elif isinstance(value, dict):
+        items = sorted((_encode_key(k), _encode_key(v)) for k, v in value.items())
+        parts.append("{" + ",".join(f"{k}:{v}" for k, v in items) + "}")
+    elif isinstance(value, (set, frozenset)):
+        parts.append("{" + ",".join(sorted(_encode_key(x) for x in value)) + "}")
+    else:
+        parts.append(repr(value))
+
+
+def _encode_key(value):
+    parts = []
+    _encode_key_part(value, parts)
+    return "".join(parts)
+
+
 def _get_cache_key(pref, funcname, args, kwargs):
-    key = "%s:%s(%s.%s)" % (
-        pref,
-        funcname,
-        md5(str(args).encode("utf-8")).hexdigest(),
-        md5(str(kwargs).encode("utf-8")).hexdigest()
-    )
-
-    kwargs_str = ", ".join(["%s=%s" % (x[0], x[1]) for x in kwargs.items()])
-    arguments = ""
-    if args:
-        arguments = ", ".join([str(x) for x in args])
-        if kwargs:
-            arguments += ", " + kwargs_str
+    """
+    Builds a cache key for a function call. Arguments are encoded
+    canonically so the key doesn't depend on kwargs order, models
+    are identified by their class and _id (or field values if unsaved)
+    """
+    parts = []
+    _encode_key_part(args, parts)
+    if kwargs:
+        for name in sorted(kwargs):
+            parts.append(name)
+            parts.append("=")
+            _encode_key_part(kwargs[name], parts)
+            parts.append(",")
+    digest = blake2b("".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+    return f"{pref}:{funcname}({digest})"
+
+
+class CachedCall:
+    """Human-readable representation of a cached call built only if logged"""
+
+    __slots__ = ("pref", "funcname", "args", "kwargs")
+
+    def __init__(self, pref, funcname, args, kwargs):
+        self.pref = pref
+        self.funcname = funcname
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        arguments = [str(x) for x in self.args]
+        arguments.extend(f"{k}={v}" for k, v in self.kwargs.items())
+        return "%s:%s(%s)" % (self.pref, self.funcname, ", ".join(arguments))
+
+
+def collection_tag(collection):
+    return f"collection:{collection}"
+
+
+def object_tag(collection, _id):
+    return f"object:{collection}:{_id}"
+
+
+def _resolve_tag(tag):
+    if isinstance(tag, str):
+        return tag
+    if isinstance(tag, AbstractModel):
+        return object_tag(tag.collection, tag._id)
+    if isinstance(tag, type) and issubclass(tag, AbstractModel):
+        return collection_tag(tag.collection)
+    raise TypeError(f"invalid cache tag {tag!r}")
+
+
+def _tag_generation_key(tag):
+    return f"{TAG_GENERATION_PREFIX}.{tag}"
+
+
+def tag_generations(tags):
+    """
+    Current generations of the tags, missing ones are created. A generation
+    evicted from the cache is replaced by a new one which just invalidates
+    the entries depending on it a bit earlier
+
+    :param tags: tag strings, model classes (collection tags)
+                 or model objects (object tags)
+    :return: list of generations in the order of tags
+    """
+    keys = [_tag_generation_key(_resolve_tag(tag)) for tag in tags]
+    if not keys:
+        return []
+    generations = ctx.cache.get_many(*keys)
+    for idx, generation in enumerate(generations):
+        if generation is None:
+            generation = str(ObjectId())
+            if not ctx.cache.add(keys[idx], generation, timeout=0):
+                # created concurrently
+                generation = ctx.cache.get(keys[idx]) or generation
+            generations[idx] = generation
+    return generations
+
+
+def tagged_cache_key(cache_key, tags):
+    """
+    Makes the cache key depend on the generations of the tags so that
+    invalidate_tags() drops all the entries tagged at once
+    """
+    if not tags:
+        return cache_key
+    digest = blake2b(".".join(tag_generations(tags)).encode("utf-8"), digest_size=8).hexdigest()
+    return f"{cache_key}[{digest}]"
+
+
+def invalidate_tags(*tags):
+    """
+    Invalidates every cache entry tagged with any of the tags given. The
+    generations are deleted rather than replaced, so tags nothing has been
+    cached with never leave keys behind, and the next tag_generations()
+    call creates new ones
+    """
+    tags = {_resolve_tag(tag) for tag in tags if tag is not None}
+    if not tags:
+        return
+    ctx.log.debug("Cache INVALIDATE TAGS %s", ", ".join(sorted(tags)))
+    ctx.cache.delete_many(*(_tag_generation_key(tag) for tag in tags))
+
+
+def _call_tags(tags, args, kwargs):
+    if callable(tags):
+        return tags(*args, **kwargs)
+    return tags
+
+
+def _needs_refresh(entry, now):
+    if entry.expires_at is None:
+        return False
+    # XFetch: the closer the expiration and the longer the computation,
+    # the more likely a caller refreshes the value before it expires
+    return now - entry.delta * EARLY_REFRESH_BETA * log(1 - random()) >= entry.expires_at
+
+
+def _compute_and_set(cache_key, compute, timeout, positive_only, stale_ttl):
+    started = time()
+    value = compute()
+    finished = time()
+    if value or not positive_only:
+        if timeout is None:
+            timeout = getattr(ctx.cache, "default_timeout", DEFAULT_CACHE_TIMEOUT)
+        if timeout:
+            entry = CacheEntry(value, finished + timeout, finished - started)
+            ctx.cache.set(cache_key, entry, timeout=timeout + stale_ttl)
+        else:
+            ctx.cache.set(cache_key, CacheEntry(value, None, finished - started), timeout=0)
+    return value
+
+
+def _lock_key(cache_key):
+    return f"{cache_key}.lock"
+
+
+def _acquire_lock(cache_key):
+    """:return: token to release the lock with or None if it's held by someone else"""
+    token = str(ObjectId())
+    if ctx.cache.add(_lock_key(cache_key), token, timeout=DISTRIBUTED_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def _release_lock(cache_key, token):
+    delete_if_equal = getattr(ctx.cache, "delete_if_equal", None)
+    if delete_if_equal is not None:
+        # the lock may have expired and been taken by someone else
+        delete_if_equal(_lock_key(cache_key), token)
     else:
-        if kwargs:
-            arguments = kwargs
-    cached_call = "%s:%s(%s)" % (pref, funcname, arguments)
-    return key, cached_call
+        ctx.cache.delete(_lock_key(cache_key))
+
 
+def _wait_for_entry(cache_key):
+    """Waits for another process holding the lock to compute the value"""
+    lock_key = _lock_key(cache_key)
+    deadline = time() + DISTRIBUTED_LOCK_TIMEOUT
+    while time() < deadline:
+        sleep(DISTRIBUTED_LOCK_POLL_INTERVAL)
+        entry = ctx.cache.get(cache_key)
+        if isinstance(entry, CacheEntry):
+            return entry
+        if not ctx.cache.has(lock_key):
+            break
+    return None
 
-def cached_function(cache_key_prefix=DEFAULT_CACHE_PREFIX, cache_timeout=DEFAULT_CACHE_TIMEOUT, positive_only=False):
+
+def single_flight(cache_key, compute, timeout=None, positive_only=False,
+                  stale_ttl=DEFAULT_STALE_TTL, distributed_lock=False):
+    """
+    Gets a value from ctx.cache computing it if necessary so that only one
+    caller computes a key at a time. Values are refreshed with a probability
+    growing towards their expiration and expired values are served for
+    stale_ttl more seconds while being recomputed by someone else.
+
+    :param compute: callable returning the value
+    :param timeout: cache timeout, ctx.cache default if None, 0 for no expiration
+    :param distributed_lock: also lock the key across processes via ctx.cache.add()
+    :return: tuple (value, status) where status is one of HIT, MISS, STALE, REFRESH
+    """
+    entry = ctx.cache.get(cache_key)
+    if entry is not None and not isinstance(entry, CacheEntry):
+        # stored by an older version
+        return entry, HIT
+
+    if entry is not None:
+        if not _needs_refresh(entry, time()):
+            return entry.value, HIT
+        if not _flights.acquire(cache_key, blocking=False):
+            return entry.value, STALE
+        try:
+            token = None
+            if distributed_lock:
+                token = _acquire_lock(cache_key)
+                if token is None:
+                    return entry.value, STALE
+            try:
+                return _compute_and_set(cache_key, compute, timeout, positive_only, stale_ttl), REFRESH
+            except Exception as e:
+                # the stale value is still better than an error
+                ctx.log.error("Cache REFRESH %s failed: %s", cache_key, e)
+                return entry.value, STALE
+            finally:
+                if token is not None:
+                    _release_lock(cache_key, token)
+        finally:
+            _flights.release(cache_key)
+
+    # nothing to serve, wait for the one already computing the value
+    _flights.acquire(cache_key)
+    try:
+        entry = ctx.cache.get(cache_key)
+        if isinstance(entry, CacheEntry):
+            return entry.value, HIT
+        token = None
+        if distributed_lock:
+            token = _acquire_lock(cache_key)
+            if token is None:
+                entry = _wait_for_entry(cache_key)
+                if entry is not None:
+                    return entry.value, HIT
+        try:
+            return _compute_and_set(cache_key, compute, timeout, positive_only, stale_ttl), MISS
+        finally:
+            if token is not None:
+                _release_lock(cache_key, token)
+    finally:
+        _flights.release(cache_key)
+
+
+def cached_function(cache_key_prefix=DEFAULT_CACHE_PREFIX, cache_timeout=DEFAULT_CACHE_TIMEOUT, positive_only=False,
+                    stale_ttl=DEFAULT_STALE_TTL, distributed_lock=False, tags=None):
+    """
+    :param tags: list of tags (see tag_generations()) the result depends on
+                 or a callable returning them for the function arguments.
+                 The result is dropped as soon as any of the tags is invalidated
+    """
     def cache_decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            cache_key, _ = _get_cache_key(
-                cache_key_prefix, func.__name__, args, kwargs)
+            cache_key = _get_cache_key(cache_key_prefix, func.__name__, args, kwargs)
+            cache_key = tagged_cache_key(cache_key, _call_tags(tags, args, kwargs))
             t1 = datetime.now()
-
-            if ctx.cache.has(cache_key):
-                value = ctx.cache.get(cache_key)
-                ctx.log.debug("Cache HIT %s (%.3f seconds)",
-                              cache_key, (datetime.now() - t1).total_seconds())
-            else:
-                value = func(*args, **kwargs)
-                if value or not positive_only:
-                    ctx.cache.set(cache_key, value, timeout=cache_timeout)
-                ctx.log.debug("Cache MISS %s (%.3f seconds)",
-                              cache_key, (datetime.now() - t1).total_seconds())
+            value, status = single_flight(cache_key, lambda: func(*args, **kwargs), cache_timeout,
+                                          positive_only, stale_ttl, distributed_lock)
+            ctx.log.debug("Cache %s %s %s (%.3f seconds)",
+                          status, cache_key, CachedCall(cache_key_prefix, func.__name__, args, kwargs),
+                          (datetime.now() - t1).total_seconds())
             return value
         return wrapper
     return cache_decorator
 
 
-def cached_method(prefix, key_field=None, cache_timeout=None, positive_only=False):
+def cached_method(prefix, key_field=None, cache_timeout=None, positive_only=False,
+                  stale_ttl=DEFAULT_STALE_TTL, distributed_lock=False, tags=None):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
@@ -105,18 +437,12 @@ def cached_method(prefix, key_field=None, cache_timeout=None, positive_only=Fals
                 cache_key = f"{prefix}.{key}"
             else:
                 cache_key = prefix
+            cache_key = tagged_cache_key(cache_key, _call_tags(tags, args, kwargs))
 
-            if ctx.cache.has(cache_key):
-                value = ctx.cache.get(cache_key)
-                ctx.log.debug("MethodCache HIT %s (%.3f seconds)",
-                              cache_key, (datetime.now() - t1).total_seconds())
-            else:
-                value = func(*args, **kwargs)
-                if value or not positive_only:
-                    ctx.cache.set(cache_key, value, timeout=cache_timeout)
-                ctx.log.debug("MethodCache MISS %s (%.3f seconds)",
-                              cache_key, (datetime.now() - t1).total_seconds())
-
+            value, status = single_flight(cache_key, lambda: func(*args, **kwargs), cache_timeout,
+                                          positive_only, stale_ttl, distributed_lock)
+            ctx.log.debug("MethodCache %s %s (%.3f seconds)",
+                          status, cache_key, (datetime.now() - t1).total_seconds())
             return value
 
         return wrapper
@@ -147,8 +473,7 @@ def once_per_request(cache_key_prefix=DEFAULT_CACHE_PREFIX + ".once"):
             if not has_app_context():
                 func(*args, **kwargs)
                 return
-            flag_key, _ = _get_cache_key(
-                cache_key_prefix, func.__name__, args, kwargs)
+            flag_key = _get_cache_key(cache_key_prefix, func.__name__, args, kwargs)
             t1 = datetime.now()
 
             if not req_cache_has_key(flag_key):
@@ -165,6 +490,40 @@ def once_per_request(cache_key_prefix=DEFAULT_CACHE_PREFIX + ".once"):
     return cache_decorator
 
 
+class _Materialized:
+    """Items of a cursor or a list cached by request_time_cache"""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+
+def _materialize(value):
+    """
+    :return: tuple (value to cache, number of objects)
+    """
+    if isinstance(value, (ObjectsCursor, ShardsCursor, list)):
+        # every call gets a list of its own to modify
+        items = tuple(identity_map_merge(item) for item in value)
+        return _Materialized(items), len(items)
+    if isinstance(value, tuple):
+        items = tuple(identity_map_merge(item) for item in value)
+        return items, len(items)
+    return identity_map_merge(value), 1
+
+
+def _request_budget_allows(count):
+    max_objects = ctx.cfg.get("request_cache_max_objects")
+    if max_objects is None:
+        return True
+    used = g.get("request_cache_objects", 0)
+    if used + count > max_objects:
+        return False
+    g.request_cache_objects = used + count
+    return True
+
+
 def request_time_cache(cache_key_prefix=DEFAULT_CACHE_PREFIX):
     """
     Decorator used for caching data during one api request.
@@ -173,6 +532,12 @@ def request_time_cache(cache_key_prefix=DEFAULT_CACHE_PREFIX):
     I.e. list of 20 hosts included in the same group and inheriting the same set of tags/custom fields
     may produce 20 additional db requests and 20 requests for each parent group recursively. This may be fixed
     by caching db responses in flask "g" store.
+
+    Cursors returned are consumed once, their items as well as the items of lists
+    returned are returned as a new list on every call.
+    Models are merged into the request identity map so the same object is always the same instance.
+    request_cache_max_objects setting limits the number of objects cached during a request,
+    results beyond it are not cached.
     """
     def cache_decorator(func):
         @functools.wraps(func)
@@ -180,23 +545,26 @@ def request_time_cache(cache_key_prefix=DEFAULT_CACHE_PREFIX):
             if not has_app_context():
                 return func(*args, **kwargs)
 
-            cache_key, _ = _get_cache_key(
-                cache_key_prefix, func.__name__, args, kwargs)
+            cache_key = _get_cache_key(cache_key_prefix, func.__name__, args, kwargs)
             t1 = datetime.now()
 
-            if not req_cache_has_key(cache_key):
-                value = func(*args, **kwargs)
-                req_cache_set(cache_key, value)
+            value = req_cache_get(cache_key, NOT_FOUND)
+            if value is NOT_FOUND:
+                value, count = _materialize(func(*args, **kwargs))
+                status = "MISS"
+                if _request_budget_allows(count):
+                    req_cache_set(cache_key, value)
+                else:
+                    status = "SKIP"
                 ts = (datetime.now() - t1).total_seconds()
-                ctx.log.debug("RTCache MISS %s(%s) (%.3f secs)",
-                              func.__name__, cache_key, ts)
+                ctx.log.debug("RTCache %s %s(%s) (%.3f secs)",
+                              status, func.__name__, cache_key, ts)
             else:
-                value = req_cache_get(cache_key)
-                if isinstance(value, ObjectsCursor):
-                    value.cursor.rewind()
                 ts = (datetime.now() - t1).total_seconds()
                 ctx.log.debug("RTCache HIT  %s(%s) (%.3f secs)",
                               func.__name__, cache_key, ts)
+            if isinstance(value, _Materialized):
+                return list(value.items)
             return value
         return wrapper
     return cache_decorator
@@ -0,0 +1,220 @@
+import pickle
+import struct
+import zlib
+
+from datetime import datetime, timedelta
+import bson
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+
+from . import ctx
+from .cache import CacheEntry
+from .errors import ConfigurationError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+# encoded values start with the marker and the codec version
+CODEC_MARKER = 0xCE
+CODEC_VERSION = 1
+HEADER = struct.Struct("!BBBBB")  # marker, version, serializer, compression, entry
+
+SERIALIZER_PICKLE = 0
+SERIALIZER_BSON = 1
+SERIALIZER_MSGPACK = 2
+SERIALIZERS = {"pickle": SERIALIZER_PICKLE, "bson": SERIALIZER_BSON, "msgpack": SERIALIZER_MSGPACK}
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZ4 = 2
+COMPRESSIONS = {None: COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "lz4": COMPRESSION_LZ4}
+
+DEFAULT_SERIALIZER = "pickle"
+DEFAULT_COMPRESSION = "zlib"
+DEFAULT_COMPRESS_THRESHOLD = 1024
+DEFAULT_ZLIB_LEVEL = 6
+
+MSGPACK_EXT_OBJECTID = 1
+MSGPACK_EXT_DATETIME = 2
+EPOCH = datetime(1970, 1, 1)
+
+
+def _msgpack_default(o):
+    if isinstance(o, ObjectId):
+        return msgpack.ExtType(MSGPACK_EXT_OBJECTID, o.binary)
+    if isinstance(o, datetime) and o.tzinfo is None:
+        delta = o - EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return msgpack.ExtType(MSGPACK_EXT_DATETIME, struct.pack("!q", micros))
+    raise TypeError(f"can not serialize {o.__class__.__name__}")
+
+
+def _msgpack_ext_hook(code, data):
+    if code == MSGPACK_EXT_OBJECTID:
+        return ObjectId(data)
+    if code == MSGPACK_EXT_DATETIME:
+        return EPOCH + timedelta(microseconds=struct.unpack("!q", data)[0])
+    return msgpack.ExtType(code, data)
+
+
+class CacheCodec:
+    """
+    Encodes cache values into compact bytes. Values are serialized with
+    bson or msgpack if possible falling back to pickle for the types these
+    can't handle, and compressed if larger than compress_threshold.
+
+    Note that bson and msgpack store tuples as lists and bson keeps
+    datetimes with millisecond precision, just like MongoDB does
+    """
+
+    def __init__(self, serializer=DEFAULT_SERIALIZER, compression=DEFAULT_COMPRESSION,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD, zlib_level=DEFAULT_ZLIB_LEVEL):
+        if serializer not in SERIALIZERS:
+            raise ConfigurationError(f"unknown cache serializer {serializer}")
+        if serializer == "msgpack" and msgpack is None:
+            raise ConfigurationError("cache serializer is set to msgpack which is not installed")
+        if compression not in COMPRESSIONS:
+            raise ConfigurationError(f"unknown cache compression {compression}")
+        if compression == "lz4" and lz4 is None:
+            raise ConfigurationError("cache compression is set to lz4 which is not installed")
+        self.serializer = SERIALIZERS[serializer]
+        self.compression = COMPRESSIONS[compression]
+        self.compress_threshold = compress_threshold
+        self.zlib_level = zlib_level
+
+    def _serialize(self, value):
+        if self.serializer != SERIALIZER_PICKLE:
+            try:
+                if self.serializer == SERIALIZER_BSON:
+                    return SERIALIZER_BSON, bson.encode({"v": value})
+                return SERIALIZER_MSGPACK, msgpack.packb(value, default=_msgpack_default, use_bin_type=True)
+            except (InvalidDocument, TypeError, ValueError, OverflowError):
+                pass
+        return SERIALIZER_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _deserialize(serializer, data):
+        if serializer == SERIALIZER_BSON:
+            return bson.decode(data)["v"]
+        if serializer == SERIALIZER_MSGPACK:
+            if msgpack is None:
+                raise ValueError("msgpack is not installed")
+            return msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, raw=False, strict_map_key=False)
+        return pickle.loads(data)
+
+    def _compress(self, data):
+        if self.compression == COMPRESSION_NONE or len(data) < self.compress_threshold:
+            return COMPRESSION_NONE, data
+        if self.compression == COMPRESSION_ZLIB:
+            compressed = zlib.compress(data, self.zlib_level)
+        else:
+            compressed = lz4.compress(data)
+        if len(compressed) >= len(data):
+            return COMPRESSION_NONE, data
+        return self.compression, compressed
+
+    @staticmethod
+    def _decompress(compression, data):
+        if compression == COMPRESSION_ZLIB:
+            return zlib.decompress(data)
+        if compression == COMPRESSION_LZ4:
+            if lz4 is None:
+                raise ValueError("lz4 is not installed")
+            return lz4.decompress(data)
+        return data
+
+    def encode(self, value):
+        entry = isinstance(value, CacheEntry)
+        if entry:
+            value = list(value)
+        serializer, data = self._serialize(value)
+        compression, data = self._compress(data)
+        return HEADER.pack(CODEC_MARKER, CODEC_VERSION, serializer, compression, entry) + data
+
+    def decode(self, data):
+        """
+        :return: value decoded. Values which are not encoded by a codec
+                 (i.e. stored before the codec was enabled) are returned as is
+        """
+        if not isinstance(data, bytes) or len(data) < HEADER.size or data[0] != CODEC_MARKER:
+            return data
+        _, version, serializer, compression, entry = HEADER.unpack_from(data)
+        if version != CODEC_VERSION:
+            raise ValueError(f"unsupported cache codec version {version}")
+        value = self._deserialize(serializer, self._decompress(compression, data[HEADER.size:]))
+        if entry:
+            value = CacheEntry(*value)
+        return value
+
+
+class CodecCache:
+    """
+    Wraps a cachelib cache encoding values with a CacheCodec. Values which
+    can't be decoded are reported as missing. Other methods and attributes
+    are proxied to the cache as is
+    """
+
+    def __init__(self, cache, codec):
+        self.cache = cache
+        self.codec = codec
+
+    def __getattr__(self, item):
+        return getattr(self.cache, item)
+
+    def _decode(self, key, data):
+        if data is None:
+            return None
+        try:
+            return self.codec.decode(data)
+        except Exception as e:
+            ctx.log.error("error decoding cache value %s: %s", key, e)
+            return None
+
+    def get(self, key):
+        return self._decode(key, self.cache.get(key))
+
+    def get_many(self, *keys):
+        return [self._decode(key, data) for key, data in zip(keys, self.cache.get_many(*keys))]
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def set(self, key, value, timeout=None):
+        return self.cache.set(key, self.codec.encode(value), timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.cache.add(key, self.codec.encode(value), timeout=timeout)
+
+    def set_many(self, mapping, timeout=None):
+        return self.cache.set_many({key: self.codec.encode(value) for key, value in mapping.items()},
+                                   timeout=timeout)
+
+    @property
+    def delete_if_equal(self):
+        # only available if the cache supports it, see cache._release_lock()
+        if not hasattr(self.cache, "delete_if_equal"):
+            raise AttributeError("delete_if_equal")
+        return lambda key, value: self.cache.delete_if_equal(key, self.codec.encode(value))
+
+
+def create_codec_cache(cache, cfg):
+    """
+    :param cache: cachelib cache to wrap
+    :param cfg: cache_codec settings: serializer ("pickle", "bson" or "msgpack"),
+                compression (null, "zlib" or "lz4"), compress_threshold in bytes
+                and zlib_level
+    """
+    codec = CacheCodec(
+        serializer=cfg.get("serializer", DEFAULT_SERIALIZER),
+        compression=cfg.get("compression", DEFAULT_COMPRESSION),
+        compress_threshold=cfg.get("compress_threshold", DEFAULT_COMPRESS_THRESHOLD),
+        zlib_level=cfg.get("zlib_level", DEFAULT_ZLIB_LEVEL),
+    )
+    return CodecCache(cache, codec)
@@ -59,6 +59,7 @@ class _Context:
     log = gen_ctx_prop("log", default=logging)
     db = gen_ctx_prop("db")
     cache = gen_ctx_prop("cache")
+    local_cache = gen_ctx_prop("local_cache", default=None)
     filecache = gen_ctx_prop("filecache")
     queue = gen_ctx_prop("queue")
     line_profiler = _LineProfilerFuncs()
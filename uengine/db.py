@@ -1,13 +1,30 @@
+import heapq
 import pymongo
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial, wraps
+from hashlib import md5
+from itertools import chain, islice
+from bson import json_util
 from bson.objectid import ObjectId, InvalidId
-from time import sleep
+from flask import g, has_request_context
+from queue import Queue, Full
+from threading import Event, Lock, Thread
+from time import sleep, time, perf_counter
 from datetime import datetime
-from random import randint
-from pymongo.errors import ServerSelectionTimeoutError
+from random import uniform
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import AutoReconnect, ConnectionFailure, ServerSelectionTimeoutError, BulkWriteError
+try:
+    from pymongo.errors import NotPrimaryError
+except ImportError:  # pymongo < 3.12
+    from pymongo.errors import NotMasterError as NotPrimaryError
 from pymongo.uri_parser import parse_uri
-from uengine.errors import InvalidShardId
+from uengine.errors import InvalidShardId, DatabaseUnavailable
+from uengine.identity_map import identity_map_load, identity_map_lookup
+from uengine.shard_placement import create_placement_strategy
 from urllib.parse import quote_plus, urlencode
 
 
@@ -15,124 +32,653 @@ from . import ctx
 
 MONGO_RETRIES = 6
 MONGO_RETRIES_RO = 6
-RETRY_SLEEP = 3  # 3 seconds
+RETRY_SLEEP = 3  # 3 seconds, max delay between retries
+RETRY_INITIAL_DELAY = 0.1
+RETRY_MAX_TIME = 18
+
+# Writes are retried only when it's known they haven't been applied,
+# a generic AutoReconnect may happen after the server has done the job
+RETRYABLE_ERRORS_RW = (ServerSelectionTimeoutError, NotPrimaryError)
+RETRYABLE_ERRORS_RO = (AutoReconnect,)
+
+CIRCUIT_FAILURE_THRESHOLD = 10
+CIRCUIT_RESET_TIMEOUT = 30  # seconds before probing an unavailable database
+CIRCUIT_PROBE_TIMEOUT = 30  # seconds to wait for a probe to report before opening again
+
+LATENCY_EWMA_ALPHA = 0.2
+DEFAULT_BULK_CHUNK_SIZE = 1000
+DEFAULT_CURSOR_CHUNK_SIZE = 100
+
+COUNT_EXACT = "exact"
+COUNT_ESTIMATED = "estimated"  # collection metadata, used for empty queries only
+COUNT_CAPPED = "capped"  # stop counting at the cap
+COUNT_CACHED = "cached"  # exact count cached in ctx.cache until a model save
+COUNT_STRATEGIES = (COUNT_EXACT, COUNT_ESTIMATED, COUNT_CAPPED, COUNT_CACHED)
+DEFAULT_COUNT_CAP = 1000
+DEFAULT_COUNT_CACHE_TTL = 30
+PREFETCH_POLL_INTERVAL = 0.1
+# the shards pool is shared by all the request threads, by default it's sized
+# for that many concurrent scatter-gather calls not waiting for each other
+SHARDS_POOL_CONCURRENCY = 8
+
+# mongo sort order of BSON types, see
+# https://docs.mongodb.com/manual/reference/bson-type-comparison-order/
+_TYPE_ORDER = (
+    (type(None), 1),
+    (bool, 8),
+    ((int, float), 2),
+    (str, 3),
+    (dict, 4),
+    ((list, tuple), 5),
+    (ObjectId, 7),
+    (datetime, 9),
+)
 
 
 class AbortTransaction(Exception):
     pass
 
 
-def intercept_mongo_errors_rw(func):
-    def wrapper(*args, **kwargs):
-        if "retries_left" in kwargs:
-            retries_left = kwargs["retries_left"]
-            del kwargs["retries_left"]
-        else:
-            retries_left = MONGO_RETRIES
-
-        try:
-            result = func(*args, **kwargs)
-        except ServerSelectionTimeoutError:
-            ctx.log.error(
-                "ServerSelectionTimeout in db module for read/write operations")
-            retries_left -= 1
-            if retries_left == MONGO_RETRIES / 2:
-                ctx.log.error(
-                    "Mongo connection %d retries passed with no result, "
-                    "trying to reinstall connection",
-                    MONGO_RETRIES / 2
-                )
-                db_obj = args[0]
-                db_obj.reset_conn()
-            if retries_left == 0:
-                ctx.log.error(
-                    "Mongo connection %d retries more passed with no result, giving up", MONGO_RETRIES / 2)
-                raise
-
-            sleep(RETRY_SLEEP)
-            kwargs["retries_left"] = retries_left
-            return wrapper(*args, **kwargs)
-
-        return result
-
-    return wrapper
-
-
-def intercept_mongo_errors_ro(func):
-    def wrapper(*args, **kwargs):
-        if "retries_left" in kwargs:
-            retries_left = kwargs["retries_left"]
-            del kwargs["retries_left"]
-        else:
-            retries_left = MONGO_RETRIES
+class RetryPolicy:
+    """
+    Describes how mongo operations are retried on connection errors:
+    exponential backoff starting from initial_delay, multiplied by multiplier
+    on every attempt up to max_delay, randomized by +-jitter share. No more
+    than retries attempts are made and no sleep goes beyond max_time seconds
+    since the operation has started (or the request deadline, whichever is sooner)
+    """
+
+    def __init__(self, retries=MONGO_RETRIES, initial_delay=RETRY_INITIAL_DELAY, max_delay=RETRY_SLEEP,
+                 multiplier=2, jitter=0.2, max_time=RETRY_MAX_TIME, retryable=None):
+        self.retries = retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_time = max_time
+        self.retryable = retryable
+
+    @classmethod
+    def from_config(cls, cfg, retryable, **defaults):
+        """
+        :param cfg: dict of RetryPolicy constructor arguments, "retryable"
+                    is a list of pymongo.errors class names
+        """
+        kwargs = dict(defaults)
+        kwargs.update((k, v) for k, v in cfg.items() if k != "retryable")
+        if "retryable" in cfg:
+            retryable = tuple(getattr(pymongo.errors, name) for name in cfg["retryable"])
+        return cls(retryable=retryable, **kwargs)
+
+    def delay(self, attempt):
+        delay = min(self.initial_delay * self.multiplier ** (attempt - 1), self.max_delay)
+        if self.jitter:
+            delay *= 1 + uniform(-self.jitter, self.jitter)
+        return delay
+
+    def deadline(self, started):
+        deadline = started + self.max_time if self.max_time else None
+        request_deadline = get_request_deadline()
+        if request_deadline is not None and (deadline is None or request_deadline < deadline):
+            deadline = request_deadline
+        return deadline
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a database after failure_threshold consecutive
+    operations failed with connection errors (each one after its retries).
+    Once reset_timeout seconds pass a single probe request is let through
+    (half-open state): its success closes the circuit, a failure opens it
+    again, as does the probe not reporting back within probe_timeout seconds
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT,
+                 probe_timeout=CIRCUIT_PROBE_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+        self._lock = Lock()
 
-        try:
-            result = func(*args, **kwargs)
-        except pymongo.errors.ServerSelectionTimeoutError:
-            ctx.log.error(
-                "ServerSelectionTimeout in db module for read-only operations")
-            retries_left -= 1
-            if retries_left == MONGO_RETRIES_RO / 2:
-                ctx.log.error(
-                    "Mongo readonly connection %d retries passed, switching "
-                    "readonly operations to read-write socket",
-                    MONGO_RETRIES_RO / 2
-                )
-                db_obj = args[0]
-                db_obj._ro_conn = db_obj.conn  # pylint: disable=protected-access
-            if retries_left == 0:
-                raise
-
-            sleep(RETRY_SLEEP)
-            kwargs["retries_left"] = retries_left
-            return wrapper(*args, **kwargs)
+    @property
+    def is_open(self):
+        return self.state == self.OPEN and time() - self.opened_at < self.reset_timeout
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            now = time()
+            if self.state == self.HALF_OPEN and now - self.probe_started_at >= self.probe_timeout:
+                # the probe has never reported, i.e. has been killed
+                ctx.log.error("Mongo circuit breaker probe timed out")
+                self.state = self.OPEN
+                self.opened_at = now
+                self.probe_started_at = None
+            elif self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_started_at = now
+                return True
+            # either open or a probe is in progress
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.state == self.CLOSED and self.failures == 0:
+            return
+        with self._lock:
+            if self.state != self.CLOSED:
+                ctx.log.info("Mongo circuit breaker is closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    ctx.log.error("Mongo circuit breaker is open after %d failures", self.failures)
+                self.state = self.OPEN
+                self.opened_at = time()
+                self.probe_started_at = None
+
+    def info(self):
+        return dict(
+            state=self.state,
+            failures=self.failures,
+            opened_at=datetime.fromtimestamp(self.opened_at) if self.opened_at else None,
+        )
 
-        return result
 
-    return wrapper
+def get_request_deadline():
+    if not has_request_context():
+        return None
+    return getattr(g, "request_deadline", None)
+
+
+def _intercept_mongo_errors(mode, on_half_retries):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(db_obj, *args, **kwargs):
+            policy = db_obj.retry_policies[mode]
+            breaker = db_obj.circuit_breaker
+            deadline = policy.deadline(time())
+            # the breaker is consulted once per operation so that the retries
+            # of an operation let through are not cut short by other failures
+            if not breaker.allow():
+                db_obj.retry_stats[f"{mode}_rejects"] += 1
+                raise DatabaseUnavailable(f"database {db_obj.name} is unavailable")
+            attempt = 0
+            while True:
+                started = perf_counter()
+                try:
+                    result = func(db_obj, *args, **kwargs)
+                except policy.retryable as e:
+                    attempt += 1
+                    delay = policy.delay(attempt)
+                    ctx.log.error("%s in db module for %s operations, attempt %d: %s",
+                                  e.__class__.__name__, mode, attempt, e)
+                    if attempt >= policy.retries or (deadline is not None and time() + delay > deadline):
+                        ctx.log.error("Mongo %s operation failed after %d attempts, giving up", mode, attempt)
+                        db_obj.retry_stats[f"{mode}_failures"] += 1
+                        breaker.record_failure()
+                        raise
+                    db_obj.retry_stats[f"{mode}_retries"] += 1
+                    if attempt == policy.retries // 2:
+                        on_half_retries(db_obj, attempt)
+                    sleep(delay)
+                except ConnectionFailure:
+                    breaker.record_failure()
+                    raise
+                except Exception:
+                    # the server has responded which is all the breaker cares about
+                    breaker.record_success()
+                    raise
+                else:
+                    breaker.record_success()
+                    db_obj.record_latency(mode, perf_counter() - started)
+                    return result
+
+        return wrapper
+    return decorator
+
+
+def _reset_rw_conn(db_obj, attempt):
+    ctx.log.error(
+        "Mongo connection %d retries passed with no result, "
+        "trying to reinstall connection", attempt)
+    db_obj.reset_conn()
+
+
+def _fallback_ro_conn(db_obj, attempt):
+    ctx.log.error(
+        "Mongo readonly connection %d retries passed, switching "
+        "readonly operations to read-write socket", attempt)
+    db_obj._ro_conn = db_obj.conn  # pylint: disable=protected-access
+
+
+intercept_mongo_errors_rw = _intercept_mongo_errors("rw", _reset_rw_conn)
+intercept_mongo_errors_ro = _intercept_mongo_errors("ro", _fallback_ro_conn)
 
 
 class ObjectsCursor:
 
-    def __init__(self, cursor, obj_class, shard_id=None):
+    def __init__(self, cursor, obj_class, shard_id=None, projected_finder=None, query_finder=None,
+                 counter=None, identity_map=False):
+        """
+        :param projected_finder: callable accepting a projection and returning
+                                 a raw cursor for the same query. Used by as_dicts()
+        :param query_finder: callable accepting an additional query condition and
+                             returning an ObjectsCursor for the narrowed query. Used by keyset()
+        :param counter: callable counting the documents of the same query with
+                        a count strategy given. Used by count_with()
+        :param identity_map: load objects through the request identity map.
+                             Must be off for projected queries
+        """
         self.obj_class = obj_class
         self.cursor = cursor
         self._shard_id = shard_id
+        self._projected_finder = projected_finder
+        self._query_finder = query_finder
+        self._counter = counter
+        self._identity_map = identity_map
+        self._modifiers = []
+        self._batch_size = None
+        self._prefetch = 0
 
     def all(self):
         return list(self)
 
+    def batch_size(self, batch_size):
+        self.cursor.batch_size(batch_size)
+        self._modifiers.append(("batch_size", (batch_size,), {}))
+        self._batch_size = batch_size
+        return self
+
+    def prefetch(self, depth=1):
+        """
+        Makes the cursor fetch documents on a helper thread, keeping up to
+        depth chunks ready while the caller processes the current one.
+        Useful for long scans bound by getMore round-trips
+
+        :param depth: number of chunks to fetch ahead, 0 disables prefetching
+        """
+        self._prefetch = depth
+        return self
+
     def limit(self, *args, **kwargs):
         self.cursor.limit(*args, **kwargs)
+        self._modifiers.append(("limit", args, kwargs))
         return self
 
     def skip(self, *args, **kwargs):
         self.cursor.skip(*args, **kwargs)
+        self._modifiers.append(("skip", args, kwargs))
         return self
 
     def sort(self, *args, **kwargs):
         self.cursor.sort(*args, **kwargs)
+        self._modifiers.append(("sort", args, kwargs))
         return self
 
+    def count_with(self, strategy=COUNT_EXACT, **kwargs):
+        """
+        Counts the documents matching the query regardless of skip and limit
+
+        :param strategy: one of COUNT_STRATEGIES
+        :return: tuple (count, capped), capped is True if there are more
+                 documents than the count returned
+        """
+        if self._counter is None:
+            return self.cursor.count(), False
+        return self._counter(strategy, **kwargs)
+
+    @property
+    def sort_spec(self):
+        for method, args, kwargs in reversed(self._modifiers):
+            if method == "sort":
+                return normalize_sort(*args, **kwargs)
+        return []
+
+    @property
+    def keyset_sort(self):
+        """Current sort order made unique by adding _id as the last key"""
+        sort = self.sort_spec
+        if "_id" not in (field for field, _ in sort):
+            # follow the direction of the last key so the index can be walked backwards
+            direction = sort[-1][1] if sort else pymongo.ASCENDING
+            sort.append(("_id", direction))
+        return sort
+
+    def keyset_values(self, obj):
+        """Values of keyset_sort fields of an object returned by this cursor"""
+        return [_get_sort_value(obj, field.split(".")) for field, _ in self.keyset_sort]
+
+    def keyset(self, after=None):
+        """
+        Returns a cursor sorted by keyset_sort which starts right after the document
+        having the keyset values given. Unlike skip() it uses the index to seek to the
+        position so deep pages cost the same as the first one. The sort fields should
+        be of the same type in all the documents, i.e. never missing or null.
+
+        :param after: keyset_values() of the last object seen, None to start over
+        """
+        sort = self.keyset_sort
+        if after is None:
+            return self.sort(sort)
+        if self._query_finder is None:
+            raise TypeError("keyset pagination is not supported by this cursor")
+        cursor = self._query_finder(keyset_condition(sort, after))
+        for method, args, kwargs in self._modifiers:
+            if method not in ("skip", "sort"):
+                getattr(cursor, method)(*args, **kwargs)
+        return cursor.sort(sort)
+
+    @property
+    def model_class(self):
+        # obj_class is usually a bound from_data classmethod
+        return getattr(self.obj_class, "__self__", self.obj_class)
+
+    def raw(self):
+        """Iterates over the documents as they are stored in DB"""
+        return iter(self.cursor)
+
+    def as_dicts(self, fields=None):
+        """
+        Iterates over to_dict(fields) representations of the objects. Whenever
+        possible the fields are fetched using a projection and no model objects
+        are created at all
+        """
+        model_class = self.model_class
+        stored_fields = None
+        if self._projected_finder is not None and hasattr(model_class, "get_stored_fields"):
+            stored_fields = model_class.get_stored_fields(fields)
+
+        if stored_fields is None:
+            return (obj.to_dict(fields) for obj in self)
+
+        projection = {field: True for field in stored_fields}
+        projection["_id"] = "_id" in stored_fields
+        if not stored_fields:
+            # empty projection means the whole document
+            projection["_id"] = True
+        cursor = self._projected_finder(projection)
+        for method, args, kwargs in self._modifiers:
+            getattr(cursor, method)(*args, **kwargs)
+        return (model_class.dict_from_document(doc, stored_fields) for doc in cursor)
+
+    def _load(self, item):
+        if self._identity_map:
+            obj = identity_map_lookup(self.obj_class, self._shard_id, item.get("_id"))
+            if obj is not None:
+                return obj
+        if self._shard_id:
+            item["shard_id"] = self._shard_id
+        obj = self.obj_class(**item)
+        if self._identity_map:
+            obj = identity_map_load(obj)
+        return obj
+
+    def _raw_chunks(self, size):
+        cursor = iter(self.cursor)
+        while True:
+            chunk = list(islice(cursor, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _prefetched_chunks(self, size):
+        chunks = Queue(maxsize=self._prefetch)
+        stop = Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=PREFETCH_POLL_INTERVAL)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for chunk in self._raw_chunks(size):
+                    if not put(chunk):
+                        return
+            except Exception as e:  # pylint: disable=broad-except
+                put(e)
+                return
+            put(None)
+
+        Thread(target=fetch, daemon=True, name="cursor-prefetch").start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            # the caller may stop iterating early, release the helper thread
+            stop.set()
+
+    def chunks(self, size=None):
+        """
+        Iterates over lists of objects. By default the chunk size follows
+        the cursor batch size so every chunk corresponds to a single round-trip
+
+        :param size: number of objects per chunk
+        """
+        if size is None:
+            size = self._batch_size or DEFAULT_CURSOR_CHUNK_SIZE
+        if self._prefetch:
+            raw_chunks = self._prefetched_chunks(size)
+        else:
+            raw_chunks = self._raw_chunks(size)
+        for chunk in raw_chunks:
+            yield [self._load(item) for item in chunk]
+
     def __iter__(self):
+        if self._prefetch:
+            for chunk in self.chunks():
+                yield from chunk
+            return
         for item in self.cursor:
-            if self._shard_id:
-                item["shard_id"] = self._shard_id
-            yield self.obj_class(**item)
+            yield self._load(item)
 
     def __getitem__(self, item):
-        attrs = self.cursor.__getitem__(item)
-        if self._shard_id:
-            attrs["shard_id"] = self._shard_id
-        return self.obj_class(**attrs)
+        return self._load(self.cursor.__getitem__(item))
 
     def __getattr__(self, item):
         return getattr(self.cursor, item)
 
 
+def _type_order(value):
+    for types, order in _TYPE_ORDER:
+        if isinstance(value, types):
+            return order
+    return 6
+
+
+def _get_sort_value(obj, path):
+    value = obj
+    for token in path:
+        if isinstance(value, dict):
+            value = value.get(token)
+        else:
+            value = getattr(value, token, None)
+        if value is None:
+            break
+    return value
+
+
+class _SortKey:
+
+    __slots__ = ("values", "directions")
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for a, b, direction in zip(self.values, other.values, self.directions):
+            ta, tb = _type_order(a), _type_order(b)
+            if ta == tb:
+                if a == b:
+                    continue
+                try:
+                    less = a < b
+                except TypeError:
+                    less = str(a) < str(b)
+            else:
+                less = ta < tb
+            return less if direction == pymongo.ASCENDING else not less
+        return False
+
+
+def keyset_condition(sort, values):
+    """
+    Builds a query condition matching the documents following the one
+    having the values given in the sort order given
+    """
+    conditions = []
+    for idx, (field, direction) in enumerate(sort):
+        condition = {prev_field: value for (prev_field, _), value in zip(sort[:idx], values)}
+        op = "$gt" if direction == pymongo.ASCENDING else "$lt"
+        condition[field] = {op: values[idx]}
+        conditions.append(condition)
+    return {"$or": conditions}
+
+
+def _count_generation_key(collection):
+    return f"count_gen.{collection}"
+
+
+def count_cache_key(db_name, collection, query):
+    """
+    Cached counts of a collection are keyed by its current generation
+    so they can be dropped at once by invalidate_counts()
+    """
+    generation_key = _count_generation_key(collection)
+    generation = ctx.cache.get(generation_key)
+    if generation is None:
+        generation = str(ObjectId())
+        ctx.cache.set(generation_key, generation, timeout=0)
+    query_hash = md5(json_util.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"count.{collection}.{db_name}.{generation}.{query_hash}"
+
+
+def invalidate_counts(collection):
+    """
+    Drops the cached counts of a collection. Nothing is written unless counts
+    are cached by default or some have been cached for the collection
+    """
+    generation_key = _count_generation_key(collection)
+    if ctx.cfg.get("count_strategy") == COUNT_CACHED or ctx.cache.has(generation_key):
+        ctx.cache.set(generation_key, str(ObjectId()), timeout=0)
+
+
+def normalize_sort(key_or_list, direction=None):
+    if key_or_list is None:
+        return []
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or pymongo.ASCENDING)]
+    return [(key, order) for key, order in key_or_list]
+
+
+class ShardsCursor:
+    """
+    Merges ObjectsCursors of several shards into a single stream honouring
+    sort, skip and limit. The first batch of every shard is fetched concurrently,
+    the results are then merged lazily with a k-way merge.
+    """
+
+    def __init__(self, cursors):
+        self.cursors = cursors
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+
+    def all(self):
+        return list(self)
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = normalize_sort(key_or_list, direction)
+        return self
+
+    def count(self):
+        counts = ctx.db.run_on_shards(
+            lambda shard_id: self.cursors[shard_id].cursor.count(), self.cursors)
+        return sum(counts.values())
+
+    def count_with(self, strategy=COUNT_EXACT, **kwargs):
+        counts = ctx.db.run_on_shards(
+            lambda shard_id: self.cursors[shard_id].count_with(strategy, **kwargs), self.cursors)
+        count = sum(shard_count for shard_count, _ in counts.values())
+        capped = any(shard_capped for _, shard_capped in counts.values())
+        cap = kwargs.get("cap", DEFAULT_COUNT_CAP)
+        if strategy == COUNT_CAPPED and count > cap:
+            count, capped = cap, True
+        return count, capped
+
+    def _sort_key(self, obj):
+        values = [_get_sort_value(obj, key.split(".")) for key, _ in self._sort]
+        return _SortKey(values, [order for _, order in self._sort])
+
+    def _prepare(self, shard_id):
+        cursor = self.cursors[shard_id]
+        if self._sort:
+            cursor.sort(self._sort)
+        if self._limit:
+            cursor.limit(self._skip + self._limit)
+        iterator = iter(cursor)
+        try:
+            first = next(iterator)
+        except StopIteration:
+            return None
+        return chain([first], iterator)
+
+    def __iter__(self):
+        iterators = ctx.db.run_on_shards(self._prepare, self.cursors)
+        iterators = [it for it in iterators.values() if it is not None]
+        if self._sort:
+            merged = heapq.merge(*iterators, key=self._sort_key)
+        else:
+            merged = chain(*iterators)
+        stop = self._skip + self._limit if self._limit else None
+        merged = islice(merged, self._skip, stop)
+        if any(cursor._identity_map for cursor in self.cursors.values()):
+            # the first objects of every shard are loaded by executor threads
+            # which have no app context and skip the identity map
+            return map(identity_map_load, merged)
+        return merged
+
+
 def pick_rw_shard_id():
-    idx = randint(0, len(ctx.db.rw_shards)-1)
-    return ctx.db.rw_shards[idx]
+    shard_ids = [shard_id for shard_id in ctx.db.rw_shards
+                 if not ctx.db.shards[shard_id].circuit_breaker.is_open]
+    if not shard_ids:
+        # nothing is known to be alive, let the circuit breakers decide
+        shard_ids = ctx.db.rw_shards
+    return ctx.db.placement.pick(shard_ids)
 
 
 class _DB:
@@ -161,6 +707,26 @@ class _DB:
         self._ro_conn = None
         self._shard_id = shard_id
         self._session = None
+        retry_cfg = dbconf.get("retry", {})
+        self.retry_policies = {
+            "rw": RetryPolicy.from_config(retry_cfg.get("rw", {}), RETRYABLE_ERRORS_RW),
+            "ro": RetryPolicy.from_config(retry_cfg.get("ro", {}), RETRYABLE_ERRORS_RO,
+                                          retries=MONGO_RETRIES_RO),
+        }
+        self.retry_stats = Counter()
+        self.circuit_breaker = CircuitBreaker(**dbconf.get("circuit_breaker", {}))
+        self.avg_latency = {"rw": None, "ro": None}
+
+    @property
+    def name(self):
+        return self._shard_id or "meta"
+
+    def record_latency(self, mode, elapsed):
+        avg = self.avg_latency[mode]
+        if avg is None:
+            self.avg_latency[mode] = elapsed
+        else:
+            self.avg_latency[mode] = avg + LATENCY_EWMA_ALPHA * (elapsed - avg)
 
     def reset_conn(self):
         self._rw_client = None
@@ -256,17 +822,26 @@ class _DB:
         return self._ro_conn
 
     @intercept_mongo_errors_ro
-    def get_obj(self, cls, collection, query):
+    def get_obj(self, cls, collection, query, identity_map=True):
+        """
+        :param identity_map: False to always query the database and get
+                             a new object, i.e. to reload one
+        """
         if not isinstance(query, dict):
             try:
                 query = {'_id': ObjectId(query)}
             except InvalidId:
                 pass
+        if identity_map and isinstance(query, dict) and len(query) == 1 and isinstance(query.get("_id"), ObjectId):
+            obj = identity_map_lookup(cls, self._shard_id, query["_id"])
+            if obj is not None:
+                return obj
         data = self.ro_conn[collection].find_one(query, session=self._session)
         if data:
             if self._shard_id:
                 data["shard_id"] = self._shard_id
-            return cls(**data)
+            obj = cls(**data)
+            return identity_map_load(obj) if identity_map else obj
 
         return None
 
@@ -279,7 +854,18 @@ class _DB:
         if self._session:
             kwargs["session"] = self._session
         cursor = self.ro_conn[collection].find(query, **kwargs)
-        return ObjectsCursor(cursor, cls, shard_id=self._shard_id)
+        projected_finder = None
+        if "projection" not in kwargs:
+            def projected_finder(projection):
+                return self.get_objs_projected(collection, query, projection, **kwargs)
+
+        def query_finder(condition):
+            narrowed = {"$and": [query, condition]} if query else condition
+            return self.get_objs(cls, collection, narrowed, **kwargs)
+
+        return ObjectsCursor(cursor, cls, shard_id=self._shard_id, projected_finder=projected_finder,
+                             query_finder=query_finder, counter=partial(self.count_query, collection, query),
+                             identity_map="projection" not in kwargs)
 
     @intercept_mongo_errors_ro
     def get_objs_projected(self, collection, query, projection, **kwargs):
@@ -300,6 +886,34 @@ class _DB:
     def count_docs(self, collection, query, **kwargs):
         return self.ro_conn[collection].count_documents(query, **kwargs)
 
+    @intercept_mongo_errors_ro
+    def estimated_count(self, collection):
+        return self.ro_conn[collection].estimated_document_count()
+
+    def count_query(self, collection, query, strategy=COUNT_EXACT, cap=DEFAULT_COUNT_CAP,
+                    ttl=DEFAULT_COUNT_CACHE_TTL):
+        """
+        :param strategy: one of COUNT_STRATEGIES
+        :param cap: max count for the capped strategy
+        :param ttl: cache timeout for the cached strategy
+        :return: tuple (count, capped)
+        """
+        if strategy not in COUNT_STRATEGIES:
+            raise ValueError(f"unknown count strategy {strategy}")
+        if strategy == COUNT_ESTIMATED and not query:
+            return self.estimated_count(collection), False
+        if strategy == COUNT_CAPPED:
+            count = self.count_docs(collection, query, limit=cap + 1)
+            return min(count, cap), count > cap
+        if strategy == COUNT_CACHED:
+            cache_key = count_cache_key(self.name, collection, query)
+            count = ctx.cache.get(cache_key)
+            if count is None:
+                count = self.count_docs(collection, query)
+                ctx.cache.set(cache_key, count, timeout=ttl)
+            return count, False
+        return self.count_docs(collection, query), False
+
     def get_objs_by_field_in(self, cls, collection, field, values, **kwargs):
         return self.get_objs(
             cls,
@@ -322,10 +936,84 @@ class _DB:
             inserted_id = self.conn[obj.collection].insert_one(
                 data, session=self._session).inserted_id
             obj._id = inserted_id
+        elif obj.USE_PARTIAL_UPDATES:
+            update = obj._get_partial_update()
+            if not update:
+                return
+            result = self.conn[obj.collection].update_one(
+                {'_id': obj._id}, update, session=self._session)
+            if result.matched_count == 0:
+                # the document has gone, restore it as a whole like replace_one would do
+                self.conn[obj.collection].replace_one(
+                    {'_id': obj._id}, obj.to_dict(include_restricted=True), upsert=True, session=self._session)
         else:
             self.conn[obj.collection].replace_one(
                 {'_id': obj._id}, obj.to_dict(include_restricted=True), upsert=True, session=self._session)
 
+    @intercept_mongo_errors_rw
+    def save_objs(self, collection, objs, ordered=False, chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        """
+        Saves objects of the same collection using bulk_write, chunk_size objects
+        per request. New objects get their _id assigned once written.
+
+        :return: tuple of (indexes of objects saved, list of write errors).
+                 Write error indexes refer to positions in objs
+        """
+        saved = []
+        errors = []
+        for offset in range(0, len(objs), chunk_size):
+            chunk = objs[offset:offset + chunk_size]
+            ops = []
+            op_indexes = []
+            new_ids = {}
+            for idx, obj in enumerate(chunk):
+                if obj.is_new:
+                    data = obj.to_dict(include_restricted=True)
+                    # ids are generated client-side as bulk_write
+                    # doesn't report inserted ids back
+                    data["_id"] = ObjectId()
+                    new_ids[idx] = data["_id"]
+                    ops.append(InsertOne(data))
+                elif obj.USE_PARTIAL_UPDATES:
+                    # unlike save_obj() a partial update of a document deleted
+                    # in the meantime is not turned into an upsert here
+                    update = obj._get_partial_update()
+                    if not update:
+                        continue
+                    ops.append(UpdateOne({'_id': obj._id}, update))
+                else:
+                    data = obj.to_dict(include_restricted=True)
+                    ops.append(ReplaceOne({'_id': obj._id}, data, upsert=True))
+                op_indexes.append(idx)
+
+            chunk_errors = []
+            if ops:
+                try:
+                    self.conn[collection].bulk_write(
+                        ops, ordered=ordered, session=self._session)
+                except BulkWriteError as e:
+                    chunk_errors = [dict(err, index=op_indexes[err["index"]])
+                                    for err in e.details.get("writeErrors", [])]
+
+            failed = {err["index"] for err in chunk_errors}
+            if ordered and failed:
+                # ordered bulk_write stops at the first error
+                written = range(min(failed))
+            else:
+                written = (idx for idx in range(len(chunk)) if idx not in failed)
+
+            for idx in written:
+                if idx in new_ids:
+                    chunk[idx]._id = new_ids[idx]
+                saved.append(offset + idx)
+            for err in chunk_errors:
+                errors.append(dict(err, index=offset + err["index"]))
+
+            if ordered and failed:
+                break
+
+        return saved, errors
+
     @intercept_mongo_errors_rw
     def delete_obj(self, obj):
         if obj.is_new:
@@ -404,11 +1092,64 @@ class DB:
         else:
             self.rw_shards = list(self.shards.keys())
 
+        self.placement = create_placement_strategy(ctx.cfg["database"].get("shard_placement", {}))
+        self._shards_executor = None
+
+    @property
+    def shards_executor(self):
+        """
+        Thread pool running scatter-gather queries. Every call occupies a worker
+        per shard, so the shards_pool_size setting should be about the number
+        of shards times the number of concurrent requests querying all of them,
+        otherwise the calls queue behind each other
+        """
+        if self._shards_executor is None:
+            workers = ctx.cfg["database"].get(
+                "shards_pool_size", max(len(self.shards), 1) * SHARDS_POOL_CONCURRENCY)
+            self._shards_executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="shards")
+        return self._shards_executor
+
+    def run_on_shards(self, func, shard_ids=None):
+        """
+        Runs func(shard_id) concurrently for every shard given
+
+        :param func: callable accepting a shard id
+        :param shard_ids: shard ids to run func on, all shards by default
+        :return: dict shard_id -> func result
+        """
+        if shard_ids is None:
+            shard_ids = self.shards.keys()
+        shard_ids = list(shard_ids)
+        if len(shard_ids) < 2:
+            return {shard_id: func(shard_id) for shard_id in shard_ids}
+        futures = [self.shards_executor.submit(func, shard_id)
+                   for shard_id in shard_ids]
+        return {shard_id: future.result() for shard_id, future in zip(shard_ids, futures)}
+
     def get_shard(self, shard_id):
         if shard_id not in self.shards:
             raise InvalidShardId(f"shard {shard_id} doesn't exist")
         return self.shards[shard_id]
 
+    def retry_info(self):
+        return dict(
+            meta=dict(self.meta.retry_stats),
+            shards={shard_id: dict(shard.retry_stats) for shard_id, shard in self.shards.items()}
+        )
+
+    def circuit_info(self):
+        return dict(
+            meta=self.meta.circuit_breaker.info(),
+            shards={shard_id: shard.circuit_breaker.info() for shard_id, shard in self.shards.items()}
+        )
+
+    def latency_info(self):
+        return dict(
+            meta=dict(self.meta.avg_latency),
+            shards={shard_id: dict(shard.avg_latency) for shard_id, shard in self.shards.items()}
+        )
+
     def mongodb_info(self):
 
         def sys_info(raw_info):
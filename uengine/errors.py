@@ -80,6 +80,11 @@ class InvalidShardId(ApiError):
     status_code = 500
 
 
+class DatabaseUnavailable(ApiError):
+    error_key = "db_unavailable"
+    status_code = 503
+
+
 class ShardIsReadOnly(IntegrityError):
     pass
 
@@ -88,6 +93,10 @@ class ModelDestroyed(IntegrityError):
     pass
 
 
+class BulkSaveError(IntegrityError):
+    pass
+
+
 class MissingSubmodel(IntegrityError):
     pass
 
@@ -1,18 +1,56 @@
 import os
 import pickle
+import struct
 import functools
+from datetime import datetime
 from hashlib import sha256
+from tempfile import mkstemp
+from threading import Thread, Event, Lock
+from time import time
 
 from uengine import ctx
 from uengine.utils import now
-from datetime import timedelta
-from .cache import DEFAULT_CACHE_PREFIX, DEFAULT_CACHE_TIMEOUT, _get_cache_key
+from .cache import DEFAULT_CACHE_PREFIX, DEFAULT_CACHE_TIMEOUT, NOT_FOUND, _get_cache_key
+
+# every file starts with the header so expiration can be checked without unpickling
+FILECACHE_MAGIC = b"UEFC"
+FILECACHE_VERSION = 1
+HEADER = struct.Struct("!4sBd")  # magic, version, expiration timestamp (0 for never)
+
+TMP_PREFIX = ".tmp-"
+# temporary files of writers which have died are removed by the sweeper
+TMP_FILE_EXPIRE = 3600
+# last access time is kept in mtime, it's updated not more often than that
+LRU_TOUCH_INTERVAL = 60
+# the sweeper evicts entries until the cache is that much of max_size
+SWEEP_TARGET_RATIO = 0.9
+
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def _is_hex(name, length):
+    return len(name) == length and HEX_DIGITS.issuperset(name)
 
 
 class FileCache:
+    """
+    Cache storing every value in its own file. Files are fanned out into
+    two levels of subdirectories and written atomically via rename. Each
+    file starts with a header holding the expiration time so has() and
+    expires() don't need to read the value.
 
-    def __init__(self, cache_dir=""):
+    If max_size (bytes) is set, sweep() evicts the least recently used
+    entries beyond it along with the expired ones. sweep_interval starts
+    sweeping in a background thread
+    """
+
+    def __init__(self, cache_dir="", max_size=None, sweep_interval=None):
         self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._sweeper_pid = None
+        self._sweeper_lock = Lock()
+        self._stop = Event()
         if not os.path.isdir(cache_dir):
             try:
                 os.makedirs(cache_dir, 0o755)
@@ -24,89 +62,232 @@ class FileCache:
         self.initialized = True
 
     def __getpath(self, key):
-        hashed_key = sha256(key.encode())
-        return os.path.join(self.cache_dir, hashed_key.hexdigest())
+        hashed_key = sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, hashed_key[:2], hashed_key[2:4], hashed_key)
 
     def set(self, key, value, timeout=None):
         if not self.initialized:
             return False
+        if self.sweep_interval:
+            self.ensure_sweeper()
         path = self.__getpath(key)
+        expires_at = time() + timeout if timeout else 0
+        tmp_path = None
         try:
-            with open(path, "wb") as cf:
-                expires = None
-                if timeout is not None:
-                    td = timedelta(seconds=timeout)
-                    expires = now() + td
-                data = {
-                    "value": value,
-                    "expires": expires
-                }
-                pickle.dump(data, cf)
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, 0o755, exist_ok=True)
+            fd, tmp_path = mkstemp(dir=dirname, prefix=TMP_PREFIX)
+            with os.fdopen(fd, "wb") as cf:
+                cf.write(HEADER.pack(FILECACHE_MAGIC, FILECACHE_VERSION, expires_at))
+                pickle.dump(value, cf, pickle.HIGHEST_PROTOCOL)
+            os.chmod(tmp_path, 0o644)
+            # readers see either the old file or the new one, never a partial one
+            os.replace(tmp_path, path)
         except Exception as e:
             ctx.log.error("error writing filecache %s: %s", path, e)
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
             return False
         return True
 
-    def __load(self, key):
+    @staticmethod
+    def __read_header(cf, path):
+        header = cf.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError("truncated header")
+        magic, version, expires_at = HEADER.unpack(header)
+        if magic != FILECACHE_MAGIC or version != FILECACHE_VERSION:
+            raise ValueError(f"unsupported file format in {path}")
+        return expires_at
+
+    def __load(self, key, header_only=False):
+        """
+        :return: tuple (expires_at, value) or None if the key is missing or expired
+        """
         if not self.initialized:
             return None
         path = self.__getpath(key)
-        if not os.path.isfile(path):
-            return None
         try:
             with open(path, "rb") as cf:
-                data = pickle.load(cf)
-                return data
+                expires_at = self.__read_header(cf, path)
+                if expires_at and expires_at < time():
+                    cf.close()
+                    self.delete(key)
+                    return None
+                if header_only:
+                    return expires_at, None
+                value = pickle.load(cf)
+                if os.fstat(cf.fileno()).st_mtime < time() - LRU_TOUCH_INTERVAL:
+                    os.utime(path)
+                return expires_at, value
+        except FileNotFoundError:
+            return None
         except Exception as e:
             ctx.log.error("error loading filecache %s: %s", path, e)
             return None
 
-    def get(self, key):
+    def get(self, key, default=None):
+        """
+        :param default: returned if the key is missing, pass NOT_FOUND to tell
+                        a cached None from a miss with a single read
+        """
         data = self.__load(key)
         if data is None:
-            return None
-        if data["expires"] is not None and now() > data["expires"]:
-            self.delete(key)
-            return None
-        return data["value"]
+            return default
+        return data[1]
 
     def has(self, key):
-        data = self.__load(key)
-        if data is None:
-            return False
-        if data["expires"] is not None and now() > data["expires"]:
-            self.delete(key)
-            return False
-        return True
+        return self.__load(key, header_only=True) is not None
 
     def expires(self, key):
-        data = self.__load(key)
-        if data is None:
+        data = self.__load(key, header_only=True)
+        if data is None or not data[0]:
             return None
-        return data["expires"]
+        return datetime.utcfromtimestamp(data[0])
 
     def delete(self, key):
         if not self.initialized:
             return False
         path = self.__getpath(key)
-        if os.path.isfile(path):
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            ctx.log.error("error deleting filecache %s: %s", path, e)
+        return False
+
+    def __walk(self):
+        """
+        Yields os.DirEntry of every file in the cache. Only the names the cache
+        creates are matched so nothing else is touched if cache_dir is shared
+        """
+        for top in os.scandir(self.cache_dir):
+            if not top.is_dir(follow_symlinks=False):
+                # flat files of the previous versions
+                if _is_hex(top.name, 64) and top.is_file(follow_symlinks=False):
+                    yield top
+                continue
+            if not _is_hex(top.name, 2):
+                continue
+            for sub in os.scandir(top.path):
+                if not _is_hex(sub.name, 2) or not sub.is_dir(follow_symlinks=False):
+                    continue
+                prefix = top.name + sub.name
+                for entry in os.scandir(sub.path):
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if entry.name.startswith(TMP_PREFIX) or \
+                            (_is_hex(entry.name, 64) and entry.name.startswith(prefix)):
+                        yield entry
+
+    def __expired(self, entry, started):
+        if entry.name.startswith(TMP_PREFIX):
+            return entry.stat().st_mtime < started - TMP_FILE_EXPIRE
+        try:
+            with open(entry.path, "rb") as cf:
+                expires_at = self.__read_header(cf, entry.path)
+        except ValueError:
+            # not a cache file of this version
+            return True
+        return bool(expires_at) and expires_at < started
+
+    def sweep(self, max_size=None):
+        """
+        Removes expired entries and evicts the least recently used ones
+        if the cache is larger than max_size
+
+        :param max_size: overrides max_size given to the constructor
+        :return: dict of stats: files, size, expired, evicted
+        """
+        if max_size is None:
+            max_size = self.max_size
+        stats = {"files": 0, "size": 0, "expired": 0, "evicted": 0}
+        if not self.initialized:
+            return stats
+        started = time()
+        entries = []
+        for entry in self.__walk():
             try:
-                os.unlink(path)
-                return True
+                if self.__expired(entry, started):
+                    os.unlink(entry.path)
+                    stats["expired"] += 1
+                    continue
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
             except Exception as e:
-                ctx.log.error("error deleting filecache %s: %s", path, e)
-        return False
+                ctx.log.error("error sweeping filecache %s: %s", entry.path, e)
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            stats["size"] += st.st_size
+
+        if max_size and stats["size"] > max_size:
+            entries.sort()
+            target = max_size * SWEEP_TARGET_RATIO
+            for _, size, path in entries:
+                if stats["size"] <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    ctx.log.error("error evicting filecache %s: %s", path, e)
+                    continue
+                stats["size"] -= size
+                stats["evicted"] += 1
+        stats["files"] = len(entries) - stats["evicted"]
+        ctx.log.debug("FileCache SWEEP %d files, %d bytes, %d expired, %d evicted (%.3f seconds)",
+                      stats["files"], stats["size"], stats["expired"], stats["evicted"], time() - started)
+        return stats
+
+    def clear(self):
+        if not self.initialized:
+            return False
+        for entry in self.__walk():
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _run_sweeper(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                ctx.log.error("error sweeping filecache: %s", e)
+
+    def ensure_sweeper(self):
+        """
+        Starts the sweeper thread unless it's running in the current process.
+        Threads do not survive fork() so this is checked on every write
+        """
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            Thread(target=self._run_sweeper, daemon=True, name="filecache-sweeper").start()
+            self._sweeper_pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
 
 
 def file_cached_function(cache_key_prefix=DEFAULT_CACHE_PREFIX, cache_timeout=DEFAULT_CACHE_TIMEOUT, positive_only=False):
     def cache_decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            cache_key, _ = _get_cache_key(
-                cache_key_prefix, func.__name__, args, kwargs)
+            cache_key = _get_cache_key(cache_key_prefix, func.__name__, args, kwargs)
             t1 = now()
-            if ctx.filecache.has(cache_key):
-                value = ctx.filecache.get(cache_key)
+            value = ctx.filecache.get(cache_key, NOT_FOUND)
+            if value is not NOT_FOUND:
                 ctx.log.debug("FileCache HIT %s (%.3f seconds)",
                               cache_key, (now() - t1).total_seconds())
             else:
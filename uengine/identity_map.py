@@ -0,0 +1,88 @@
+from flask import g, has_app_context
+
+from . import ctx
+from .models.abstract_model import AbstractModel
+
+
+def _identity_map(create=False):
+    if not has_app_context():
+        return None
+    if create:
+        return g.setdefault("request_identity_map", {})
+    return g.get("request_identity_map")
+
+
+def _obj_key(obj):
+    return obj.__class__, getattr(obj, "_shard_id", None), obj._id
+
+
+def identity_map_enabled():
+    """Models are loaded through the request identity map if the identity_map setting is on"""
+    return has_app_context() and bool(ctx.cfg.get("identity_map"))
+
+
+def identity_map_merge(obj):
+    """
+    Returns the instance of the same object (class, shard and _id) loaded
+    earlier during the request, registers obj if there is none
+
+    :param obj: model object or anything else which is returned as is
+    """
+    if not isinstance(obj, AbstractModel) or obj._id is None:
+        return obj
+    identity_map = _identity_map(create=True)
+    if identity_map is None:
+        return obj
+    return identity_map.setdefault(_obj_key(obj), obj)
+
+
+def identity_map_load(obj):
+    """identity_map_merge() for objects loaded from the database, if enabled"""
+    if obj is None or not identity_map_enabled():
+        return obj
+    return identity_map_merge(obj)
+
+
+def identity_map_lookup(cls, shard_id, _id):
+    """
+    :param cls: model class or its from_data method
+    :return: instance loaded earlier during the request or None
+    """
+    if not identity_map_enabled():
+        return None
+    identity_map = _identity_map()
+    if not identity_map:
+        return None
+    cls = getattr(cls, "__self__", cls)
+    return identity_map.get((cls, shard_id, _id))
+
+
+def identity_map_saved(obj):
+    """
+    Registers an object saved, other instances of the same object
+    loaded during the request are reloaded from it
+    """
+    identity_map = _identity_map(create=identity_map_enabled())
+    if identity_map is None or obj._id is None:
+        return
+    key = _obj_key(obj)
+    existing = identity_map.get(key)
+    if existing is None:
+        if identity_map_enabled():
+            identity_map[key] = obj
+    elif existing is not obj:
+        existing._reload_from_obj(obj)
+
+
+def identity_map_discard(cls, shard_id, _id):
+    identity_map = _identity_map()
+    if identity_map:
+        identity_map.pop((cls, shard_id, _id), None)
+
+
+def identity_map_discard_collection(collection):
+    """Drops the objects of a collection changed by a bulk operation"""
+    identity_map = _identity_map()
+    if identity_map:
+        for key in [key for key, obj in identity_map.items() if obj.collection == collection]:
+            del identity_map[key]
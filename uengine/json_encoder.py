@@ -1,19 +1,186 @@
+import json
+import warnings
+
+from dataclasses import asdict, is_dataclass
+from datetime import date
+from decimal import Decimal
+from uuid import UUID
+from flask import current_app, has_app_context
 from flask.json import JSONEncoder
+from werkzeug.http import http_date
 from bson import ObjectId, Timestamp
 from .models.abstract_model import AbstractModel
-from .db import ObjectsCursor
+from .db import ObjectsCursor, ShardsCursor
+from .errors import ConfigurationError
+from . import ctx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_JSON_BACKEND = "auto"
+DATETIME_FORMATS = ("http", "iso")
+DEFAULT_DATETIME_FORMAT = "http"
 
 
 class MongoJSONEncoder(JSONEncoder):
     def default(self, o):  # pylint: disable=method-hidden
+        return json_default(o)
+
+
+def json_default(o):
+    """
+    Converts objects json can't serialize: mongo types, models and cursors
+    along with the ones flask JSONEncoder handles
+    """
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, AbstractModel):
+        return o.to_dict()
+    if isinstance(o, (ObjectsCursor, ShardsCursor, set)):
+        return list(o)
+    if isinstance(o, Timestamp):
+        return o.time
+    if isinstance(o, date):
+        return http_date(o)
+    if isinstance(o, (UUID, Decimal)):
+        return str(o)
+    if is_dataclass(o) and not isinstance(o, type):
+        return asdict(o)
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+class JSONBackend:
+
+    NAME = None
+
+    def __init__(self, datetime_format=DEFAULT_DATETIME_FORMAT, encoder_class=None):
+        """
+        :param datetime_format: "http" to format dates as flask JSONEncoder does
+                                or "iso" for ISO 8601 which is much faster
+        :param encoder_class: JSONEncoder subclass with customised default(),
+                              json_default() is used if None
+        """
+        if datetime_format not in DATETIME_FORMATS:
+            raise ConfigurationError(f"unknown json_datetime_format {datetime_format}")
+        self.iso_dates = datetime_format == "iso"
+        self._default = json_default
+        if encoder_class is not None and encoder_class is not MongoJSONEncoder:
+            with warnings.catch_warnings():
+                # flask deprecates JSONEncoder in favour of json providers
+                warnings.simplefilter("ignore", DeprecationWarning)
+                self._default = encoder_class().default
+
+    def default(self, o):
+        if self.iso_dates and isinstance(o, date):
+            return o.isoformat()
+        return self._default(o)
+
+    def dumps(self, obj, indent=None):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class StdlibJSONBackend(JSONBackend):
+
+    NAME = "json"
+
+    def dumps(self, obj, indent=None):
+        if indent:
+            return json.dumps(obj, default=self.default, sort_keys=True, indent=indent)
+        return json.dumps(obj, default=self.default, sort_keys=True, separators=(",", ":"))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonBackend(JSONBackend):
+
+    NAME = "orjson"
+
+    def __init__(self, datetime_format=DEFAULT_DATETIME_FORMAT, encoder_class=None):
+        super().__init__(datetime_format, encoder_class)
+        self.options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        if not self.iso_dates:
+            # orjson can only produce ISO 8601 itself
+            self.options |= orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self, obj, indent=None):
+        options = self.options
+        if indent:
+            # orjson only supports 2 spaces indentation
+            options |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=options).decode()
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def create_json_backend(name=DEFAULT_JSON_BACKEND, datetime_format=DEFAULT_DATETIME_FORMAT, encoder_class=None):
+    """
+    :param name: "json", "orjson" or "auto" to use orjson if installed
+    :param datetime_format: see JSONBackend
+    :param encoder_class: see JSONBackend
+    """
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    if name == "orjson":
+        if orjson is None:
+            raise ConfigurationError("json_backend is set to orjson which is not installed")
+        return OrjsonBackend(datetime_format, encoder_class)
+    if name == "json":
+        return StdlibJSONBackend(datetime_format, encoder_class)
+    raise ConfigurationError(f"unknown json_backend {name}")
+
+
+JSON_BACKENDS_EXTENSION = "uengine_json_backends"
+# backends used outside of app contexts, i.e. by queue workers
+_backends = {}
+
+
+def _app_encoder_class(app):
+    if app is None:
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        encoder_class = app.json_encoder
+    # flask's own encoder knows nothing of mongo types
+    if isinstance(encoder_class, type) and issubclass(encoder_class, MongoJSONEncoder):
+        return encoder_class
+    return None
+
+
+def json_backend():
+    """
+    JSON backend configured by the json_backend and json_datetime_format
+    settings. Backends are kept per flask app so customisations of its
+    json_encoder (a MongoJSONEncoder subclass) are respected, and are
+    rebuilt if the settings change
+    """
+    settings = (
+        ctx.cfg.get("json_backend", DEFAULT_JSON_BACKEND),
+        ctx.cfg.get("json_datetime_format", DEFAULT_DATETIME_FORMAT),
+    )
+    app = None
+    backends = _backends
+    if has_app_context():
+        app = current_app._get_current_object()  # pylint: disable=protected-access
+        backends = app.extensions.setdefault(JSON_BACKENDS_EXTENSION, {})
+    backend = backends.get(settings)
+    if backend is None:
+        backend = create_json_backend(*settings, _app_encoder_class(app))
+        backends[settings] = backend
+    return backend
+
+
+def json_dumps(obj, indent=None):
+    return json_backend().dumps(obj, indent=indent)
 
-        if isinstance(o, ObjectId):
-            return str(o)
-        if isinstance(o, Timestamp):
-            return o.time
-        if isinstance(o, (ObjectsCursor, set)):
-            return list(o)
-        if isinstance(o, AbstractModel):
-            return o.to_dict()
 
-        return JSONEncoder.default(self, o)
+def json_loads(data):
+    return json_backend().loads(data)
@@ -0,0 +1,212 @@
+import pickle
+
+from collections import OrderedDict
+from datetime import datetime
+from os import getpid
+from socket import gethostname
+from threading import Lock, Thread, Event
+from time import time
+from bson.objectid import ObjectId
+
+from . import ctx
+
+DEFAULT_LOCAL_CACHE_ITEMS = 10000
+DEFAULT_LOCAL_CACHE_SIZE = 64 * 1024 * 1024  # bytes of pickled values
+DEFAULT_LOCAL_CACHE_TTL = 60
+
+DEFAULT_INVALIDATIONS_COLLECTION = "cache_invalidations"
+DEFAULT_INVALIDATIONS_POLL_INTERVAL = 1
+INVALIDATIONS_EXPIRE = 3600
+# ObjectIds generated by different processes are not strictly ordered,
+# every poll looks that far back to catch the late ones
+INVALIDATIONS_POLL_OVERLAP = 5
+
+
+class LocalCache:
+    """
+    Per-process LRU cache with expiration bounded by the number of items
+    and the total size of values. Values are stored pickled so objects
+    returned never share mutable state with each other.
+
+    If a bus is given, invalidate() broadcasts the keys dropped to the
+    other processes which drop them from their local caches as well
+    """
+
+    def __init__(self, max_items=DEFAULT_LOCAL_CACHE_ITEMS, max_size=DEFAULT_LOCAL_CACHE_SIZE,
+                 ttl=DEFAULT_LOCAL_CACHE_TTL, bus=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.ttl = ttl
+        self.bus = bus
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        if self.bus is not None:
+            self.bus.ensure_running(self)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, dump = item
+            if expires_at < time():
+                self._remove(key)
+                return None
+            self._items.move_to_end(key)
+        return pickle.loads(dump)
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        dump = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(dump) > self.max_size:
+            return False
+        if timeout is None:
+            timeout = self.ttl
+        with self._lock:
+            self._remove(key)
+            self._items[key] = (time() + timeout, dump)
+            self.size += len(dump)
+            while len(self._items) > self.max_items or self.size > self.max_size:
+                self._remove(next(iter(self._items)))
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is None:
+            return False
+        self.size -= len(item[1])
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def delete_many(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def invalidate(self, *keys):
+        """Drops the keys locally and in the other processes"""
+        self.delete_many(*keys)
+        if self.bus is not None:
+            self.bus.publish(keys)
+
+
+class MongoInvalidationBus:
+    """
+    Broadcasts cache invalidations through a collection in the meta database.
+    Every process polls the collection in a background thread and drops the
+    keys invalidated by the others from its local cache. Invalidation records
+    expire in an hour via a TTL index.
+    """
+
+    def __init__(self, collection=DEFAULT_INVALIDATIONS_COLLECTION,
+                 poll_interval=DEFAULT_INVALIDATIONS_POLL_INTERVAL):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.hostname = gethostname()
+        self.cache = None
+        self._last_poll = None
+        self._seen = {}
+        self._stop = Event()
+        self._pid = None
+        self._start_lock = Lock()
+
+    @property
+    def origin(self):
+        return f"{self.hostname}:{getpid()}"
+
+    @property
+    def _coll(self):
+        return ctx.db.meta.conn[self.collection]
+
+    def publish(self, keys):
+        keys = [key for key in keys if key]
+        if not keys:
+            return
+        try:
+            self._coll.insert_one({"origin": self.origin, "keys": keys, "created_at": datetime.utcnow()})
+        except Exception as e:
+            # the other processes will expire the keys anyway
+            ctx.log.error("error publishing cache invalidation: %s", e)
+
+    def poll(self):
+        started = time()
+        if self._last_poll is None:
+            self._last_poll = started
+            return
+        since = datetime.utcfromtimestamp(self._last_poll - INVALIDATIONS_POLL_OVERLAP)
+        for doc in self._coll.find({"_id": {"$gte": ObjectId.from_datetime(since)}}):
+            if doc["_id"] in self._seen:
+                continue
+            self._seen[doc["_id"]] = started
+            if doc["origin"] != self.origin and self.cache is not None:
+                self.cache.delete_many(*doc["keys"])
+        self._last_poll = started
+        expired = started - INVALIDATIONS_POLL_OVERLAP * 2
+        self._seen = {_id: seen_at for _id, seen_at in self._seen.items() if seen_at > expired}
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                ctx.log.error("error polling cache invalidations: %s", e)
+
+    def ensure_running(self, cache):
+        """
+        Starts the polling thread unless it's running in the current process.
+        Threads do not survive fork() so this is checked on every cache access
+        """
+        if self._pid == getpid():
+            return
+        with self._start_lock:
+            if self._pid == getpid():
+                return
+            self.cache = cache
+            self._last_poll = None
+            self._seen = {}
+            try:
+                self._coll.create_index("created_at", expireAfterSeconds=INVALIDATIONS_EXPIRE)
+            except Exception as e:
+                ctx.log.error("error creating cache invalidations index: %s", e)
+            self.poll()
+            Thread(target=self._run, daemon=True, name="cache-invalidations").start()
+            self._pid = getpid()
+
+    def stop(self):
+        self._stop.set()
+
+
+def create_local_cache(cfg):
+    """
+    :param cfg: local_cache settings: max_items, max_size, ttl and
+                invalidation (collection, poll_interval). Invalidations
+                are not broadcast if invalidation is set to False
+    """
+    bus = None
+    invalidation_cfg = cfg.get("invalidation", {})
+    if invalidation_cfg is not False:
+        bus = MongoInvalidationBus(**invalidation_cfg)
+    return LocalCache(
+        max_items=cfg.get("max_items", DEFAULT_LOCAL_CACHE_ITEMS),
+        max_size=cfg.get("max_size", DEFAULT_LOCAL_CACHE_SIZE),
+        ttl=cfg.get("ttl", DEFAULT_LOCAL_CACHE_TTL),
+        bus=bus,
+    )
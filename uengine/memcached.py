@@ -0,0 +1,379 @@
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5, blake2b
+from threading import Lock
+from time import time
+from cachelib import BaseCache
+
+from . import ctx
+from .errors import ConfigurationError
+
+try:
+    import pymemcache
+    from pymemcache.serde import pickle_serde
+except ImportError:
+    pymemcache = None
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 1
+DEFAULT_TIMEOUT = 1
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_RETRY_TIMEOUT = 30
+# values written to a replacement node of a dead one expire that soon,
+# otherwise they could be read again after the next failure of the same node
+DEFAULT_FAILOVER_TTL = 60
+# keys written while a node is ejected are deleted from it once it's back so it
+# doesn't serve the values invalidated meanwhile. If more keys are written than
+# that the node is flushed instead
+DEFAULT_MAX_MISSED_KEYS = 10000
+DEFAULT_CACHE_TIMEOUT = 3600
+
+# every node gets POINTS_PER_NODE * weight points on the ring, 4 per md5 digest
+POINTS_PER_NODE = 160
+MAX_KEY_LENGTH = 250
+# memcached treats expiration times longer than 30 days as unix timestamps
+MAX_RELATIVE_EXPIRE = 30 * 86400
+
+
+def _ring_hash(data):
+    return int.from_bytes(md5(data.encode("utf-8")).digest()[:4], "little")
+
+
+def _node_errors():
+    errors = (OSError,)
+    if pymemcache is not None:
+        errors += (pymemcache.MemcacheServerError, pymemcache.MemcacheUnknownError)
+    return errors
+
+
+def create_pymemcache_client(server, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                             timeout=DEFAULT_TIMEOUT):
+    if pymemcache is None:
+        raise ConfigurationError("memcached cache requires pymemcache which is not installed")
+    host, _, port = server.partition(":")
+    return pymemcache.PooledClient(
+        (host, int(port or 11211)),
+        serde=pickle_serde,
+        connect_timeout=connect_timeout,
+        timeout=timeout,
+        max_pool_size=pool_size,
+        default_noreply=False,
+    )
+
+
+class MemcachedNode:
+    """
+    Memcached server along with its connection pool and health. A node failing
+    max_failures times in a row is ejected from the ring for retry_timeout seconds.
+    Keys written elsewhere while it's ejected are kept to be deleted on recovery
+    """
+
+    def __init__(self, server, client, max_failures=DEFAULT_MAX_FAILURES, retry_timeout=DEFAULT_RETRY_TIMEOUT,
+                 max_missed_keys=DEFAULT_MAX_MISSED_KEYS):
+        self.server = server
+        self.client = client
+        self.max_failures = max_failures
+        self.retry_timeout = retry_timeout
+        self.max_missed_keys = max_missed_keys
+        self.failures = 0
+        self.dead_until = None
+        self.missed_keys = set()
+        self.missed_overflow = False
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f"<MemcachedNode {self.server}>"
+
+    @property
+    def ejected(self):
+        return self.dead_until is not None
+
+    def is_alive(self, now):
+        return self.dead_until is None or self.dead_until <= now
+
+    def mark_failed(self, error):
+        with self._lock:
+            self.failures += 1
+            ctx.log.error("memcached %s error (%d in a row): %s", self.server, self.failures, error)
+            if self.failures >= self.max_failures or self.ejected:
+                if not self.ejected:
+                    ctx.log.error("memcached %s is ejected for %d seconds", self.server, self.retry_timeout)
+                self.dead_until = time() + self.retry_timeout
+
+    def record_missed(self, key):
+        """Reports a key written to another node while this one is ejected"""
+        with self._lock:
+            if self.missed_overflow:
+                return
+            self.missed_keys.add(key)
+            if len(self.missed_keys) > self.max_missed_keys:
+                self.missed_overflow = True
+                self.missed_keys = set()
+
+    def mark_ok(self, flush_on_recovery):
+        if not self.failures and not self.ejected:
+            return True
+        with self._lock:
+            if self.ejected:
+                # the node holds values invalidated while it was away
+                try:
+                    if flush_on_recovery or self.missed_overflow:
+                        if self.missed_overflow:
+                            ctx.log.error("memcached %s missed more than %d keys, flushing",
+                                          self.server, self.max_missed_keys)
+                        self.client.flush_all()
+                    elif self.missed_keys:
+                        self.client.delete_many(list(self.missed_keys))
+                except _node_errors() as e:
+                    self.dead_until = time() + self.retry_timeout
+                    ctx.log.error("memcached %s failed to recover: %s", self.server, e)
+                    return False
+                self.missed_keys = set()
+                self.missed_overflow = False
+                ctx.log.info("memcached %s is back", self.server)
+            self.failures = 0
+            self.dead_until = None
+        return True
+
+
+class ConsistentHashMemcachedCache(BaseCache):
+    """
+    Memcached cache distributing keys over the servers with ketama-style
+    consistent hashing so that losing or adding a server only moves the keys
+    of that server. Dead servers are ejected and their keys are served by the
+    next servers on the ring until they are back. Multi-key operations are
+    sent to all the servers involved in parallel, one request per server
+    """
+
+    def __init__(self, servers, default_timeout=DEFAULT_CACHE_TIMEOUT, key_prefix="",
+                 max_failures=DEFAULT_MAX_FAILURES, retry_timeout=DEFAULT_RETRY_TIMEOUT,
+                 failover_ttl=DEFAULT_FAILOVER_TTL, flush_on_recovery=False, max_missed_keys=DEFAULT_MAX_MISSED_KEYS,
+                 client_factory=None, **client_options):
+        """
+        :param servers: list of "host:port" or dict {"host:port": weight}
+        :param flush_on_recovery: flush a node when it's back after an ejection. Ejections
+                                  are tracked per process so a node flushed may have been
+                                  healthy for other processes. Otherwise only the keys
+                                  written while the node was away are deleted from it,
+                                  unless there are more than max_missed_keys of them
+        :param client_factory: callable(server, **client_options) creating a client,
+                               pymemcache PooledClient by default
+        :param client_options: pool_size, connect_timeout and timeout for the default client
+        """
+        super().__init__(default_timeout)
+        if not servers:
+            raise ConfigurationError("no memcached servers configured")
+        if not isinstance(servers, dict):
+            servers = {server: 1 for server in servers}
+        if client_factory is None:
+            client_factory = create_pymemcache_client
+        self.key_prefix = key_prefix
+        self.failover_ttl = failover_ttl
+        self.flush_on_recovery = flush_on_recovery
+        self.nodes = [
+            MemcachedNode(server, client_factory(server, **client_options), max_failures, retry_timeout,
+                          max_missed_keys)
+            for server in servers
+        ]
+        ring = []
+        for idx, (server, weight) in enumerate(servers.items()):
+            for i in range(int(POINTS_PER_NODE * weight) // 4):
+                digest = md5(f"{server}-{i}".encode("utf-8")).digest()
+                for offset in range(0, 16, 4):
+                    ring.append((int.from_bytes(digest[offset:offset + 4], "little"), idx))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._point_nodes = [self.nodes[idx] for _, idx in ring]
+        self._executor = None
+        self._executor_lock = Lock()
+
+    def _normalize_key(self, key):
+        key = f"{self.key_prefix}{key}"
+        if len(key) > MAX_KEY_LENGTH or not key.isascii() or any(c <= " " or c == "\x7f" for c in key):
+            key = "h." + blake2b(key.encode("utf-8"), digest_size=20).hexdigest()
+        return key
+
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        if timeout > MAX_RELATIVE_EXPIRE:
+            timeout = int(time()) + timeout
+        return timeout
+
+    def _locate(self, key, write=False):
+        """
+        :param write: the key is about to be written, dead nodes it belongs
+                      to are told so to drop it on recovery
+        :return: tuple (node, fallback) where fallback is True if the node
+                 replaces the dead one the key belongs to. node is None if
+                 all the nodes are dead
+        """
+        if not self._points:
+            return None, False
+        now = time()
+        start = bisect(self._points, _ring_hash(key)) % len(self._points)
+        primary = self._point_nodes[start]
+        checked = set()
+        for i in range(len(self._points)):
+            node = self._point_nodes[(start + i) % len(self._points)]
+            if node in checked:
+                continue
+            if node.is_alive(now):
+                return node, node is not primary
+            if write:
+                node.record_missed(key)
+            checked.add(node)
+            if len(checked) == len(self.nodes):
+                break
+        return None, False
+
+    def _call(self, node, method, *args, **kwargs):
+        """
+        Runs a client method on the node.
+        :return: tuple (ok, result). ok is False if the node has failed
+        """
+        if node.ejected and not node.mark_ok(self.flush_on_recovery):
+            return False, None
+        try:
+            result = getattr(node.client, method)(*args, **kwargs)
+        except _node_errors() as e:
+            node.mark_failed(e)
+            return False, None
+        node.mark_ok(self.flush_on_recovery)
+        return True, result
+
+    def _group(self, keys, write=False):
+        groups = {}
+        for key in keys:
+            node, fallback = self._locate(key, write)
+            if node is not None:
+                groups.setdefault((node, fallback), []).append(key)
+        return groups
+
+    def _run_groups(self, groups, func):
+        """Runs func(node, fallback, keys) for every group, in parallel if there are several"""
+        if len(groups) < 2:
+            return [func(node, fallback, keys) for (node, fallback), keys in groups.items()]
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=len(self.nodes),
+                                                        thread_name_prefix="memcached")
+        futures = [self._executor.submit(func, node, fallback, keys) for (node, fallback), keys in groups.items()]
+        return [future.result() for future in futures]
+
+    def _expire(self, timeout, fallback):
+        expire = self._normalize_timeout(timeout)
+        if fallback and self.failover_ttl and (not expire or expire > self.failover_ttl):
+            expire = self.failover_ttl
+        return expire
+
+    def get(self, key):
+        key = self._normalize_key(key)
+        node, _ = self._locate(key)
+        if node is None:
+            return None
+        _, value = self._call(node, "get", key)
+        return value
+
+    def get_many(self, *keys):
+        mapping = {self._normalize_key(key): key for key in keys}
+
+        def fetch(node, _, node_keys):
+            ok, found = self._call(node, "get_many", node_keys)
+            return found if ok else {}
+
+        found = {}
+        for result in self._run_groups(self._group(mapping), fetch):
+            found.update(result)
+        return [found.get(self._normalize_key(key)) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        key = self._normalize_key(key)
+        node, fallback = self._locate(key, write=True)
+        if node is None:
+            return False
+        ok, result = self._call(node, "set", key, value, expire=self._expire(timeout, fallback))
+        return ok and bool(result)
+
+    def add(self, key, value, timeout=None):
+        key = self._normalize_key(key)
+        node, fallback = self._locate(key, write=True)
+        if node is None:
+            return False
+        ok, result = self._call(node, "add", key, value, expire=self._expire(timeout, fallback))
+        return ok and bool(result)
+
+    def set_many(self, mapping, timeout=None):
+        normalized = {self._normalize_key(key): key for key in mapping}
+
+        def store(node, fallback, node_keys):
+            values = {key: mapping[normalized[key]] for key in node_keys}
+            ok, failed = self._call(node, "set_many", values, expire=self._expire(timeout, fallback))
+            if not ok:
+                return []
+            failed = set(failed)
+            return [normalized[key] for key in node_keys if key not in failed]
+
+        set_keys = set()
+        for result in self._run_groups(self._group(normalized, write=True), store):
+            set_keys.update(result)
+        return [key for key in mapping if key in set_keys]
+
+    def delete(self, key):
+        key = self._normalize_key(key)
+        node, _ = self._locate(key, write=True)
+        if node is None:
+            return False
+        ok, result = self._call(node, "delete", key)
+        return ok and bool(result)
+
+    def delete_many(self, *keys):
+        normalized = {self._normalize_key(key): key for key in keys}
+
+        def delete(node, _, node_keys):
+            ok, _ = self._call(node, "delete_many", node_keys)
+            return [normalized[key] for key in node_keys] if ok else []
+
+        deleted = set()
+        for result in self._run_groups(self._group(normalized, write=True), delete):
+            deleted.update(result)
+        return [key for key in keys if key in deleted]
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        now = time()
+        results = [self._call(node, "flush_all")[0] for node in self.nodes if node.is_alive(now)]
+        return bool(results) and all(results)
+
+    def inc(self, key, delta=1):
+        key = self._normalize_key(key)
+        node, _ = self._locate(key, write=True)
+        if node is None:
+            return None
+        _, value = self._call(node, "incr", key, delta)
+        return value
+
+    def dec(self, key, delta=1):
+        key = self._normalize_key(key)
+        node, _ = self._locate(key, write=True)
+        if node is None:
+            return None
+        _, value = self._call(node, "decr", key, delta)
+        return value
+
+    def nodes_info(self):
+        now = time()
+        return {node.server: {"alive": node.is_alive(now), "failures": node.failures} for node in self.nodes}
+
+
+def create_memcached_cache(cfg):
+    """
+    :param cfg: memcached settings: servers (list or dict of weights), default_timeout,
+                key_prefix, pool_size, connect_timeout, timeout, max_failures,
+                retry_timeout, failover_ttl, flush_on_recovery and max_missed_keys
+    """
+    cfg = dict(cfg)
+    servers = cfg.pop("servers", None)
+    return ConsistentHashMemcachedCache(servers, **cfg)
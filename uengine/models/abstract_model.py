@@ -2,7 +2,7 @@ from typing import Any
 from copy import deepcopy
 
 from bson.objectid import ObjectId
-from functools import wraps
+from functools import wraps, partial
 from itertools import chain
 from pymongo import ASCENDING, DESCENDING, HASHED
 from pymongo.errors import OperationFailure
@@ -53,6 +53,15 @@ class DoNotSave(Exception):
     pass
 
 
+def loader_compatible(init):
+    """
+    Marks a model __init__ as compatible with the precompiled loader, i.e. all
+    it does for objects loaded from the DB is repeated by _on_load()
+    """
+    init.loader_compatible = True
+    return init
+
+
 def merge_set(attr, new_cls, bases):
     merged = set()
     valid_types = (list, set, frozenset, tuple)
@@ -108,9 +117,67 @@ class ModelMeta(type):
         new_cls.COMPATIBILITY_FIELDS = frozenset(compatibility_fields)
 
         new_cls.collection = mcs._get_collection(new_cls, name, bases, dct)
+        new_cls._DEFAULT_FACTORIES = mcs._compile_defaults(new_cls)
+        new_cls._LOADER = mcs._compile_loader(new_cls)
 
         return new_cls
 
+    @staticmethod
+    def _compile_defaults(model_cls):
+        """
+        :return: dict field -> (default value, factory), factory is None
+                 if the value can be used as is
+        """
+        defaults = {}
+        for field in model_cls.FIELDS:
+            value = model_cls.DEFAULTS.get(field)
+            if callable(value):
+                factory = value
+            elif hasattr(value, "copy"):
+                factory = value.copy
+            elif hasattr(value, "__getitem__") and not isinstance(value, (str, bytes, tuple)):
+                factory = partial(value.__getitem__, slice(None))
+            else:
+                factory = None
+            defaults[field] = (value, factory)
+        return defaults
+
+    @staticmethod
+    def _compile_loader(model_cls):
+        """
+        Builds a function creating objects out of DB documents, bypassing
+        __init__ machinery. Returns None if the model's __init__ is not
+        known to be safe to skip
+        """
+        init = next(vars(klass)["__init__"] for klass in model_cls.__mro__ if "__init__" in vars(klass))
+        if not getattr(init, "loader_compatible", False):
+            return None
+
+        fields = model_cls.FIELDS
+        defaults = tuple((field, value, factory)
+                         for field, (value, factory) in model_cls._DEFAULT_FACTORIES.items())
+        setter = object.__setattr__
+
+        def load(data):
+            obj = object.__new__(model_cls)
+            setter(obj, "_dirty", None)
+            for field, value in data.items():
+                if field in fields:
+                    setter(obj, field, value)
+            for field, value, factory in defaults:
+                if field not in data:
+                    setter(obj, field, value if factory is None else factory())
+            setter(obj, "_dirty", set())
+            setter(obj, "_initial_snapshot", None)
+            if model_cls._HOOKS:
+                obj._init_hooks()
+            else:
+                setter(obj, "_hooks", [])
+            obj._on_load(data)
+            return obj
+
+        return load
+
     @staticmethod
     def _get_collection(model_cls, name, bases, dct):  # pylint: disable=unused-argument
         # Do not inherit collection names from base classes
@@ -146,6 +213,10 @@ class AbstractModel(metaclass=ModelMeta):
     )
 
     USE_INITIAL_STATE = False
+    # save only the fields assigned since the object was loaded or saved
+    # using $set/$unset instead of replacing the whole document. In-place
+    # modifications of mutable values must be reported with mark_dirty()
+    USE_PARTIAL_UPDATES = False
 
     _MERGERS = {
         "FIELDS": merge_set,
@@ -159,11 +230,16 @@ class AbstractModel(metaclass=ModelMeta):
     }
 
     _HOOKS = None
+    _LOADER = None
+    _DEFAULT_FACTORIES = None
 
     __hash__ = None
-    __slots__ = FIELDS + ["_id", "_hooks"]
+    __slots__ = FIELDS + ["_id", "_hooks", "_dirty", "_initial_snapshot"]
 
+    @loader_compatible
     def __init__(self, **kwargs):
+        # changes are not tracked until the object is fully initialised
+        object.__setattr__(self, "_dirty", None)
         if "_id" not in kwargs:
             self._id = None
         for field, value in kwargs.items():
@@ -179,7 +255,10 @@ class AbstractModel(metaclass=ModelMeta):
                 elif hasattr(value, "__getitem__"):
                     value = value[:]
                 setattr(self, field, value)
-        self.__set_initial_state()
+        self._reset_changes()
+        self._init_hooks()
+
+    def _init_hooks(self):
         self._hooks = []
         if self._HOOKS:
             for hook_class in self._HOOKS:
@@ -187,14 +266,79 @@ class AbstractModel(metaclass=ModelMeta):
                 if hook_inst:
                     self._hooks.append(hook_inst)
 
+    def _on_load(self, data):
+        """
+        Called by the precompiled loader for objects created from DB documents.
+        Override along with __init__ (decorated with loader_compatible) to
+        reproduce whatever __init__ does for such objects
+        """
+        if self.USE_INITIAL_STATE:
+            object.__setattr__(self, "_initial_snapshot", self.setup_initial_state())
+
+    def __setattr__(self, name, value):
+        if name in self.FIELDS:
+            self.__track_change(name)
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        if name in self.FIELDS:
+            self.__track_change(name)
+        object.__delattr__(self, name)
+
+    def __track_change(self, name):
+        dirty = getattr(self, "_dirty", None)
+        if dirty is None:
+            return
+        dirty.add(name)
+
+    def mark_dirty(self, *fields):
+        """
+        Reports fields modified in-place (i.e. list.append) which
+        can't be tracked automatically
+        """
+        for field in fields:
+            if field in self.FIELDS:
+                self.__track_change(field)
+
+    @property
+    def dirty_fields(self):
+        if self._dirty is None:
+            return frozenset()
+        return frozenset(self._dirty)
+
+    def _reset_changes(self):
+        object.__setattr__(self, "_dirty", set())
+        # the snapshot is taken eagerly as mutable values may be
+        # modified in-place without any assignment to track
+        snapshot = self.setup_initial_state() if self.USE_INITIAL_STATE else None
+        object.__setattr__(self, "_initial_snapshot", snapshot)
+
     def setup_initial_state(self):
         # this may be highly ineffective and is higlhy recommended
         # to be overriden
         return deepcopy(self.to_dict(self.FIELDS))
 
-    def __set_initial_state(self):
-        if self.USE_INITIAL_STATE:
-            setattr(self, "_initial_state", self.setup_initial_state())
+    @property
+    def _initial_state(self):
+        if not self.USE_INITIAL_STATE:
+            raise AttributeError("_initial_state requires USE_INITIAL_STATE to be set")
+        return self._initial_snapshot
+
+    def _get_partial_update(self):
+        """
+        :return: mongo update document with the fields changed since the object
+                 was loaded or saved. Empty dict if there were no changes
+        """
+        fields = [f for f in self.dirty_fields
+                  if f != "_id" and not f.startswith("_") and f not in self.AUXILIARY_SLOTS]
+        data = self.to_dict(fields, include_restricted=True)
+        update = {}
+        if data:
+            update["$set"] = data
+        unset = {f: "" for f in fields if f not in data and not hasattr(self, f)}
+        if unset:
+            update["$unset"] = unset
+        return update
 
     @classmethod
     def register_model_hook(cls, model_hook_class, *args, **kwargs):
@@ -262,6 +406,7 @@ class AbstractModel(metaclass=ModelMeta):
                 continue
             value = getattr(obj, field)
             setattr(self, field, value)
+        self._reset_changes()
 
     def destroy(self, skip_callback=False, invalidate_cache=True):
         if self.is_new:
@@ -283,14 +428,12 @@ class AbstractModel(metaclass=ModelMeta):
             self.invalidate(_id=old_id)
         return self
 
-    def save(self, skip_callback=False, invalidate_cache=True):
-        is_new = self.is_new
-
+    def _prepare_save(self, skip_callback=False):
         if not skip_callback:
             try:
                 self._before_validation()
             except DoNotSave:
-                return
+                return False
 
         self._validate()
 
@@ -298,8 +441,9 @@ class AbstractModel(metaclass=ModelMeta):
         for field in self.AUTO_TRIM_FIELDS:
             value = getattr(self, field)
             try:
-                value = value.strip()
-                setattr(self, field, value)
+                stripped = value.strip()
+                if stripped != value:
+                    setattr(self, field, stripped)
             except AttributeError:
                 pass
 
@@ -307,9 +451,10 @@ class AbstractModel(metaclass=ModelMeta):
             try:
                 self._before_save()
             except DoNotSave:
-                return
-        self._save_to_db()
+                return False
+        return True
 
+    def _complete_save(self, is_new, skip_callback=False, invalidate_cache=True):
         for hook in self._hooks:
             try:
                 hook.on_model_save(self, is_new)
@@ -317,12 +462,18 @@ class AbstractModel(metaclass=ModelMeta):
                 ctx.log.error("error executing save hook %s on model %s(%s): %s",
                               hook.__class__.__name__, self.__class__.__name__, self._id, e)
 
-        self.__set_initial_state()
+        self._reset_changes()
         if invalidate_cache:
             self.invalidate()
         if not skip_callback:
             self._after_save(is_new)
 
+    def save(self, skip_callback=False, invalidate_cache=True):
+        is_new = self.is_new
+        if not self._prepare_save(skip_callback):
+            return
+        self._save_to_db()
+        self._complete_save(is_new, skip_callback, invalidate_cache)
         return self
 
     def __repr__(self):
@@ -367,9 +518,54 @@ class AbstractModel(metaclass=ModelMeta):
         return result
 
     @classmethod
-    def from_data(cls, **data):
+    def get_default(cls, field):
+        value, factory = cls._DEFAULT_FACTORIES[field]
+        return value if factory is None else factory()
+
+    @classmethod
+    def get_stored_fields(cls, fields=None):
+        """
+        :return: list of fields to_dict(fields) would return for a model stored in DB
+                 or None if some of the fields are not stored, i.e. are properties,
+                 or to_dict() is overridden and may transform the values
+        """
+        if cls.to_dict is not AbstractModel.to_dict:
+            return None
+        if fields is None:
+            fields = cls.FIELDS
+        result = []
+        for field in fields:
+            if field not in cls.FIELDS:
+                if hasattr(cls, field):
+                    return None
+                continue
+            if field.startswith("_") and field != "_id":
+                continue
+            if field in cls.AUXILIARY_SLOTS or field in cls.RESTRICTED_FIELDS:
+                continue
+            result.append(field)
+        return result
+
+    @classmethod
+    def dict_from_document(cls, doc, fields):
+        """
+        Builds the same dict as to_dict() would do for an object loaded from doc
+
+        :param fields: list of fields returned by get_stored_fields()
+        """
+        return {field: doc[field] if field in doc else cls.get_default(field) for field in fields}
+
+    @classmethod
+    def _load_data(cls, data):
+        # documents without _id are new objects and take the regular path
+        if cls._LOADER is not None and "_id" in data:
+            return cls._LOADER(data)
         return cls(**data)
 
+    @classmethod
+    def from_data(cls, **data):
+        return cls._load_data(data)
+
     @property
     def is_complete(self):
         return len(self.missing_fields) == 0
@@ -3,7 +3,10 @@ from functools import partial
 from uengine import ctx
 from uengine.errors import ApiError, NotFound
 from uengine.utils import resolve_id
+from uengine.db import ShardsCursor
+from uengine.identity_map import identity_map_load
 
+from .abstract_model import loader_compatible
 from .storable_model import StorableModel
 
 
@@ -14,6 +17,7 @@ class MissingShardId(ApiError):
 # pylint: disable=arguments-differ
 class ShardedModel(StorableModel):
 
+    @loader_compatible
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._shard_id = None
@@ -25,6 +29,13 @@ class ShardedModel(StorableModel):
             raise MissingShardId(
                 "ShardedModel from database with missing shard_id - this must be a bug")
 
+    def _on_load(self, data):
+        super()._on_load(data)
+        self._shard_id = data.get("shard_id")
+        if self._shard_id is None:
+            raise MissingShardId(
+                "ShardedModel from database with missing shard_id - this must be a bug")
+
     @property
     def _db(self):
         return ctx.db.shards[self._shard_id]
@@ -35,8 +46,16 @@ class ShardedModel(StorableModel):
                 "ShardedModel must have shard_id set before save")
         super().save(skip_callback, invalidate_cache)
 
+    @classmethod
+    def save_many(cls, objs, *args, **kwargs):
+        for obj in objs:
+            if obj._shard_id is None:
+                raise MissingShardId(
+                    "ShardedModel must have shard_id set before save")
+        return super().save_many(objs, *args, **kwargs)
+
     def _refetch_from_db(self):
-        return self.find_one(self._shard_id, {"_id": self._id})
+        return self.find_one(self._shard_id, {"_id": self._id}, identity_map=False)
 
     @classmethod
     def _get_possible_databases(cls):
@@ -80,6 +99,49 @@ class ShardedModel(StorableModel):
             **kwargs
         )
 
+    @classmethod
+    def find_all_shards(cls, query=None, sort=None, skip=0, limit=0, **kwargs):
+        """
+        Queries all the shards concurrently and merges the results into a single
+        cursor. Unlike the per-shard cursors, skip, limit and sort are applied to
+        the merged result
+        """
+        if not query:
+            query = {}
+        query = cls._preprocess_query(query)
+        cursors = {
+            shard_id: shard.get_objs(cls.from_data, cls.collection, query, **kwargs)
+            for shard_id, shard in ctx.db.shards.items()
+        }
+        cursor = ShardsCursor(cursors).skip(skip).limit(limit)
+        if sort:
+            cursor.sort(sort)
+        return cursor
+
+    @classmethod
+    def find_one_any_shard(cls, query, **kwargs):
+        query = cls._preprocess_query(query)
+        results = ctx.db.run_on_shards(
+            lambda shard_id: ctx.db.shards[shard_id].get_obj(
+                cls.from_data, cls.collection, query, **kwargs)
+        )
+        for obj in results.values():
+            if obj is not None:
+                # loaded by an executor thread which has no app context
+                return identity_map_load(obj)
+        return None
+
+    @classmethod
+    def count_all_shards(cls, query=None, **kwargs):
+        if not query:
+            query = {}
+        query = cls._preprocess_query(query)
+        results = ctx.db.run_on_shards(
+            lambda shard_id: ctx.db.shards[shard_id].count_docs(
+                cls.collection, query, **kwargs)
+        )
+        return sum(results.values())
+
     @classmethod
     def get(cls, shard_id, expression, raise_if_none=None):
         if expression is None:
@@ -109,15 +171,23 @@ class ShardedModel(StorableModel):
         obj.shard_id = shard_id
         return obj
 
-    def invalidate(self, _id=None):
+    @classmethod
+    def cache_get_many(cls, shard_id, expressions):
+        cache_keys = {x: f"{cls.collection}.{shard_id}.{x}" for x in expressions if x is not None}
+        if not cache_keys:
+            return []
+        finder = partial(cls.find, shard_id)
+        constructor = partial(cls.from_data, shard_id=shard_id)
+        return cls._cache_get_many(cache_keys, finder, constructor)
+
+    def _cache_keys(self, _id=None):
         if _id is None:
             _id = self._id
         cache_key_id = f"{self.collection}.{self._shard_id}.{_id}"
         cache_key_keyfield = None
         if self.KEY_FIELD is not None and self.KEY_FIELD != "_id":
             cache_key_keyfield = f"{self.collection}.{self._shard_id}.{getattr(self, self.KEY_FIELD)}"
-
-        return self._invalidate(cache_key_id, cache_key_keyfield)
+        return cache_key_id, cache_key_keyfield
 
     @classmethod
     def destroy_all(cls, shard_id):
@@ -126,6 +196,7 @@ class ShardedModel(StorableModel):
         # objects
         ctx.db.get_shard(shard_id).delete_query(
             cls.collection, cls._preprocess_query({}))
+        cls._invalidate_collection()
 
     @classmethod
     def destroy_many(cls, shard_id, query):
@@ -134,6 +205,7 @@ class ShardedModel(StorableModel):
         # objects
         ctx.db.get_shard(shard_id).delete_query(
             cls.collection, cls._preprocess_query(query))
+        cls._invalidate_collection()
 
     @classmethod
     def update_many(cls, shard_id, query, attrs):
@@ -142,3 +214,4 @@ class ShardedModel(StorableModel):
         # objects
         ctx.db.get_shard(shard_id).update_query(
             cls.collection, cls._preprocess_query(query), attrs)
+        cls._invalidate_collection()
@@ -1,8 +1,12 @@
 from functools import partial
 from uengine import ctx
 from uengine.utils import resolve_id
-from uengine.errors import NotFound, ModelDestroyed, IntegrityError
-from uengine.cache import req_cache_get, req_cache_set, req_cache_has_key, req_cache_delete
+from uengine.db import DEFAULT_BULK_CHUNK_SIZE, invalidate_counts
+from uengine.errors import NotFound, ModelDestroyed, IntegrityError, BulkSaveError
+from uengine.identity_map import identity_map_load, identity_map_saved, identity_map_discard, \
+    identity_map_discard_collection
+from uengine.cache import req_cache_get, req_cache_set, req_cache_delete, flight_lock, \
+    invalidate_tags, collection_tag, object_tag
 from datetime import datetime
 from bson.objectid import ObjectId
 
@@ -11,9 +15,6 @@ from .abstract_model import AbstractModel, save_required
 
 class StorableModel(AbstractModel):
 
-    def __init__(self, **kwargs):
-        AbstractModel.__init__(self, **kwargs)
-
     @property
     def _db(self):
         if not self.collection:
@@ -24,6 +25,56 @@ class StorableModel(AbstractModel):
     def _save_to_db(self):
         self._db.save_obj(self)
 
+    @classmethod
+    def save_many(cls, objs, ordered=False, chunk_size=DEFAULT_BULK_CHUNK_SIZE,
+                  skip_callback=False, invalidate_cache=True):
+        """
+        Saves a number of objects using bulk writes. Lifecycle callbacks and hooks
+        are run for every object as in save(), but the objects are written in
+        batches of chunk_size per collection and the cache is invalidated at once.
+
+        :param objs: list of objects to save
+        :param ordered: stop at the first write error as ordered bulk_write does
+        :return: list of objects saved
+        :raises BulkSaveError: if some objects could not be written. Objects written
+                               successfully are saved anyway
+        """
+        groups = {}
+        for idx, obj in enumerate(objs):
+            is_new = obj.is_new
+            if not obj._prepare_save(skip_callback):
+                continue
+            groups.setdefault((obj._db, obj.collection), []).append((idx, obj, is_new))
+
+        saved = []
+        errors = []
+        for (db, collection), group in groups.items():
+            group_saved, group_errors = db.save_objs(
+                collection, [obj for _, obj, _ in group], ordered, chunk_size)
+            saved.extend(group[i] for i in group_saved)
+            errors.extend(dict(index=group[err["index"]][0], code=err.get("code"),
+                               error=err.get("errmsg")) for err in group_errors)
+            if ordered and group_errors:
+                break
+
+        if invalidate_cache:
+            cache_keys = []
+            for _, obj, _ in saved:
+                cache_keys.extend(key for key in obj._cache_keys() if key)
+            cls._invalidate_many(cache_keys)
+            for collection in {obj.collection for _, obj, _ in saved}:
+                invalidate_counts(collection)
+            invalidate_tags(*{collection_tag(obj.collection) for _, obj, _ in saved},
+                            *(obj for _, obj, _ in saved))
+
+        for _, obj, is_new in saved:
+            obj._complete_save(is_new, skip_callback, invalidate_cache=False)
+
+        if errors:
+            raise BulkSaveError(f"{len(errors)} objects failed to save", payload={"errors": errors})
+
+        return [obj for _, obj, _ in saved]
+
     def update(self, data, skip_callback=False, invalidate_cache=True):
         for field in self.FIELDS:
             if field in data and field not in self.REJECTED_FIELDS and field != "_id":
@@ -47,14 +98,30 @@ class StorableModel(AbstractModel):
         if reload and new_data:
             tmp = self.from_data(**new_data)
             self._reload_from_obj(tmp)
+            identity_map_saved(self)
+        elif new_data:
+            # loaded again on the next access
+            identity_map_discard(self.__class__, getattr(self, "_shard_id", None), self._id)
 
         return bool(new_data)
 
+    def _complete_save(self, is_new, skip_callback=False, invalidate_cache=True):
+        super()._complete_save(is_new, skip_callback, invalidate_cache)
+        identity_map_saved(self)
+
+    def destroy(self, skip_callback=False, invalidate_cache=True):
+        _id = self._id
+        result = super().destroy(skip_callback, invalidate_cache)
+        if result is not None:
+            identity_map_discard(self.__class__, getattr(self, "_shard_id", None), _id)
+        return result
+
     def _delete_from_db(self):
         self._db.delete_obj(self)
 
     def _refetch_from_db(self):
-        return self.find_one({"_id": self._id})
+        # the identity map would return the object itself
+        return self.find_one({"_id": self._id}, identity_map=False)
 
     def reload(self):
         if self.is_new:
@@ -62,11 +129,7 @@ class StorableModel(AbstractModel):
         tmp = self._refetch_from_db()
         if tmp is None:
             raise ModelDestroyed("model has been deleted from db")
-        for field in self.FIELDS:
-            if field == "_id":
-                continue
-            value = getattr(tmp, field)
-            setattr(self, field, value)
+        self._reload_from_obj(tmp)
 
     @classmethod
     # E.g. override if you want model to always return a subset of documents in its collection
@@ -122,29 +185,44 @@ class StorableModel(AbstractModel):
         if not constructor:
             constructor = cls.from_data
 
-        if req_cache_has_key(cache_key):
-            data = req_cache_get(cache_key)
+        data = req_cache_get(cache_key)
+        if data is not None:
             td = (datetime.now() - d1).total_seconds()
             ctx.log.debug("ModelCache L1 HIT %s %.3f seconds", cache_key, td)
-            return constructor(**data)
-
-        if ctx.cache.has(cache_key):
-            data = ctx.cache.get(cache_key)
-            req_cache_set(cache_key, data)
-            td = (datetime.now() - d1).total_seconds()
-            ctx.log.debug("ModelCache L2 HIT %s %.3f seconds", cache_key, td)
-            return constructor(**data)
-
-        obj = getter()
-        if obj:
-
-            data = obj.to_dict()
-            ctx.cache.set(cache_key, data)
-            req_cache_set(cache_key, data)
-
+            return identity_map_load(constructor(**data))
+
+        local_cache = ctx.local_cache
+        if local_cache is not None:
+            data = local_cache.get(cache_key)
+            if data is not None:
+                req_cache_set(cache_key, data)
+                td = (datetime.now() - d1).total_seconds()
+                ctx.log.debug("ModelCache LOCAL HIT %s %.3f seconds", cache_key, td)
+                return identity_map_load(constructor(**data))
+
+        data = ctx.cache.get(cache_key)
+        if data is None:
+            # the first thread to miss loads the object, the others wait for it
+            with flight_lock(cache_key):
+                data = ctx.cache.get(cache_key)
+                if data is None:
+                    obj = getter()
+                    if obj:
+                        data = obj.to_dict()
+                        ctx.cache.set(cache_key, data)
+                        req_cache_set(cache_key, data)
+                        if local_cache is not None:
+                            local_cache.set(cache_key, data)
+                    td = (datetime.now() - d1).total_seconds()
+                    ctx.log.debug("ModelCache MISS %s %.3f seconds", cache_key, td)
+                    return obj
+
+        req_cache_set(cache_key, data)
+        if local_cache is not None:
+            local_cache.set(cache_key, data)
         td = (datetime.now() - d1).total_seconds()
-        ctx.log.debug("ModelCache MISS %s %.3f seconds", cache_key, td)
-        return obj
+        ctx.log.debug("ModelCache L2 HIT %s %.3f seconds", cache_key, td)
+        return identity_map_load(constructor(**data))
 
     @classmethod
     def cache_get(cls, expression, raise_if_none=None):
@@ -154,6 +232,114 @@ class StorableModel(AbstractModel):
         getter = partial(cls.get, expression, raise_if_none)
         return cls._cache_get(cache_key, getter)
 
+    @classmethod
+    def _cache_get_many(cls, cache_keys, finder, constructor=None):
+        """
+        :param cache_keys: dict expression -> cache key
+        :param finder: callable accepting a query and returning a cursor
+        :param constructor: callable to create objects from cached data
+        :return: list of objects found in the order of expressions given
+        """
+        d1 = datetime.now()
+        if not constructor:
+            constructor = cls.from_data
+
+        found = {}
+        l2_expressions = []
+        for expression, cache_key in cache_keys.items():
+            data = req_cache_get(cache_key)
+            if data is not None:
+                found[expression] = data
+            else:
+                l2_expressions.append(expression)
+        l1_hits = len(found)
+
+        local_cache = ctx.local_cache
+        if local_cache is not None and l2_expressions:
+            local_expressions = l2_expressions
+            l2_expressions = []
+            for expression in local_expressions:
+                data = local_cache.get(cache_keys[expression])
+                if data is None:
+                    l2_expressions.append(expression)
+                else:
+                    found[expression] = data
+                    req_cache_set(cache_keys[expression], data)
+        local_hits = len(found) - l1_hits
+
+        l2_hits = 0
+        if l2_expressions:
+            l2_keys = [cache_keys[x] for x in l2_expressions]
+            for expression, data in zip(l2_expressions, ctx.cache.get_many(*l2_keys)):
+                if data is not None:
+                    found[expression] = data
+                    req_cache_set(cache_keys[expression], data)
+                    if local_cache is not None:
+                        local_cache.set(cache_keys[expression], data)
+                    l2_hits += 1
+
+        ids = {}
+        keys = {}
+        for expression in cache_keys:
+            if expression in found:
+                continue
+            resolved = resolve_id(expression)
+            if isinstance(resolved, ObjectId):
+                ids[resolved] = expression
+            elif cls.KEY_FIELD is not None:
+                keys[str(resolved)] = expression
+
+        if ids or keys:
+            conditions = []
+            if ids:
+                conditions.append({"_id": {"$in": list(ids)}})
+            if keys:
+                conditions.append({cls.KEY_FIELD: {"$in": list(keys)}})
+            query = conditions[0] if len(conditions) == 1 else {"$or": conditions}
+
+            to_cache = {}
+            for obj in finder(query):
+                data = obj.to_dict()
+                expressions = []
+                if obj._id in ids:
+                    expressions.append(ids[obj._id])
+                if keys:
+                    key = getattr(obj, cls.KEY_FIELD, None)
+                    if key is not None and str(key) in keys:
+                        expressions.append(keys[str(key)])
+                for expression in expressions:
+                    found[expression] = data
+                    to_cache[cache_keys[expression]] = data
+
+            if to_cache:
+                ctx.cache.set_many(to_cache)
+                for cache_key, data in to_cache.items():
+                    req_cache_set(cache_key, data)
+                if local_cache is not None:
+                    local_cache.set_many(to_cache)
+
+        td = (datetime.now() - d1).total_seconds()
+        hits = l1_hits + local_hits + l2_hits
+        ctx.log.debug("ModelCache MANY %d keys, %d L1 HITS, %d LOCAL HITS, %d L2 HITS, %d MISSES %.3f seconds",
+                      len(cache_keys), l1_hits, local_hits, l2_hits, len(cache_keys) - hits, td)
+
+        return [identity_map_load(constructor(**found[expression])) for expression in cache_keys if expression in found]
+
+    @classmethod
+    def cache_get_many(cls, expressions):
+        """
+        Batched version of cache_get(). Looks up the request-local cache first,
+        then fetches all the remaining keys from ctx.cache in one go and loads
+        the rest from the DB with a single query
+
+        :param expressions: iterable of ids and/or KEY_FIELD values
+        :return: list of objects found, missing ones are omitted
+        """
+        cache_keys = {x: f"{cls.collection}.{x}" for x in expressions if x is not None}
+        if not cache_keys:
+            return []
+        return cls._cache_get_many(cache_keys, cls.find)
+
     @staticmethod
     def _invalidate(cache_key_id, cache_key_keyfield=None):
         ctx.log.debug("ModelCache DELETE %s", cache_key_id)
@@ -165,21 +351,50 @@ class StorableModel(AbstractModel):
             ctx.log.debug("ModelCache DELETE %s", cache_key_keyfield)
             cr_layer1_keyfield = req_cache_delete(cache_key_keyfield)
             cr_layer2_keyfield = ctx.cache.delete(cache_key_keyfield)
+        # local caches are dropped last, otherwise they could be refilled
+        # with the value still in ctx.cache
+        if ctx.local_cache is not None:
+            ctx.local_cache.invalidate(cache_key_id, cache_key_keyfield)
 
         return cr_layer1_id, cr_layer1_keyfield, cr_layer2_id, cr_layer2_keyfield
 
-    def invalidate(self, _id=None):
+    @staticmethod
+    def _invalidate_many(cache_keys):
+        if not cache_keys:
+            return
+        ctx.log.debug("ModelCache DELETE MANY %d keys", len(cache_keys))
+        for cache_key in cache_keys:
+            req_cache_delete(cache_key)
+        ctx.cache.delete_many(*cache_keys)
+        if ctx.local_cache is not None:
+            ctx.local_cache.invalidate(*cache_keys)
+
+    def _cache_keys(self, _id=None):
         if _id is None:
             _id = self._id
         cache_key_id = f"{self.collection}.{_id}"
         cache_key_keyfield = None
         if self.KEY_FIELD is not None and self.KEY_FIELD != "_id":
             cache_key_keyfield = f"{self.collection}.{getattr(self, self.KEY_FIELD)}"
-        return self._invalidate(cache_key_id, cache_key_keyfield)
+        return cache_key_id, cache_key_keyfield
+
+    def invalidate(self, _id=None):
+        invalidate_counts(self.collection)
+        invalidate_tags(collection_tag(self.collection),
+                        object_tag(self.collection, self._id if _id is None else _id))
+        return self._invalidate(*self._cache_keys(_id))
+
+    @classmethod
+    def _invalidate_collection(cls):
+        """Drops cached counts, everything tagged with the collection and its identity map objects"""
+        invalidate_counts(cls.collection)
+        invalidate_tags(cls)
+        identity_map_discard_collection(cls.collection)
 
     @classmethod
     def destroy_all(cls):
         ctx.db.meta.delete_query(cls.collection, cls._preprocess_query({}))
+        cls._invalidate_collection()
 
     @classmethod
     def destroy_many(cls, query):
@@ -187,6 +402,7 @@ class StorableModel(AbstractModel):
         # this method doesn't provide any lifecycle callback for independent
         # objects
         ctx.db.meta.delete_query(cls.collection, cls._preprocess_query(query))
+        cls._invalidate_collection()
 
     @classmethod
     def update_many(cls, query, attrs):
@@ -195,3 +411,4 @@ class StorableModel(AbstractModel):
         # objects
         ctx.db.meta.update_query(
             cls.collection, cls._preprocess_query(query), attrs)
+        cls._invalidate_collection()
@@ -51,7 +51,7 @@ on your submodels to keep the expected find/destroy/update behaviour
 >>> Animal.register_submodel(AquaticMammal.SUBMODEL, AquaticMammal)
 """
 
-from .abstract_model import ModelMeta
+from .abstract_model import ModelMeta, loader_compatible
 from .storable_model import StorableModel
 from .sharded_model import ShardedModel
 from uengine.errors import MissingSubmodel, UnknownSubmodel, WrongSubmodel, InputDataError, IntegrityError
@@ -85,6 +85,7 @@ class BaseSubmodelMixin:
     ]
     __submodel_loaders = None
 
+    @loader_compatible
     def __init__(self, **data):
         super().__init__(**data)
         if self.is_new:
@@ -101,6 +102,13 @@ class BaseSubmodelMixin:
                     f"{self.__class__.__name__} has no submodel in the DB. Bug?")
             self._check_submodel()
 
+    def _on_load(self, data):
+        super()._on_load(data)
+        if not self.submodel:
+            raise MissingSubmodel(
+                f"{self.__class__.__name__} has no submodel in the DB. Bug?")
+        self._check_submodel()
+
     def _check_submodel(self):
         if self.submodel != self.SUBMODEL:
             raise WrongSubmodel(
@@ -129,12 +137,22 @@ class BaseSubmodelMixin:
             raise MissingSubmodel(
                 f"{cls.__name__} has no submodel in the DB. Bug?")
         if not cls.__submodel_loaders:
-            return cls(**data)
+            return cls._load_data(data)
         submodel_name = data["submodel"]
         if submodel_name not in cls.__submodel_loaders:
             raise UnknownSubmodel(
                 f"Submodel {submodel_name} is not registered with {cls.__name__}")
-        return cls.__submodel_loaders[submodel_name](**data)
+        constructor = cls.__submodel_loaders[submodel_name]
+        if isinstance(constructor, ModelMeta):
+            return constructor._load_data(data)
+        return constructor(**data)
+
+    @classmethod
+    def get_stored_fields(cls, fields=None):
+        if not cls.SUBMODEL and cls.__submodel_loaders:
+            # objects of different submodels may have different fields
+            return None
+        return super().get_stored_fields(fields)
 
     @classmethod
     def _preprocess_query(cls, query):
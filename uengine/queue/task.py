@@ -1,6 +1,6 @@
 from uengine import ctx
 from uengine.utils import uuid4_string, now
-from flask import json
+from uengine.json_encoder import json_dumps, json_loads
 
 
 class BaseTask:
@@ -18,7 +18,7 @@ class BaseTask:
         return {
             "id": self.id,
             "type": self.TYPE,
-            "data": json.dumps(self.data),
+            "data": json_dumps(self.data),
             "created_at": self.created_at
         }
 
@@ -36,7 +36,7 @@ class BaseTask:
         task_id = msg["id"]
         task_type = msg["type"]
         created_at = msg["created_at"]
-        data = json.loads(msg["data"])
+        data = json_loads(msg["data"])
         if task_type in cls.TYPE_MAP:
             task_class = cls.TYPE_MAP[task_type]
         else:
@@ -51,7 +51,7 @@ class BaseTask:
         return ctx.queue.enqueue(self)
 
     def __str__(self):
-        return f"<{self.__class__.__name__} {self.TYPE} id={self.id} data={json.dumps(self.data)} " + \
+        return f"<{self.__class__.__name__} {self.TYPE} id={self.id} data={json_dumps(self.data)} " + \
                f"created_at={self.created_at} received_by={self.received_by}>"
 
     def __repr__(self):
@@ -0,0 +1,95 @@
+from cachelib import RedisCache
+
+from .errors import ConfigurationError
+
+DEFAULT_REDIS_HOST = "127.0.0.1"
+DEFAULT_REDIS_PORT = 6379
+DEFAULT_CACHE_TIMEOUT = 3600
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_SOCKET_TIMEOUT = 1
+DEFAULT_SCAN_COUNT = 1000
+
+# deletes the key only if it still holds the value given,
+# i.e. a lock is released by its owner only
+DELETE_IF_EQUAL_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class UengineRedisCache(RedisCache):
+    """
+    cachelib RedisCache with atomic add() suitable for locks, single
+    round trip delete_many(), compare-and-delete and clear() which
+    doesn't block the server with KEYS
+    """
+
+    def add(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        return bool(self._write_client.set(
+            name=f"{self._get_prefix()}{key}",
+            value=self.serializer.dumps(value),
+            ex=timeout if timeout != -1 else None,
+            nx=True,
+        ))
+
+    def delete_many(self, *keys):
+        if not keys:
+            return []
+        prefix = self._get_prefix()
+        self._write_client.delete(*[f"{prefix}{key}" for key in keys])
+        return list(keys)
+
+    def delete_if_equal(self, key, value):
+        """Atomically deletes the key if its value is equal to the one given"""
+        return bool(self._write_client.eval(
+            DELETE_IF_EQUAL_SCRIPT, 1, f"{self._get_prefix()}{key}", self.serializer.dumps(value)))
+
+    def clear(self):
+        prefix = self._get_prefix()
+        if not prefix:
+            return bool(self._write_client.flushdb())
+        keys = []
+        for key in self._read_client.scan_iter(match=f"{prefix}*", count=DEFAULT_SCAN_COUNT):
+            keys.append(key)
+            if len(keys) >= DEFAULT_SCAN_COUNT:
+                self._write_client.delete(*keys)
+                keys = []
+        if keys:
+            self._write_client.delete(*keys)
+        return True
+
+
+def create_redis_cache(cfg):
+    """
+    :param cfg: redis_cache settings: url or host, port, dbname and password;
+                key_prefix, default_timeout, max_connections (per process pool),
+                socket_timeout and socket_connect_timeout
+    """
+    try:
+        import redis
+    except ImportError:
+        raise ConfigurationError("redis_cache is configured but redis drivers are not installed")
+
+    pool_options = dict(
+        max_connections=cfg.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+        socket_timeout=cfg.get("socket_timeout", DEFAULT_SOCKET_TIMEOUT),
+        socket_connect_timeout=cfg.get("socket_connect_timeout", DEFAULT_SOCKET_TIMEOUT),
+    )
+    if "url" in cfg:
+        pool = redis.ConnectionPool.from_url(cfg["url"], **pool_options)
+    else:
+        pool = redis.ConnectionPool(
+            host=cfg.get("host", DEFAULT_REDIS_HOST),
+            port=cfg.get("port", DEFAULT_REDIS_PORT),
+            db=cfg.get("dbname", 0),
+            password=cfg.get("password"),
+            **pool_options
+        )
+    return UengineRedisCache(
+        redis.Redis(connection_pool=pool),
+        default_timeout=cfg.get("default_timeout", DEFAULT_CACHE_TIMEOUT),
+        key_prefix=cfg.get("key_prefix"),
+    )
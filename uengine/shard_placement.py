@@ -0,0 +1,137 @@
+from random import choices
+from threading import Thread, Lock
+from time import time
+
+from . import ctx
+from .errors import ConfigurationError
+
+DEFAULT_STATS_REFRESH_INTERVAL = 300
+
+
+class PlacementStrategy:
+    """
+    Chooses a shard to create a new sharded object in. Subclasses
+    override weights() to make some shards more likely to be picked
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def weights(self, shard_ids):
+        return {shard_id: 1 for shard_id in shard_ids}
+
+    def pick(self, shard_ids):
+        weights = self.weights(shard_ids)
+        values = [weights.get(shard_id, 0) for shard_id in shard_ids]
+        if not any(values):
+            values = None  # nothing to rely on, fall back to uniform choice
+        return choices(shard_ids, weights=values)[0]
+
+
+class CapacityPlacement(PlacementStrategy):
+    """Weights are configured explicitly, shards missing in config get 1"""
+
+    def weights(self, shard_ids):
+        configured = self.cfg.get("weights", {})
+        return {shard_id: configured.get(shard_id, 1) for shard_id in shard_ids}
+
+
+class StatsPlacement(PlacementStrategy):
+    """
+    Base class for strategies based on stats sampled from shards.
+    The stats are cached and refreshed in a background thread every
+    refresh_interval seconds so picking a shard never waits for the DB
+    """
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.refresh_interval = cfg.get("refresh_interval", DEFAULT_STATS_REFRESH_INTERVAL)
+        self.stats = {}
+        self.updated_at = None
+        self._refreshing = False
+        self._lock = Lock()
+
+    def collect_stats(self, shard_id):
+        raise NotImplementedError()
+
+    def refresh(self):
+        stats = {}
+        for shard_id in ctx.db.shards:
+            try:
+                stats[shard_id] = self.collect_stats(shard_id)
+            except Exception as e:
+                ctx.log.error("error collecting stats of shard %s: %s", shard_id, e)
+        self.stats = stats
+        self.updated_at = time()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+
+    def ensure_fresh(self):
+        if self.updated_at is not None and time() - self.updated_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        Thread(target=self._background_refresh, daemon=True).start()
+
+    def weights(self, shard_ids):
+        self.ensure_fresh()
+        if not all(shard_id in self.stats for shard_id in shard_ids):
+            # no stats yet or some shards failed to report
+            return super().weights(shard_ids)
+        return self.stats_weights(shard_ids)
+
+    def stats_weights(self, shard_ids):
+        raise NotImplementedError()
+
+
+class DataSizePlacement(StatsPlacement):
+    """
+    Prefers shards with less data according to dbStats. If "capacity"
+    (bytes per shard) is configured, weights are proportional to free space
+    """
+
+    def collect_stats(self, shard_id):
+        return ctx.db.shards[shard_id].conn.command("dbStats")["dataSize"]
+
+    def stats_weights(self, shard_ids):
+        capacity = self.cfg.get("capacity")
+        if capacity:
+            return {shard_id: max(capacity.get(shard_id, 0) - self.stats[shard_id], 0)
+                    for shard_id in shard_ids}
+        return {shard_id: 1 / max(self.stats[shard_id], 1) for shard_id in shard_ids}
+
+
+class LatencyPlacement(PlacementStrategy):
+    """Prefers shards with lower average write latency observed by this process"""
+
+    def weights(self, shard_ids):
+        latencies = {shard_id: ctx.db.shards[shard_id].avg_latency["rw"] for shard_id in shard_ids}
+        known = [x for x in latencies.values() if x]
+        if not known:
+            return super().weights(shard_ids)
+        # shards with no writes yet are treated as the fastest ones
+        fastest = min(known)
+        return {shard_id: 1 / (latency or fastest) for shard_id, latency in latencies.items()}
+
+
+STRATEGIES = {
+    "random": PlacementStrategy,
+    "capacity": CapacityPlacement,
+    "data_size": DataSizePlacement,
+    "latency": LatencyPlacement,
+}
+
+
+def create_placement_strategy(cfg):
+    strategy = cfg.get("strategy", "random")
+    if isinstance(strategy, str):
+        if strategy not in STRATEGIES:
+            raise ConfigurationError(f"unknown shard placement strategy {strategy}")
+        strategy = STRATEGIES[strategy]
+    return strategy(cfg)
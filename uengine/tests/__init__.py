@@ -3,3 +3,12 @@ from .test_sharded_model import TestShardedModel
 from .test_storable_model import TestStorableModel
 from .test_submodel import TestShardedSubmodel, TestStorableSubmodel
 from .test_afterlife import TestAfterlife
+from .test_db import TestRetries, TestCircuitBreaker, TestShardPlacement
+from .test_json import TestJSONBackend
+from .test_local_cache import TestLocalCache, TestInvalidationBus
+from .test_cache import TestSingleFlight, TestSingleFetch, TestCacheKey, TestCacheTags, TestRequestTimeCache
+from .test_cache_codec import TestCacheCodec, TestCodecCache
+from .test_memcached import TestConsistentHashMemcachedCache
+from .test_redis_cache import TestRedisCache
+from .test_file_cache import TestFileCache
+from .test_identity_map import TestIdentityMap
@@ -2,6 +2,7 @@
 
 from uengine.models.abstract_model import AbstractModel, FieldRequired, InvalidFieldType
 from unittest import TestCase
+from bson.objectid import ObjectId
 
 CALLABLE_DEFAULT_VALUE = 4
 
@@ -119,3 +120,56 @@ class TestAbstractModel(TestCase):
         t = TestModel(field1="   a   \t", field2="b", field3="c")
         t.save()
         self.assertEqual(t.field1, "a")
+
+    def test_dirty_fields(self):
+        t = TestModel(field1="a", field2="b")
+        self.assertSetEqual(set(), t.dirty_fields)
+        t.field2 = "c"
+        self.assertSetEqual({"field2"}, t.dirty_fields)
+        t.mark_dirty("field3", "unknown")
+        self.assertSetEqual({"field2", "field3"}, t.dirty_fields)
+        t.save()
+        self.assertSetEqual(set(), t.dirty_fields)
+
+    def test_initial_state(self):
+        class InitialStateModel(TestModel):
+            USE_INITIAL_STATE = True
+
+        t = InitialStateModel(field1="a", field2="b", field3=["a"])
+        self.assertEqual("b", t._initial_state["field2"])
+        t.field2 = "c"
+        t.field2 = "d"
+        self.assertEqual("b", t._initial_state["field2"])
+        t.save()
+        self.assertEqual("d", t._initial_state["field2"])
+
+        # in-place modifications are not assigned but still detected
+        for obj in (t, InitialStateModel.from_data(**t.to_dict(include_restricted=True))):
+            obj.field3.append("b")
+            self.assertListEqual(["a"], obj._initial_state["field3"])
+
+        self.assertFalse(hasattr(TestModel(), "_initial_state"))
+
+    def test_loader(self):
+        class ListModel(TestModel):
+            FIELDS = ["list_field"]
+            DEFAULTS = {"list_field": []}
+
+        self.assertIsNotNone(ListModel._LOADER)
+        data = {"_id": ObjectId(), "field1": "a", "field2": "b", "unknown": "c"}
+        t1 = ListModel.from_data(**data)
+        t2 = ListModel(**data)
+        self.assertEqual(t1, t2)
+        self.assertEqual(CALLABLE_DEFAULT_VALUE, t1.callable_default_field)
+        self.assertFalse(hasattr(t1, "unknown"))
+        self.assertSetEqual(set(), t1.dirty_fields)
+        t1.list_field.append(1)
+        self.assertListEqual([], ListModel.from_data(**data).list_field)
+
+        class CustomInitModel(TestModel):
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                self.field3 = "custom"
+
+        self.assertIsNone(CustomInitModel._LOADER)
+        self.assertEqual("custom", CustomInitModel.from_data(**data).field3)
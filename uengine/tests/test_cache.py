@@ -0,0 +1,404 @@
+# pylint: disable=protected-access
+
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+from unittest.mock import patch
+from uengine import ctx
+from bson.objectid import ObjectId
+from flask import Flask, g
+from uengine.cache import cached_function, cached_method, single_flight, _flights, _lock_key, _get_cache_key, \
+    invalidate_tags, tag_generations, collection_tag, object_tag, request_time_cache, identity_map_merge, \
+    CacheEntry, CachedCall, \
+    HIT, MISS, STALE, REFRESH, NOT_FOUND
+from uengine.context import _Context
+from uengine.file_cache import FileCache, file_cached_function
+from uengine.models.abstract_model import AbstractModel
+from .mongo_mock import MongoMockTest
+from .test_storable_model import TestModel
+
+
+class Counter:
+
+    def __init__(self, value="value", delay=0):
+        self.calls = 0
+        self.value = value
+        self.delay = delay
+
+    def __call__(self):
+        self.calls += 1
+        if self.delay:
+            sleep(self.delay)
+        return self.value
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        ctx.cache.clear()
+
+    def test_hit(self):
+        compute = Counter()
+        self.assertTupleEqual(("value", MISS), single_flight("key", compute, 100))
+        self.assertTupleEqual(("value", HIT), single_flight("key", compute, 100))
+        self.assertEqual(1, compute.calls)
+
+    def test_cached_none(self):
+        compute = Counter(None)
+        self.assertTupleEqual((None, MISS), single_flight("key", compute, 100))
+        self.assertTupleEqual((None, HIT), single_flight("key", compute, 100))
+        self.assertEqual(1, compute.calls)
+        single_flight("positive", compute, 100, positive_only=True)
+        single_flight("positive", compute, 100, positive_only=True)
+        self.assertEqual(3, compute.calls)
+
+    def test_stale(self):
+        compute = Counter()
+        with patch("uengine.cache.time", return_value=1000):
+            single_flight("key", compute, 100)
+        with patch("uengine.cache.time", return_value=1101):
+            # somebody is recomputing the value already
+            _flights.acquire("key")
+            try:
+                self.assertTupleEqual(("value", STALE), single_flight("key", compute, 100))
+            finally:
+                _flights.release("key")
+            self.assertEqual(1, compute.calls)
+            self.assertTupleEqual(("value", REFRESH), single_flight("key", compute, 100))
+            self.assertEqual(2, compute.calls)
+
+    def test_refresh_error(self):
+        def fail():
+            raise RuntimeError("db timeout")
+        ctx.cache.set("key", CacheEntry("stale", 0, 0))
+        self.assertTupleEqual(("stale", STALE), single_flight("key", fail, 100))
+
+    def test_early_refresh(self):
+        ctx.cache.set("key", CacheEntry("value", 1000, 10))
+        compute = Counter("new")
+        with patch("uengine.cache.time", return_value=990):
+            with patch("uengine.cache.random", return_value=0.1):
+                self.assertTupleEqual(("value", HIT), single_flight("key", compute, 100))
+            with patch("uengine.cache.random", return_value=0.9):
+                self.assertTupleEqual(("new", REFRESH), single_flight("key", compute, 100))
+
+    def test_concurrent_miss(self):
+        compute = Counter(delay=0.1)
+        results = []
+        threads = [Thread(target=lambda: results.append(single_flight("key", compute, 100)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, compute.calls)
+        self.assertListEqual(["value"] * 5, [value for value, _ in results])
+        self.assertEqual(1, len([status for _, status in results if status == MISS]))
+        self.assertDictEqual({}, _flights._locks)
+
+    @patch("uengine.cache.DISTRIBUTED_LOCK_TIMEOUT", 0.2)
+    def test_distributed_lock(self):
+        compute = Counter()
+        # another process is computing the value
+        ctx.cache.add(_lock_key("key"), 1)
+
+        def other_process():
+            sleep(0.05)
+            ctx.cache.set("key", CacheEntry("other", None, 0))
+        thread = Thread(target=other_process)
+        thread.start()
+        self.assertTupleEqual(("other", HIT), single_flight("key", compute, 100, distributed_lock=True))
+        thread.join()
+        self.assertEqual(0, compute.calls)
+
+        # the lock holder has died, stop waiting after the lock timeout
+        ctx.cache.add(_lock_key("key2"), 1)
+        self.assertTupleEqual(("value", MISS), single_flight("key2", compute, 100, distributed_lock=True))
+        self.assertEqual(1, compute.calls)
+
+        self.assertTupleEqual(("value", MISS), single_flight("key3", compute, 100, distributed_lock=True))
+        self.assertFalse(ctx.cache.has(_lock_key("key3")))
+
+    def test_cached_function(self):
+        calls = []
+
+        @cached_function(cache_timeout=100)
+        def func(a, b=1):
+            calls.append((a, b))
+            return a + b
+
+        self.assertEqual(3, func(1, b=2))
+        self.assertEqual(3, func(1, b=2))
+        self.assertEqual(2, func(1))
+        self.assertListEqual([(1, 2), (1, 1)], calls)
+
+
+class TestSingleFetch(TestCase):
+
+    def setUp(self):
+        ctx.cache.clear()
+
+    def test_cached_function(self):
+        calls = []
+
+        @cached_function(cache_timeout=100)
+        def func():
+            calls.append(1)
+
+        func()
+        with patch.object(ctx.cache, "has") as has:
+            with patch.object(ctx.cache, "get", wraps=ctx.cache.get) as get:
+                self.assertIsNone(func())
+        has.assert_not_called()
+        self.assertEqual(1, get.call_count)
+        self.assertEqual(1, len(calls))
+
+    def test_cached_method(self):
+        class Obj:
+            calls = 0
+            key = "k"
+
+            @cached_method("obj", key_field="key", cache_timeout=100)
+            def method(self):
+                self.calls += 1
+
+        obj = Obj()
+        obj.method()
+        with patch.object(ctx.cache, "has") as has:
+            self.assertIsNone(obj.method())
+        has.assert_not_called()
+        self.assertEqual(1, obj.calls)
+
+    def test_file_cache(self):
+        with TemporaryDirectory() as cache_dir:
+            filecache = FileCache(cache_dir)
+            filecache.set("none", None)
+            self.assertIsNone(filecache.get("none", NOT_FOUND))
+            self.assertIs(NOT_FOUND, filecache.get("missing", NOT_FOUND))
+            self.assertIsNone(filecache.get("missing"))
+
+            calls = []
+
+            @file_cached_function(cache_timeout=100)
+            def func():
+                calls.append(1)
+
+            with patch.object(_Context, "filecache", filecache):
+                func()
+                with patch.object(filecache, "has") as has:
+                    self.assertIsNone(func())
+                has.assert_not_called()
+            self.assertEqual(1, len(calls))
+
+
+class KeyModel(AbstractModel):
+    FIELDS = ["_id", "name"]
+
+
+class TestCacheKey(TestCase):
+
+    def test_kwargs_order(self):
+        self.assertEqual(
+            _get_cache_key("p", "f", (1,), {"a": 1, "b": {"x": 1, "y": [1, 2]}}),
+            _get_cache_key("p", "f", (1,), {"b": {"y": [1, 2], "x": 1}, "a": 1})
+        )
+        self.assertEqual(_get_cache_key("p", "f", ({1, 2, 3},), {}), _get_cache_key("p", "f", ({3, 2, 1},), {}))
+
+    def test_collisions(self):
+        keys = {
+            _get_cache_key("p", "f", (1,), {}),
+            _get_cache_key("p", "f", ("1",), {}),
+            _get_cache_key("p", "f", (True,), {}),
+            _get_cache_key("p", "f", ([1],), {}),
+            _get_cache_key("p", "f", ((1,),), {}),
+            _get_cache_key("p", "f", (), {"a": 1}),
+            _get_cache_key("p", "f", ("a=1",), {}),
+            _get_cache_key("p", "g", (1,), {}),
+        }
+        self.assertEqual(8, len(keys))
+
+    def test_models(self):
+        _id = ObjectId()
+        obj = KeyModel(_id=_id, name="a")
+        key = _get_cache_key("p", "f", (obj,), {})
+        # the key doesn't depend on the model fields other than _id
+        self.assertEqual(key, _get_cache_key("p", "f", (KeyModel(_id=_id, name="b"),), {}))
+        self.assertNotEqual(key, _get_cache_key("p", "f", (KeyModel(_id=ObjectId(), name="a"),), {}))
+
+        # unsaved models are told apart by their fields
+        key = _get_cache_key("p", "f", (KeyModel(name="a"),), {})
+        self.assertEqual(key, _get_cache_key("p", "f", (KeyModel(name="a"),), {}))
+        self.assertNotEqual(key, _get_cache_key("p", "f", (KeyModel(name="b"),), {}))
+
+    def test_cached_call(self):
+        self.assertEqual("p:f(1, a=2)", str(CachedCall("p", "f", (1,), {"a": 2})))
+
+
+class TestCacheTags(MongoMockTest):
+
+    def setUp(self):
+        super().setUp()
+        ctx.cache.clear()
+        TestModel.destroy_all()
+
+    def test_generations(self):
+        first = tag_generations(["a", TestModel])
+        self.assertListEqual(first, tag_generations(["a", collection_tag(TestModel.collection)]))
+        invalidate_tags("a")
+        second = tag_generations(["a", TestModel])
+        self.assertNotEqual(first[0], second[0])
+        self.assertEqual(first[1], second[1])
+        with self.assertRaises(TypeError):
+            tag_generations([1])
+
+        # saves leave no generation keys behind unless something is tagged
+        obj = TestModel(field2="a")
+        obj.save()
+        obj.save()
+        self.assertFalse(ctx.cache.has(f"tag_gen.{object_tag(obj.collection, obj._id)}"))
+
+    def test_cached_function(self):
+        calls = []
+
+        @cached_function(cache_timeout=100, tags=[TestModel])
+        def list_values():
+            calls.append(1)
+            return sorted(x.field2 for x in TestModel.find())
+
+        obj = TestModel(field2="a")
+        obj.save()
+        self.assertListEqual(["a"], list_values())
+        self.assertListEqual(["a"], list_values())
+        self.assertEqual(1, len(calls))
+
+        TestModel(field2="b").save()
+        self.assertListEqual(["a", "b"], list_values())
+        TestModel.update_many({}, {"$set": {"field2": "c"}})
+        self.assertListEqual(["c", "c"], list_values())
+        TestModel.destroy_many({"_id": obj._id})
+        self.assertListEqual(["c"], list_values())
+        self.assertEqual(4, len(calls))
+
+    def test_object_tags(self):
+        calls = []
+        obj1 = TestModel(field2="a")
+        obj1.save()
+        obj2 = TestModel(field2="b")
+        obj2.save()
+
+        @cached_function(cache_timeout=100, tags=lambda obj: [obj])
+        def describe(obj):
+            calls.append(obj._id)
+            return TestModel.get(obj._id).field2
+
+        self.assertEqual("a", describe(obj1))
+        self.assertEqual("b", describe(obj2))
+        obj1.field2 = "c"
+        obj1.save()
+        self.assertEqual("c", describe(obj1))
+        self.assertEqual("b", describe(obj2))
+        self.assertListEqual([obj1._id, obj2._id, obj1._id], calls)
+
+        TestModel.save_many([obj2])
+        describe(obj2)
+        self.assertListEqual([obj1._id, obj2._id, obj1._id, obj2._id], calls)
+        generation = tag_generations([object_tag(TestModel.collection, obj1._id)])
+        obj1.destroy()
+        self.assertNotEqual(generation, tag_generations([obj1]))
+
+
+class TestRequestTimeCache(MongoMockTest):
+
+    def setUp(self):
+        super().setUp()
+        TestModel.destroy_all()
+        self.objs = [TestModel(field2=f"value{i}") for i in range(3)]
+        for obj in self.objs:
+            obj.save()
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        ctx.cfg.pop("request_cache_max_objects", None)
+        super().tearDown()
+
+    def test_materialize(self):
+        @request_time_cache()
+        def find_all():
+            return TestModel.find().sort("field2")
+
+        @request_time_cache()
+        def get_first(field2):
+            return TestModel.find_one({"field2": field2})
+
+        with self.app.test_request_context():
+            g.request_local_cache = {}
+            first = find_all()
+            self.assertIsInstance(first, list)
+            with patch.object(TestModel, "find") as find:
+                second = find_all()
+            # served without querying the database again
+            find.assert_not_called()
+            self.assertListEqual(["value0", "value1", "value2"], [x.field2 for x in second])
+            self.assertIsNot(first, second)
+            second.pop()
+            self.assertEqual(3, len(find_all()))
+
+            # the same object is the same instance within the request
+            self.assertIs(first[0], second[0])
+            self.assertIs(first[1], get_first("value1"))
+            obj = TestModel.get(self.objs[2]._id)
+            self.assertIsNot(obj, first[2])
+            self.assertIs(first[2], identity_map_merge(obj))
+
+        with self.app.test_request_context():
+            g.request_local_cache = {}
+            self.assertIsNot(first[0], find_all()[0])
+
+    def test_lists(self):
+        ctx.cfg["request_cache_max_objects"] = 4
+
+        @request_time_cache()
+        def find_all(query):
+            return TestModel.find(query).sort("field2").all()
+
+        @request_time_cache()
+        def find_tuple():
+            return tuple(TestModel.find().sort("field2"))
+
+        with self.app.test_request_context():
+            g.request_local_cache = {}
+            first = find_all({})
+            first.append("appended")
+            second = find_all({})
+            self.assertEqual(3, len(second))
+            self.assertIs(first[0], second[0])
+            self.assertIs(first[1], identity_map_merge(TestModel.get(self.objs[1]._id)))
+            self.assertIs(first[0], find_tuple()[0])
+            # 3 objects are counted against the budget, not 1
+            with patch.object(TestModel, "find", wraps=TestModel.find) as find:
+                find_all({"field2": {"$ne": None}})
+                find_all({"field2": {"$ne": None}})
+            self.assertEqual(2, find.call_count)
+
+    def test_budget(self):
+        ctx.cfg["request_cache_max_objects"] = 4
+        calls = []
+
+        @request_time_cache()
+        def find_all(query):
+            calls.append(query)
+            return TestModel.find(query)
+
+        with self.app.test_request_context():
+            g.request_local_cache = {}
+            find_all({})
+            find_all({})
+            self.assertEqual(1, len(calls))
+            # the second result doesn't fit into the budget
+            find_all({"field2": {"$ne": None}})
+            find_all({"field2": {"$ne": None}})
+            self.assertEqual(3, len(calls))
+            find_all({"field2": "value0"})
+            find_all({"field2": "value0"})
+            self.assertEqual(4, len(calls))
@@ -0,0 +1,105 @@
+from datetime import datetime
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from bson.objectid import ObjectId
+from cachelib import SimpleCache
+from uengine.cache import CacheEntry
+from uengine.cache_codec import CacheCodec, CodecCache, create_codec_cache, msgpack, \
+    SERIALIZER_PICKLE, SERIALIZER_BSON, COMPRESSION_NONE, COMPRESSION_ZLIB
+from uengine.errors import ConfigurationError
+
+
+def gen_doc():
+    return {
+        "_id": ObjectId(),
+        "username": "user",
+        "tags": ["a", "b"],
+        "created_at": datetime(2020, 1, 2, 3, 4, 5, 6000),
+        "supervisor": False,
+        "counter": None,
+    }
+
+
+class TestCacheCodec(TestCase):
+
+    def assertRoundTrip(self, codec, value):
+        self.assertEqual(value, codec.decode(codec.encode(value)))
+
+    def test_bson(self):
+        codec = CacheCodec("bson", compression=None)
+        doc = gen_doc()
+        data = codec.encode(doc)
+        self.assertEqual(SERIALIZER_BSON, data[2])
+        self.assertDictEqual(doc, codec.decode(data))
+
+        entry = CacheEntry(doc, 1000.5, 0.1)
+        decoded = codec.decode(codec.encode(entry))
+        self.assertIsInstance(decoded, CacheEntry)
+        self.assertEqual(entry, decoded)
+
+        # bson can't store sets, pickle is used instead
+        data = codec.encode({"set": {1, 2}})
+        self.assertEqual(SERIALIZER_PICKLE, data[2])
+        self.assertRoundTrip(codec, {"set": {1, 2}})
+        self.assertRoundTrip(codec, 1)
+        self.assertRoundTrip(codec, None)
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        codec = CacheCodec("msgpack", compression=None)
+        self.assertRoundTrip(codec, gen_doc())
+        self.assertRoundTrip(codec, {1: "int keys"})
+        self.assertRoundTrip(codec, CacheEntry([gen_doc()], None, 0.1))
+
+    def test_compression(self):
+        codec = CacheCodec(compress_threshold=100)
+        small = codec.encode("x" * 10)
+        self.assertEqual(COMPRESSION_NONE, small[3])
+        docs = [gen_doc() for _ in range(100)]
+        large = codec.encode(docs)
+        self.assertEqual(COMPRESSION_ZLIB, large[3])
+        self.assertTrue(len(large) < len(CacheCodec(compression=None).encode(docs)) / 3)
+        self.assertRoundTrip(codec, docs)
+
+    def test_config(self):
+        with self.assertRaises(ConfigurationError):
+            CacheCodec("yaml")
+        with self.assertRaises(ConfigurationError):
+            CacheCodec(compression="zip")
+        with patch("uengine.cache_codec.lz4", None):
+            with self.assertRaises(ConfigurationError):
+                CacheCodec(compression="lz4")
+
+    def test_version(self):
+        codec = CacheCodec()
+        data = bytearray(codec.encode("value"))
+        data[1] = 99
+        with self.assertRaises(ValueError):
+            codec.decode(bytes(data))
+        # not encoded by a codec
+        self.assertEqual(b"raw", codec.decode(b"raw"))
+        self.assertEqual(1, codec.decode(1))
+
+
+class TestCodecCache(TestCase):
+
+    def test_cache(self):
+        backend = SimpleCache()
+        cache = create_codec_cache(backend, {"serializer": "bson", "compress_threshold": 10})
+        self.assertIsInstance(cache, CodecCache)
+        doc = gen_doc()
+        cache.set("a", doc)
+        self.assertIsInstance(backend.get("a"), bytes)
+        self.assertDictEqual(doc, cache.get("a"))
+        self.assertTrue(cache.add("b", 1))
+        self.assertFalse(cache.add("b", 2))
+        cache.set_many({"c": "c", "d": [1]})
+        self.assertListEqual([doc, 1, "c", [1], None], cache.get_many("a", "b", "c", "d", "e"))
+        self.assertDictEqual({"b": 1, "e": None}, cache.get_dict("b", "e"))
+        self.assertTrue(cache.has("a"))
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+
+        # broken values are reported as missing
+        backend.set("broken", b"\xce\x01\x00\x01garbage")
+        self.assertIsNone(cache.get("broken"))
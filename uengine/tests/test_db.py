@@ -0,0 +1,244 @@
+# pylint: disable=protected-access
+
+from time import time
+from unittest import TestCase
+from unittest.mock import patch
+from pymongo.errors import AutoReconnect, ServerSelectionTimeoutError
+from uengine import ctx
+from uengine.db import _DB, RetryPolicy, CircuitBreaker, pick_rw_shard_id, \
+    intercept_mongo_errors_ro, intercept_mongo_errors_rw
+from uengine.errors import DatabaseUnavailable, ConfigurationError
+from uengine.shard_placement import PlacementStrategy, CapacityPlacement, DataSizePlacement, \
+    LatencyPlacement, create_placement_strategy
+from .mongo_mock import MongoMockTest
+
+
+class FlakyDB(_DB):
+
+    def __init__(self, failures, error_class, retry_cfg=None, circuit_cfg=None):
+        super().__init__({
+            "uri": "mongodb://localhost",
+            "retry": retry_cfg or {},
+            "circuit_breaker": circuit_cfg or {},
+        })
+        self.failures = failures
+        self.error_class = error_class
+        self.calls = 0
+        self.resets = 0
+
+    def reset_conn(self):
+        self.resets += 1
+
+    def _call(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error_class("flaky")
+        return "result"
+
+    @intercept_mongo_errors_rw
+    def write(self):
+        return self._call()
+
+    @intercept_mongo_errors_ro
+    def read(self):
+        return self._call()
+
+
+@patch("uengine.db.sleep")
+class TestRetries(TestCase):
+
+    def test_delay(self, _):
+        policy = RetryPolicy(initial_delay=0.1, max_delay=1, multiplier=2, jitter=0)
+        self.assertListEqual([0.1, 0.2, 0.4, 0.8, 1, 1], [policy.delay(i) for i in range(1, 7)])
+        policy = RetryPolicy(initial_delay=1, jitter=0.5)
+        for _ in range(100):
+            self.assertTrue(0.5 <= policy.delay(1) <= 1.5)
+
+    def test_latency(self, _):
+        db = FlakyDB(0, AutoReconnect)
+        self.assertIsNone(db.avg_latency["ro"])
+        db.read()
+        self.assertIsNotNone(db.avg_latency["ro"])
+        self.assertIsNone(db.avg_latency["rw"])
+        db.record_latency("ro", 1.0)
+        db.record_latency("ro", 1.0)
+        self.assertTrue(0.3 < db.avg_latency["ro"] < 0.4)
+
+    def test_retry(self, sleep):
+        db = FlakyDB(4, ServerSelectionTimeoutError, {"rw": {"jitter": 0}})
+        self.assertEqual("result", db.write())
+        self.assertEqual(5, db.calls)
+        self.assertEqual(1, db.resets)
+        self.assertListEqual([0.1, 0.2, 0.4, 0.8], [c[0][0] for c in sleep.call_args_list])
+        self.assertEqual(4, db.retry_stats["rw_retries"])
+
+    def test_give_up(self, sleep):
+        db = FlakyDB(100, ServerSelectionTimeoutError)
+        self.assertRaises(ServerSelectionTimeoutError, db.write)
+        self.assertEqual(6, db.calls)
+        self.assertEqual(5, sleep.call_count)
+        self.assertEqual(1, db.retry_stats["rw_failures"])
+
+    def test_max_time(self, sleep):
+        db = FlakyDB(100, AutoReconnect, {"ro": {"initial_delay": 1, "jitter": 0, "max_time": 2.5}})
+        # sleeping for 2 more seconds at t=1 would exceed the deadline
+        with patch("uengine.db.time", side_effect=[0, 0, 1]):
+            self.assertRaises(AutoReconnect, db.read)
+        self.assertEqual(2, db.calls)
+        self.assertEqual(1, sleep.call_count)
+
+    def test_retryable(self, sleep):
+        # generic AutoReconnect may happen after a write is applied
+        db = FlakyDB(1, AutoReconnect)
+        self.assertRaises(AutoReconnect, db.write)
+        self.assertEqual("result", db.read())
+        self.assertEqual(0, sleep.call_count)
+
+        db = FlakyDB(1, AutoReconnect, {"rw": {"retryable": ["AutoReconnect"]}})
+        self.assertEqual("result", db.write())
+
+
+@patch("uengine.db.sleep")
+class TestCircuitBreaker(MongoMockTest):
+
+    def test_states(self, _):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        with patch("uengine.db.time", return_value=100):
+            breaker.record_failure()
+            self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+            breaker.record_success()
+            breaker.record_failure()
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+            self.assertTrue(breaker.is_open)
+            self.assertFalse(breaker.allow())
+
+        with patch("uengine.db.time", return_value=110):
+            self.assertFalse(breaker.is_open)
+            self.assertTrue(breaker.allow())
+            self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+            # only one probe at a time
+            self.assertFalse(breaker.allow())
+            breaker.record_failure()
+            self.assertTrue(breaker.is_open)
+
+        with patch("uengine.db.time", return_value=120):
+            self.assertTrue(breaker.allow())
+            breaker.record_success()
+            self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+            self.assertTrue(breaker.allow())
+
+    def test_probe_timeout(self, _):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, probe_timeout=5)
+        with patch("uengine.db.time", return_value=100):
+            breaker.record_failure()
+        with patch("uengine.db.time", return_value=110):
+            self.assertTrue(breaker.allow())
+        # the probe has never reported back
+        with patch("uengine.db.time", return_value=114):
+            self.assertFalse(breaker.allow())
+            self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+        with patch("uengine.db.time", return_value=115):
+            self.assertFalse(breaker.allow())
+            self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        with patch("uengine.db.time", return_value=125):
+            self.assertTrue(breaker.allow())
+            self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+
+    def test_fail_fast(self, _):
+        db = FlakyDB(100, ServerSelectionTimeoutError, circuit_cfg={"failure_threshold": 3})
+        # a failure is recorded per operation, not per attempt
+        for _ in range(3):
+            self.assertRaises(ServerSelectionTimeoutError, db.write)
+        self.assertEqual(18, db.calls)
+        self.assertEqual(CircuitBreaker.OPEN, db.circuit_breaker.state)
+        self.assertRaises(DatabaseUnavailable, db.write)
+        self.assertEqual(18, db.calls)
+        self.assertEqual(1, db.retry_stats["rw_rejects"])
+
+    def test_retries_not_cut_short(self, _):
+        db = FlakyDB(3, ServerSelectionTimeoutError, circuit_cfg={"failure_threshold": 1})
+
+        def call():
+            # another operation gives up meanwhile
+            db.circuit_breaker.record_failure()
+            return FlakyDB._call(db)
+
+        with patch.object(db, "_call", side_effect=call):
+            self.assertEqual("result", db.write())
+        self.assertEqual(CircuitBreaker.CLOSED, db.circuit_breaker.state)
+
+    def test_pick_rw_shard_id(self, _):
+        s1, s2 = ctx.db.rw_shards[:2]
+        for _ in range(ctx.db.shards[s1].circuit_breaker.failure_threshold):
+            ctx.db.shards[s1].circuit_breaker.record_failure()
+        for _ in range(20):
+            self.assertEqual(s2, pick_rw_shard_id())
+        info = ctx.db.circuit_info()
+        self.assertEqual(CircuitBreaker.OPEN, info["shards"][s1]["state"])
+        self.assertEqual(CircuitBreaker.CLOSED, info["meta"]["state"])
+
+
+class TestShardPlacement(MongoMockTest):
+
+    def test_create(self):
+        self.assertIs(PlacementStrategy, type(ctx.db.placement))
+        self.assertIsInstance(create_placement_strategy({"strategy": "capacity"}), CapacityPlacement)
+        self.assertIsInstance(create_placement_strategy({"strategy": LatencyPlacement}), LatencyPlacement)
+        self.assertRaises(ConfigurationError, create_placement_strategy, {"strategy": "unknown"})
+
+    def test_capacity(self):
+        strategy = CapacityPlacement({"weights": {"s1": 0, "s2": 3}})
+        self.assertDictEqual({"s1": 0, "s2": 3, "s3": 1}, strategy.weights(["s1", "s2", "s3"]))
+        for _ in range(20):
+            self.assertEqual("s2", strategy.pick(["s1", "s2"]))
+        # all the weights are zero, any shard is better than none
+        self.assertIn(strategy.pick(["s1"]), ["s1"])
+
+    def test_data_size(self):
+        strategy = DataSizePlacement({})
+        with patch.object(strategy, "collect_stats", side_effect=lambda shard_id: {"s1": 100, "s2": 400}[shard_id]):
+            strategy.refresh()
+        self.assertDictEqual({"s1": 0.01, "s2": 0.0025}, strategy.weights(["s1", "s2"]))
+
+        strategy = DataSizePlacement({"capacity": {"s1": 300, "s2": 500}})
+        strategy.stats = {"s1": 300, "s2": 400}
+        strategy.updated_at = time()
+        self.assertDictEqual({"s1": 0, "s2": 100}, strategy.weights(["s1", "s2"]))
+        for _ in range(20):
+            self.assertEqual("s2", strategy.pick(["s1", "s2"]))
+
+    def test_data_size_refresh(self):
+        strategy = DataSizePlacement({"refresh_interval": 60})
+        with patch("uengine.shard_placement.Thread") as thread:
+            # no stats yet, uniform weights while they're being collected
+            self.assertDictEqual({"s1": 1, "s2": 1}, strategy.weights(["s1", "s2"]))
+            self.assertEqual(1, thread.call_count)
+            # refresh is already running
+            strategy.weights(["s1", "s2"])
+            self.assertEqual(1, thread.call_count)
+            with patch.object(strategy, "collect_stats", return_value=10):
+                strategy._background_refresh()
+            self.assertDictEqual({"s1": 0.1, "s2": 0.1}, strategy.weights(["s1", "s2"]))
+            self.assertEqual(1, thread.call_count)
+            strategy.updated_at -= 61
+            strategy.weights(["s1", "s2"])
+            self.assertEqual(2, thread.call_count)
+
+    def test_latency(self):
+        strategy = LatencyPlacement({})
+        self.assertDictEqual({"s1": 1, "s2": 1}, strategy.weights(["s1", "s2"]))
+        ctx.db.shards["s1"].avg_latency["rw"] = 0.5
+        self.assertDictEqual({"s1": 2, "s2": 2}, strategy.weights(["s1", "s2"]))
+        ctx.db.shards["s2"].avg_latency["rw"] = 0.25
+        self.assertDictEqual({"s1": 2, "s2": 4}, strategy.weights(["s1", "s2"]))
+
+    def test_pick_rw_shard_id(self):
+        ctx.db.placement = CapacityPlacement({"weights": {"s1": 0}})
+        for _ in range(20):
+            self.assertEqual("s2", pick_rw_shard_id())
+        # circuit breakers take precedence over weights
+        for _ in range(ctx.db.shards["s2"].circuit_breaker.failure_threshold):
+            ctx.db.shards["s2"].circuit_breaker.record_failure()
+        self.assertEqual("s1", pick_rw_shard_id())
@@ -0,0 +1,135 @@
+import os
+import pickle
+
+from datetime import datetime
+from hashlib import sha256
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+from uengine.file_cache import FileCache, TMP_FILE_EXPIRE
+
+
+def cache_files(cache_dir):
+    return [os.path.join(root, name) for root, _, names in os.walk(cache_dir) for name in names]
+
+
+class TestFileCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.cache = FileCache(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_set_get(self):
+        self.assertTrue(self.cache.set("key", {"value": 1}))
+        self.assertDictEqual({"value": 1}, self.cache.get("key"))
+        self.assertTrue(self.cache.has("key"))
+        self.assertIsNone(self.cache.expires("key"))
+        self.assertIsNone(self.cache.get("missing"))
+        self.assertFalse(self.cache.has("missing"))
+        self.assertTrue(self.cache.delete("key"))
+        self.assertFalse(self.cache.delete("key"))
+
+        self.cache.set("key", 1)
+        files = cache_files(self.tmpdir.name)
+        self.assertEqual(1, len(files))
+        # fanned out into two levels of subdirectories
+        path = os.path.relpath(files[0], self.tmpdir.name).split(os.sep)
+        self.assertEqual(3, len(path))
+        self.assertTrue(path[2].startswith(path[0] + path[1]))
+
+    def test_expiration(self):
+        with patch("uengine.file_cache.time", return_value=1000):
+            self.cache.set("key", "value", timeout=10)
+        with patch("uengine.file_cache.time", return_value=1005):
+            self.assertEqual(datetime.utcfromtimestamp(1010), self.cache.expires("key"))
+            with patch("uengine.file_cache.pickle.load") as load:
+                self.assertTrue(self.cache.has("key"))
+            # has() reads the header only
+            load.assert_not_called()
+            self.assertEqual("value", self.cache.get("key"))
+        with patch("uengine.file_cache.time", return_value=1011):
+            self.assertFalse(self.cache.has("key"))
+        self.assertListEqual([], cache_files(self.tmpdir.name))
+
+    def test_atomic_write(self):
+        self.cache.set("key", "old")
+        with patch("uengine.file_cache.pickle.dump", side_effect=pickle.PicklingError("broken")):
+            self.assertFalse(self.cache.set("key", "new"))
+        # the old value is intact and no temporary files are left
+        self.assertEqual("old", self.cache.get("key"))
+        self.assertEqual(1, len(cache_files(self.tmpdir.name)))
+
+    def test_sweep(self):
+        with patch("uengine.file_cache.time", return_value=1000):
+            self.cache.set("expired", "x", timeout=10)
+        for i in range(10):
+            self.cache.set(f"key{i}", "x" * 100)
+        entry_size = max(os.path.getsize(path) for path in cache_files(self.tmpdir.name))
+
+        # key0 is the least recently used one, key9 the most
+        for i in range(10):
+            hashed = sha256(f"key{i}".encode()).hexdigest()
+            path = [path for path in cache_files(self.tmpdir.name) if os.path.basename(path) == hashed][0]
+            os.utime(path, (1000 + i, 1000 + i))
+
+        legacy = os.path.join(self.tmpdir.name, "0" * 64)
+        with open(legacy, "wb") as cf:
+            pickle.dump({"value": 1, "expires": None}, cf)
+        # temporary files are created next to the entries
+        tmp = os.path.join(os.path.dirname(path), ".tmp-dead")
+        with open(tmp, "wb") as cf:
+            cf.write(b"partial")
+        os.utime(tmp, (0, 0))
+
+        stats = self.cache.sweep(max_size=entry_size * 6)
+        self.assertEqual(3, stats["expired"])
+        self.assertEqual(5, stats["evicted"])
+        self.assertEqual(5, stats["files"])
+        self.assertListEqual([None] * 5 + ["x" * 100] * 5, [self.cache.get(f"key{i}") for i in range(10)])
+        self.assertFalse(os.path.exists(legacy))
+        self.assertFalse(os.path.exists(tmp))
+
+        # fresh temporary files of running writers are kept
+        with open(tmp, "wb") as cf:
+            cf.write(b"partial")
+        with patch("uengine.file_cache.time", return_value=os.path.getmtime(tmp) + TMP_FILE_EXPIRE - 1):
+            self.cache.sweep()
+        self.assertTrue(os.path.exists(tmp))
+
+        self.assertTrue(self.cache.clear())
+        self.assertListEqual([], cache_files(self.tmpdir.name))
+
+    def test_foreign_files(self):
+        self.cache.set("key", 1)
+        path = cache_files(self.tmpdir.name)[0]
+        foreign = [
+            os.path.join(self.tmpdir.name, "notes.txt"),
+            os.path.join(self.tmpdir.name, "a" * 63),
+            os.path.join(os.path.dirname(path), "notes.txt"),
+            os.path.join(os.path.dirname(path), "0" * 64),
+        ]
+        os.makedirs(os.path.join(self.tmpdir.name, "data", "ab"))
+        foreign.append(os.path.join(self.tmpdir.name, "data", "ab", "f" * 64))
+        for name in foreign:
+            with open(name, "wb") as cf:
+                cf.write(b"foreign")
+            os.utime(name, (0, 0))
+
+        stats = self.cache.sweep(max_size=1)
+        self.assertEqual(1, stats["evicted"])
+        self.assertEqual(0, stats["expired"])
+        self.cache.set("key", 1)
+        self.assertTrue(self.cache.clear())
+        self.assertListEqual(sorted(foreign), sorted(cache_files(self.tmpdir.name)))
+
+    def test_lru_touch(self):
+        self.cache.set("key", 1)
+        path = cache_files(self.tmpdir.name)[0]
+        os.utime(path, (1000, 1000))
+        self.cache.has("key")
+        self.assertEqual(1000, os.path.getmtime(path))
+        self.cache.get("key")
+        self.assertNotEqual(1000, os.path.getmtime(path))
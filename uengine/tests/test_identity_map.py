@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+from flask import Flask, g
+from unittest.mock import patch, PropertyMock
+from uengine import ctx
+from uengine.errors import ModelDestroyed
+from uengine.models.sharded_model import ShardedModel
+from .mongo_mock import MongoMockTest
+from .test_storable_model import TestModel
+
+
+class IdentityShardedModel(ShardedModel):
+    FIELDS = ("_id", "name")
+    collection = "identity_sharded"
+
+
+class TestIdentityMap(MongoMockTest):
+
+    def setUp(self):
+        super().setUp()
+        ctx.cache.clear()
+        ctx.cfg["identity_map"] = True
+        TestModel.destroy_all()
+        self.obj = TestModel(field2="value")
+        self.obj.save()
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        ctx.cfg.pop("identity_map", None)
+        super().tearDown()
+
+    @contextmanager
+    def request(self):
+        with self.app.test_request_context():
+            g.request_local_cache = {}
+            g.request_identity_map = {}
+            yield
+
+    def test_loads(self):
+        with self.request():
+            obj = TestModel.get(self.obj._id)
+            self.assertIs(obj, TestModel.find_one({"field2": "value"}))
+            self.assertIs(obj, TestModel.find().all()[0])
+            self.assertIs(obj, TestModel.cache_get(self.obj._id))
+            self.assertIs(obj, TestModel.cache_get(self.obj._id))
+            self.assertIs(obj, TestModel.cache_get_many([self.obj._id])[0])
+            # loaded by _id without querying the database
+            with patch.object(type(ctx.db.meta), "ro_conn", new_callable=PropertyMock) as ro_conn:
+                self.assertIs(obj, TestModel.get(self.obj._id))
+            ro_conn.assert_not_called()
+            # projected objects are not merged
+            partial = TestModel.find({}, projection=["field2"]).all()[0]
+            self.assertIsNot(obj, partial)
+
+        with self.request():
+            self.assertIsNot(obj, TestModel.get(self.obj._id))
+
+        # disabled
+        ctx.cfg["identity_map"] = False
+        with self.request():
+            self.assertIsNot(TestModel.get(self.obj._id), TestModel.get(self.obj._id))
+
+    def test_save_destroy(self):
+        with self.request():
+            obj = TestModel.get(self.obj._id)
+            # the instance saved is not the one in the map
+            self.obj.field2 = "changed"
+            self.obj.save()
+            self.assertEqual("changed", obj.field2)
+
+            new = TestModel(field2="new")
+            new.save()
+            self.assertIs(new, TestModel.get(new._id))
+
+            new.db_update({"$set": {"field2": "updated"}})
+            self.assertEqual("updated", TestModel.get(new._id).field2)
+            new.db_update({"$set": {"field2": "updated again"}}, reload=False)
+            loaded = TestModel.get(new._id)
+            self.assertIsNot(new, loaded)
+            self.assertEqual("updated again", loaded.field2)
+
+            _id = obj._id
+            obj.destroy()
+            self.assertIsNone(TestModel.get(_id))
+
+            TestModel.update_many({}, {"$set": {"field2": "bulk"}})
+            self.assertEqual("bulk", TestModel.get(new._id).field2)
+
+    def test_reload(self):
+        with self.request():
+            obj = TestModel.get(self.obj._id)
+            ctx.db.meta.conn[TestModel.collection].update_one({"_id": obj._id}, {"$set": {"field2": "external"}})
+            obj.reload()
+            self.assertEqual("external", obj.field2)
+            self.assertIs(obj, TestModel.get(obj._id))
+            ctx.db.meta.conn[TestModel.collection].delete_one({"_id": obj._id})
+            self.assertRaises(ModelDestroyed, obj.reload)
+
+        sharded = IdentityShardedModel(name="a")
+        sharded._shard_id = "s1"
+        sharded.save()
+        with self.request():
+            obj = IdentityShardedModel.get("s1", sharded._id)
+            ctx.db.shards["s1"].conn[IdentityShardedModel.collection].update_one(
+                {"_id": obj._id}, {"$set": {"name": "external"}})
+            obj.reload()
+            self.assertEqual("external", obj.name)
+        IdentityShardedModel.destroy_all("s1")
+
+    def test_sharded(self):
+        obj = IdentityShardedModel(name="a")
+        obj._shard_id = "s1"
+        obj.save()
+        with self.request():
+            loaded = IdentityShardedModel.get("s1", obj._id)
+            self.assertIs(loaded, IdentityShardedModel.find("s1").all()[0])
+            self.assertIs(loaded, IdentityShardedModel.cache_get("s1", obj._id))
+            self.assertIsNone(IdentityShardedModel.get("s2", obj._id))
+        IdentityShardedModel.destroy_all("s1")
+
+    def test_all_shards(self):
+        shard_ids = sorted(ctx.db.shards)[:2]
+        for shard_id in shard_ids:
+            obj = IdentityShardedModel(name=shard_id)
+            obj._shard_id = shard_id
+            obj.save()
+        with self.request():
+            objs = IdentityShardedModel.find_all_shards().sort("name").all()
+            self.assertEqual(2, len(objs))
+            for obj in objs:
+                self.assertIs(obj, IdentityShardedModel.find_one(obj._shard_id, {"name": obj.name}))
+            obj = IdentityShardedModel.find_one_any_shard({"name": shard_ids[1]})
+            self.assertIs(objs[1], obj)
+        for shard_id in shard_ids:
+            IdentityShardedModel.destroy_all(shard_id)
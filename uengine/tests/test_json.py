@@ -0,0 +1,121 @@
+import json
+import warnings
+
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from bson import ObjectId, Timestamp
+from uengine import ctx
+from uengine.errors import ConfigurationError
+from uengine.json_encoder import create_json_backend, orjson, StdlibJSONBackend, OrjsonBackend, MongoJSONEncoder, \
+    json_backend, json_dumps
+from uengine.queue.task import BaseTask
+from .test_abstract_model import TestModel
+
+
+class Point:
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class PointJSONEncoder(MongoJSONEncoder):
+    def default(self, o):  # pylint: disable=method-hidden
+        if isinstance(o, Point):
+            return [o.x, o.y]
+        return super().default(o)
+
+
+class TestJSONBackend(TestCase):
+
+    def backends(self, datetime_format="http", encoder_class=None):
+        backends = [create_json_backend("json", datetime_format, encoder_class)]
+        if orjson is not None:
+            backends.append(create_json_backend("orjson", datetime_format, encoder_class))
+        return backends
+
+    def test_create(self):
+        self.assertIsInstance(create_json_backend("json"), StdlibJSONBackend)
+        if orjson is None:
+            self.assertIsInstance(create_json_backend("auto"), StdlibJSONBackend)
+            self.assertRaises(ConfigurationError, create_json_backend, "orjson")
+        else:
+            self.assertIsInstance(create_json_backend("auto"), OrjsonBackend)
+        self.assertRaises(ConfigurationError, create_json_backend, "unknown")
+        self.assertRaises(ConfigurationError, create_json_backend, "json", "unknown")
+
+    def test_dumps(self):
+        oid = ObjectId()
+        obj = TestModel(_id=oid, field2="value")
+        data = {
+            "id": oid,
+            "ts": Timestamp(1500000000, 1),
+            "dt": datetime(2020, 1, 2, 3, 4, 5),
+            "set": {1},
+            "model": obj,
+            "list": [obj],
+            "nested": {"b": 1, "a": None},
+        }
+        expected = {
+            "id": str(oid),
+            "ts": 1500000000,
+            "dt": "Thu, 02 Jan 2020 03:04:05 GMT",
+            "set": [1],
+            "model": obj.to_dict(),
+            "list": [obj.to_dict()],
+            "nested": {"a": None, "b": 1},
+        }
+        expected["model"]["_id"] = str(oid)
+        expected["list"][0]["_id"] = str(oid)
+
+        outputs = set()
+        for backend in self.backends():
+            dump = backend.dumps(data)
+            self.assertDictEqual(expected, backend.loads(dump))
+            outputs.add(dump)
+            self.assertDictEqual(expected, backend.loads(backend.dumps(data, indent=4)))
+            self.assertRaises(TypeError, backend.dumps, {"obj": object()})
+        # backends are interchangeable
+        self.assertEqual(1, len(outputs))
+
+        expected["dt"] = "2020-01-02T03:04:05"
+        outputs = set()
+        for backend in self.backends("iso"):
+            dump = backend.dumps(data)
+            self.assertDictEqual(expected, backend.loads(dump))
+            outputs.add(dump)
+        self.assertEqual(1, len(outputs))
+
+    def test_encoder_class(self):
+        oid = ObjectId()
+        data = {"point": Point(1, 2), "id": oid}
+        for backend in self.backends(encoder_class=PointJSONEncoder):
+            self.assertDictEqual({"point": [1, 2], "id": str(oid)}, backend.loads(backend.dumps(data)))
+        for backend in self.backends():
+            self.assertRaises(TypeError, backend.dumps, data)
+
+    def test_app_backend(self):
+        data = {"point": Point(1, 2), "dt": datetime(2020, 1, 2, 3, 4, 5)}
+        # used outside of an app context first
+        self.assertRaises(TypeError, json_dumps, data)
+        app = Flask(__name__)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            app.json_encoder = PointJSONEncoder
+        with app.app_context():
+            self.assertDictEqual({"point": [1, 2], "dt": "Thu, 02 Jan 2020 03:04:05 GMT"},
+                                 json.loads(json_dumps(data)))
+            backend = json_backend()
+            self.assertIs(backend, json_backend())
+            with patch.dict(ctx.cfg, {"json_datetime_format": "iso"}):
+                self.assertEqual("2020-01-02T03:04:05", json.loads(json_dumps(data))["dt"])
+        self.assertRaises(TypeError, json_dumps, data)
+
+    def test_task_message(self):
+        task = BaseTask({"id": ObjectId(), "values": [1, 2]})
+        msg = task.to_message()
+        restored = BaseTask.from_message(msg)
+        self.assertEqual(task.id, restored.id)
+        self.assertDictEqual({"id": str(task.data["id"]), "values": [1, 2]}, restored.data)
@@ -0,0 +1,122 @@
+# pylint: disable=protected-access
+
+from os import getpid
+from unittest import TestCase
+from unittest.mock import patch, Mock
+from uengine import ctx
+from uengine.local_cache import LocalCache, MongoInvalidationBus
+from .mongo_mock import MongoMockTest
+from .test_storable_model import TestModel
+
+
+class TestLocalCache(TestCase):
+
+    def test_lru(self):
+        cache = LocalCache(max_items=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.set("c", 3)
+        # b is the least recently used one
+        self.assertIsNone(cache.get("b"))
+        self.assertListEqual([1, None, 3], cache.get_many("a", "b", "c"))
+        self.assertEqual(2, len(cache))
+
+    def test_size(self):
+        cache = LocalCache(max_size=1000)
+        self.assertFalse(cache.set("huge", "x" * 1000))
+        cache.set("a", "x" * 400)
+        cache.set("b", "x" * 400)
+        cache.set("c", "x" * 400)
+        self.assertIsNone(cache.get("a"))
+        self.assertTrue(cache.size <= 1000)
+        cache.delete_many("b", "c", None)
+        self.assertEqual(0, cache.size)
+
+    def test_ttl(self):
+        cache = LocalCache(ttl=10)
+        with patch("uengine.local_cache.time", return_value=100):
+            cache.set("a", 1)
+            cache.set("b", 2, timeout=100)
+        with patch("uengine.local_cache.time", return_value=111):
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(2, cache.get("b"))
+        self.assertEqual(1, len(cache))
+
+    def test_copies(self):
+        cache = LocalCache()
+        cache.set("a", {"list": [1]})
+        cache.get("a")["list"].append(2)
+        self.assertDictEqual({"list": [1]}, cache.get("a"))
+
+    def test_invalidate(self):
+        bus = Mock()
+        cache = LocalCache(bus=bus)
+        cache.set("a", 1)
+        cache.invalidate("a", None)
+        self.assertIsNone(cache.get("a"))
+        bus.publish.assert_called_once_with(("a", None))
+
+
+class TestInvalidationBus(MongoMockTest):
+
+    def tearDown(self):
+        try:
+            del ctx.local_cache
+        except AttributeError:
+            pass
+        super().tearDown()
+
+    def test_broadcast(self):
+        caches = []
+        for hostname in ("host1", "host2"):
+            bus = MongoInvalidationBus()
+            bus.hostname = hostname
+            # pretend the polling thread is running, the test polls explicitly
+            bus._pid = getpid()
+            cache = LocalCache(bus=bus)
+            bus.cache = cache
+            bus.poll()
+            cache.set("a", 1)
+            cache.set("b", 2)
+            caches.append(cache)
+
+        caches[0].invalidate("a")
+        for cache in caches:
+            cache.bus.poll()
+        self.assertIsNone(caches[0].get("a"))
+        self.assertIsNone(caches[1].get("a"))
+        self.assertEqual(2, caches[1].get("b"))
+
+        # the same invalidation is never applied twice
+        caches[1].set("a", 1)
+        caches[1].bus.poll()
+        self.assertEqual(1, caches[1].get("a"))
+
+    def test_model_cache(self):
+        ctx.local_cache = LocalCache()
+        TestModel.destroy_all()
+        obj = TestModel(field2="value")
+        obj.save()
+        self.assertEqual("value", TestModel.cache_get(obj._id).field2)
+
+        ctx.cache.clear()
+        ctx.db.meta.conn[TestModel.collection].update_one({"_id": obj._id}, {"$set": {"field2": "changed"}})
+        # served from the local cache
+        self.assertEqual("value", TestModel.cache_get(obj._id).field2)
+        self.assertListEqual(["value"], [x.field2 for x in TestModel.cache_get_many([obj._id])])
+
+        obj.reload()
+        obj.save()
+        self.assertEqual("changed", TestModel.cache_get(obj._id).field2)
+
+        # the local cache is dropped only after ctx.cache so it can't be
+        # refilled with the stale value meanwhile
+        cache_key = f"{TestModel.collection}.{obj._id}"
+        self.assertIsNotNone(ctx.cache.get(cache_key))
+        with patch.object(ctx.local_cache, "invalidate",
+                          side_effect=lambda *keys: self.assertIsNone(ctx.cache.get(cache_key))) as invalidate:
+            obj.save()
+            TestModel._invalidate_many([cache_key])
+        self.assertEqual(2, invalidate.call_count)
+        TestModel.destroy_all()
@@ -0,0 +1,235 @@
+from unittest import TestCase
+from unittest.mock import patch
+from uengine.errors import ConfigurationError
+from uengine.memcached import ConsistentHashMemcachedCache, create_memcached_cache
+
+
+class FakeClient:
+    """In-memory client with the subset of pymemcache API used by the cache"""
+
+    def __init__(self, server):
+        self.server = server
+        self.data = {}
+        self.expires = {}
+        self.down = False
+        self.calls = []
+
+    def _check(self, method):
+        self.calls.append(method)
+        if self.down:
+            raise ConnectionRefusedError(f"{self.server} is down")
+
+    def get(self, key):
+        self._check("get")
+        return self.data.get(key)
+
+    def get_many(self, keys):
+        self._check("get_many")
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def set(self, key, value, expire=0):
+        self._check("set")
+        self.data[key] = value
+        self.expires[key] = expire
+        return True
+
+    def add(self, key, value, expire=0):
+        self._check("add")
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def set_many(self, values, expire=0):
+        self._check("set_many")
+        self.data.update(values)
+        return []
+
+    def delete(self, key):
+        self._check("delete")
+        return self.data.pop(key, None) is not None
+
+    def delete_many(self, keys):
+        self._check("delete_many")
+        for key in keys:
+            self.data.pop(key, None)
+        return True
+
+    def incr(self, key, value):
+        self._check("incr")
+        self.data[key] = int(self.data[key]) + value
+        return self.data[key]
+
+    def flush_all(self):
+        self._check("flush_all")
+        self.data.clear()
+        return True
+
+
+SERVERS = ["mc1:11211", "mc2:11211", "mc3:11211"]
+
+
+def create_cache(servers=None, **kwargs):
+    clients = {}
+
+    def factory(server):
+        clients[server] = FakeClient(server)
+        return clients[server]
+
+    return ConsistentHashMemcachedCache(servers or SERVERS, client_factory=factory, **kwargs), clients
+
+
+class TestConsistentHashMemcachedCache(TestCase):
+
+    def test_distribution(self):
+        cache, clients = create_cache()
+        keys = [f"key{i}" for i in range(3000)]
+        for key in keys:
+            cache.set(key, key)
+        for client in clients.values():
+            # roughly a third of keys each
+            self.assertTrue(700 < len(client.data) < 1300)
+        self.assertListEqual(keys, [cache.get(key) for key in keys])
+
+        # adding a server moves only the keys going to the new one
+        cache4, _ = create_cache(SERVERS + ["mc4:11211"])
+        moved = [key for key in keys if cache4._locate(key)[0].server != cache._locate(key)[0].server]
+        self.assertTrue(len(moved) < len(keys) * 0.35)
+        self.assertTrue(all(cache4._locate(key)[0].server == "mc4:11211" for key in moved))
+
+    def test_weights(self):
+        cache, clients = create_cache({"mc1:11211": 1, "mc2:11211": 3})
+        for i in range(2000):
+            cache.set(f"key{i}", i)
+        self.assertTrue(len(clients["mc2:11211"].data) > 2 * len(clients["mc1:11211"].data))
+
+    def test_failover(self):
+        cache, clients = create_cache(max_failures=2, retry_timeout=10, failover_ttl=5, flush_on_recovery=True)
+        keys = [f"key{i}" for i in range(300)]
+        cache.set_many({key: key for key in keys})
+        dead = clients["mc1:11211"]
+        dead_keys = [key for key in keys if key in dead.data]
+        dead.down = True
+
+        with patch("uengine.memcached.time", return_value=1000):
+            # failures are tolerated until max_failures
+            self.assertIsNone(cache.get(dead_keys[0]))
+            self.assertIsNone(cache.get(dead_keys[0]))
+            calls = len(dead.calls)
+            # ejected, other keys stay where they are
+            self.assertIsNone(cache.get(dead_keys[0]))
+            self.assertEqual(calls, len(dead.calls))
+            alive_keys = [key for key in keys if key not in dead_keys]
+            self.assertListEqual(alive_keys, cache.get_many(*alive_keys))
+            cache.set(dead_keys[0], "new", timeout=100)
+            self.assertEqual("new", cache.get(dead_keys[0]))
+            replacement = cache._locate(dead_keys[0])[0].client
+            # written to a replacement node for a short time only
+            self.assertEqual(5, replacement.expires[dead_keys[0]])
+
+        dead.down = False
+        dead.data["stale"] = "value"
+        with patch("uengine.memcached.time", return_value=1011):
+            # back and flushed
+            self.assertIsNone(cache.get(dead_keys[0]))
+            self.assertIn("flush_all", dead.calls)
+            self.assertNotIn("stale", dead.data)
+            self.assertTrue(all(info["alive"] for info in cache.nodes_info().values()))
+
+    def test_missed_invalidations(self):
+        cache, _ = create_cache(max_failures=1, retry_timeout=10)
+        cache.set("users.42", "old")
+        cache.set("other", "value")
+        node = cache._locate("users.42")[0]
+        node.client.data["untouched"] = "value"
+        node.client.down = True
+        with patch("uengine.memcached.time", return_value=1000):
+            self.assertIsNone(cache.get("users.42"))
+            # sent to the fallback node
+            cache.delete("users.42")
+            cache.set_many({"users.43": "new"})
+        node.client.down = False
+        with patch("uengine.memcached.time", return_value=1011):
+            # the recovered node doesn't serve the value invalidated meanwhile
+            self.assertIsNone(cache.get("users.42"))
+        self.assertNotIn("flush_all", node.client.calls)
+        self.assertIn("untouched", node.client.data)
+        self.assertSetEqual(set(), node.missed_keys)
+
+    def test_missed_keys_overflow(self):
+        cache, _ = create_cache(max_failures=1, retry_timeout=10, max_missed_keys=2)
+        cache.set("key", "old")
+        node = cache._locate("key")[0]
+        node.client.down = True
+        with patch("uengine.memcached.time", return_value=1000):
+            cache.get("key")
+            for i in range(10):
+                cache.set(f"key{i}", i)
+        self.assertTrue(node.missed_overflow)
+        node.client.down = False
+        with patch("uengine.memcached.time", return_value=1011):
+            cache.get("key")
+        # too many keys missed to track, flushed
+        self.assertIn("flush_all", node.client.calls)
+        self.assertFalse(node.missed_overflow)
+
+    def test_recovery_without_flush(self):
+        cache, clients = create_cache(max_failures=1, retry_timeout=10)
+        cache.set("key", "value")
+        node = cache._locate("key")[0]
+        node.client.down = True
+        with patch("uengine.memcached.time", return_value=1000):
+            self.assertIsNone(cache.get("key"))
+        node.client.down = False
+        with patch("uengine.memcached.time", return_value=1011):
+            # the node may have been healthy for other processes
+            self.assertEqual("value", cache.get("key"))
+        self.assertNotIn("flush_all", node.client.calls)
+        self.assertFalse(node.ejected)
+
+    def test_all_dead(self):
+        cache, clients = create_cache(max_failures=1)
+        for client in clients.values():
+            client.down = True
+        self.assertFalse(cache.set("a", 1))
+        self.assertIsNone(cache.get("a"))
+        for i in range(10):
+            cache.get(f"key{i}")
+        self.assertEqual((None, False), cache._locate("a"))
+        self.assertFalse(cache.set("a", 1))
+        self.assertListEqual([None, None], cache.get_many("a", "b"))
+
+    def test_multi(self):
+        cache, clients = create_cache()
+        keys = [f"key{i}" for i in range(100)]
+        self.assertListEqual(keys, cache.set_many({key: key for key in keys}))
+        self.assertEqual(keys + [None], cache.get_many(*keys, "missing"))
+        for client in clients.values():
+            # one request per server
+            self.assertListEqual(["set_many", "get_many"], client.calls)
+        self.assertTrue(cache.add("a", 1))
+        self.assertFalse(cache.add("a", 2))
+        self.assertEqual(2, cache.inc("a"))
+        self.assertTrue(cache.has("a"))
+        self.assertListEqual(keys, cache.delete_many(*keys))
+        self.assertListEqual([None] * 100, cache.get_many(*keys))
+        self.assertTrue(cache.clear())
+
+    def test_keys(self):
+        cache, clients = create_cache(key_prefix="app:")
+        cache.set("with spaces", 1)
+        cache.set("long" * 100, 2)
+        cache.set("plain", 3)
+        stored = set()
+        for client in clients.values():
+            stored.update(client.data)
+        self.assertIn("app:plain", stored)
+        self.assertTrue(all(len(key) <= 250 and " " not in key for key in stored))
+        self.assertListEqual([1, 2, 3], cache.get_many("with spaces", "long" * 100, "plain"))
+
+    def test_config(self):
+        with self.assertRaises(ConfigurationError):
+            create_memcached_cache({"servers": []})
+        with patch("uengine.memcached.pymemcache", None):
+            with self.assertRaises(ConfigurationError):
+                create_memcached_cache({"servers": SERVERS})
@@ -0,0 +1,140 @@
+from fnmatch import fnmatch
+from unittest import TestCase
+from unittest.mock import patch
+from cachelib import SimpleCache
+from uengine import ctx
+from uengine.cache import single_flight, _lock_key, MISS
+from uengine.cache_codec import create_codec_cache
+from uengine.context import _Context
+from uengine.errors import ConfigurationError
+from uengine.redis_cache import UengineRedisCache, create_redis_cache
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, **kwargs):
+        self.commands.append(kwargs)
+
+    def execute(self):
+        self.client.calls.append("pipeline")
+        return [self.client._set(**kwargs) for kwargs in self.commands]
+
+
+class FakeRedis:
+    """In-memory client with the subset of redis-py API used by the cache"""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.calls = []
+
+    def _set(self, name, value, ex=None, nx=False):
+        if nx and name in self.data:
+            return None
+        self.data[name] = value if isinstance(value, bytes) else str(value).encode()
+        self.ttls[name] = ex
+        return True
+
+    def set(self, name, value, ex=None, nx=False):
+        self.calls.append("set")
+        return self._set(name, value, ex, nx)
+
+    def get(self, name):
+        self.calls.append("get")
+        return self.data.get(name)
+
+    def mget(self, names):
+        self.calls.append("mget")
+        return [self.data.get(name) for name in names]
+
+    def delete(self, *names):
+        self.calls.append("delete")
+        return len([self.data.pop(name) for name in names if name in self.data])
+
+    def exists(self, name):
+        self.calls.append("exists")
+        return int(name in self.data)
+
+    def eval(self, script, numkeys, *args):
+        self.calls.append("eval")
+        key, value = args
+        if "del" in script and self.data.get(key) == value:
+            del self.data[key]
+            return 1
+        return 0
+
+    def scan_iter(self, match, count):
+        return [key for key in list(self.data) if fnmatch(key, match)]
+
+    def flushdb(self):
+        self.data.clear()
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class TestRedisCache(TestCase):
+
+    def test_cache(self):
+        client = FakeRedis()
+        cache = UengineRedisCache(client, default_timeout=100, key_prefix="app:")
+        cache.set("a", {"value": 1})
+        self.assertDictEqual({"value": 1}, cache.get("a"))
+        self.assertEqual(100, client.ttls["app:a"])
+        cache.set("b", 2, timeout=0)
+        self.assertIsNone(client.ttls["app:b"])
+
+        client.calls = []
+        self.assertListEqual([{"value": 1}, 2, None], cache.get_many("a", "b", "c"))
+        self.assertListEqual(["c", "d"], cache.set_many({"c": 3, "d": 4}, timeout=10))
+        self.assertListEqual(["mget", "pipeline"], client.calls)
+
+        # add is a single atomic command along with expiration
+        client.calls = []
+        self.assertTrue(cache.add("lock", "token", timeout=5))
+        self.assertFalse(cache.add("lock", "other", timeout=5))
+        self.assertListEqual(["set", "set"], client.calls)
+        self.assertEqual(5, client.ttls["app:lock"])
+
+        self.assertFalse(cache.delete_if_equal("lock", "other"))
+        self.assertTrue(cache.has("lock"))
+        self.assertTrue(cache.delete_if_equal("lock", "token"))
+        self.assertFalse(cache.has("lock"))
+
+        client.calls = []
+        self.assertListEqual(["a", "b", "x"], cache.delete_many("a", "b", "x"))
+        self.assertListEqual(["delete"], client.calls)
+
+        client.data["other:key"] = b"1"
+        cache.clear()
+        self.assertListEqual(["other:key"], list(client.data))
+
+    def test_codec(self):
+        client = FakeRedis()
+        cache = create_codec_cache(UengineRedisCache(client), {"serializer": "bson"})
+        self.assertTrue(cache.add("lock", "token"))
+        self.assertFalse(cache.delete_if_equal("lock", "other"))
+        self.assertTrue(cache.delete_if_equal("lock", "token"))
+        self.assertIsNone(getattr(create_codec_cache(SimpleCache(), {}), "delete_if_equal", None))
+
+    def test_lock_release(self):
+        cache = UengineRedisCache(FakeRedis())
+
+        def compute():
+            # the lock has expired and is taken by someone else meanwhile
+            cache.set(_lock_key("key"), "other")
+            return "value"
+
+        with patch.object(_Context, "cache", cache):
+            self.assertTupleEqual(("value", MISS), single_flight("key", compute, 100, distributed_lock=True))
+            self.assertEqual("other", ctx.cache.get(_lock_key("key")))
+
+    def test_config(self):
+        with patch.dict("sys.modules", {"redis": None}):
+            with self.assertRaises(ConfigurationError):
+                create_redis_cache({})
@@ -1,6 +1,8 @@
 # pylint: disable=protected-access
 
+from pymongo import DESCENDING
 from uengine import ctx
+from uengine.db import SHARDS_POOL_CONCURRENCY
 from uengine.models.sharded_model import ShardedModel, MissingShardId
 from .mongo_mock import MongoMockTest
 
@@ -67,3 +69,83 @@ class TestShardedModel(MongoMockTest):
         model = TestModel(shard_id=shard_id, field2="value")
         self.assertEqual(model._shard_id, shard_id)
         model.save()
+
+    def test_cache_get_many(self):
+        shard_id = ctx.db.rw_shards[0]
+        model1 = TestModel(shard_id=shard_id, field2="value")
+        model1.save()
+        model2 = TestModel(shard_id=shard_id, field2="value")
+        model2.save()
+
+        objs = TestModel.cache_get_many(shard_id, [model1._id, model2._id])
+        self.assertListEqual([model1._id, model2._id], [x._id for x in objs])
+        self.assertListEqual([shard_id, shard_id], [x._shard_id for x in objs])
+        self.assertTrue(ctx.cache.has(f"test_model.{shard_id}.{model1._id}"))
+
+        other_shard_id = ctx.db.rw_shards[1]
+        self.assertListEqual([], TestModel.cache_get_many(other_shard_id, [model1._id, model2._id]))
+
+    def test_find_all_shards(self):
+        s1, s2 = ctx.db.rw_shards[:2]
+        for i in range(10):
+            shard_id = s1 if i % 3 else s2
+            TestModel(shard_id=shard_id, field2=f"value{i:02d}").save()
+
+        objs = TestModel.find_all_shards(sort=[("field2", DESCENDING)]).all()
+        self.assertListEqual([f"value{i:02d}" for i in reversed(range(10))],
+                             [x.field2 for x in objs])
+
+        objs = TestModel.find_all_shards(sort="field2", skip=2, limit=5).all()
+        self.assertListEqual([f"value{i:02d}" for i in range(2, 7)],
+                             [x.field2 for x in objs])
+        self.assertListEqual([s1, s2, s1, s1, s2], [x._shard_id for x in objs])
+
+        cursor = TestModel.find_all_shards({"field2": {"$gte": "value05"}})
+        self.assertEqual(5, cursor.count())
+        self.assertTupleEqual((4, True), cursor.count_with("capped", cap=4))
+        self.assertTupleEqual((5, False), cursor.count_with("cached"))
+        self.assertEqual(5, len(cursor.all()))
+
+    def test_paginated_json(self):
+        from flask import Flask
+        from uengine.api import paginated, json_response
+
+        s1, s2 = ctx.db.rw_shards[:2]
+        TestModel(shard_id=s1, field2="value1").save()
+        TestModel(shard_id=s2, field2="value2").save()
+        with Flask(__name__).test_request_context("/?_limit=1&_page=2"):
+            result = paginated(TestModel.find_all_shards(sort="field2"))
+            data = json_response(result).get_json()
+        self.assertEqual(2, data["count"])
+        self.assertListEqual(["value2"], [x["field2"] for x in data["data"]])
+
+    def test_find_one_any_shard(self):
+        s1, s2 = ctx.db.rw_shards[:2]
+        TestModel(shard_id=s1, field2="value1").save()
+        TestModel(shard_id=s2, field2="value2").save()
+
+        obj = TestModel.find_one_any_shard({"field2": "value2"})
+        self.assertIsNotNone(obj)
+        self.assertEqual(s2, obj._shard_id)
+        self.assertIsNone(TestModel.find_one_any_shard({"field2": "value3"}))
+
+    def test_shards_pool_size(self):
+        # concurrent scatter-gather calls don't wait for each other's workers
+        self.assertEqual(len(ctx.db.shards) * SHARDS_POOL_CONCURRENCY, ctx.db.shards_executor._max_workers)
+
+    def test_count_all_shards(self):
+        s1, s2 = ctx.db.rw_shards[:2]
+        TestModel(shard_id=s1, field2="value").save()
+        TestModel(shard_id=s2, field2="value").save()
+        TestModel(shard_id=s2, field2="other").save()
+
+        self.assertEqual(3, TestModel.count_all_shards())
+        self.assertEqual(2, TestModel.count_all_shards({"field2": "value"}))
+
+    def test_save_many(self):
+        s1, s2 = ctx.db.rw_shards[:2]
+        models = [TestModel(shard_id=s1 if i % 2 else s2, field2=f"bulk{i}") for i in range(6)]
+        TestModel.save_many(models)
+        self.assertEqual(3, TestModel.find(s1).count())
+        self.assertEqual(3, TestModel.find(s2).count())
+        self.assertRaises(MissingShardId, TestModel.save_many, [TestModel(field2="value")])
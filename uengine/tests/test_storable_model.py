@@ -1,6 +1,10 @@
 # pylint: disable=protected-access
 
+from bson.objectid import ObjectId
+from pymongo.errors import AutoReconnect
 from uengine import ctx
+from uengine.errors import BulkSaveError
+from uengine.models.abstract_model import FieldRequired
 from uengine.models.storable_model import StorableModel
 from .mongo_mock import MongoMockTest
 
@@ -118,3 +122,263 @@ class TestStorableModel(MongoMockTest):
 
         m.destroy()
         self.assertFalse(ctx.cache.has(f"test_model.{model1._id}"))
+
+    def test_cache_get_many(self):
+        model1 = TestModel(field1="f1", field2="f2", field3="f3")
+        model1.save()
+        model2 = TestModel(field1="f1", field2="f2", field3="f3")
+        model2.save()
+
+        ctx.cache.set(f"test_model.{model2._id}", model2.to_dict())
+        self.assertFalse(ctx.cache.has(f"test_model.{model1._id}"))
+
+        missing_id = ObjectId()
+        objs = TestModel.cache_get_many([model2._id, missing_id, model1._id])
+        self.assertListEqual([model2._id, model1._id], [x._id for x in objs])
+        self.assertEqual(model1, objs[1])
+        self.assertTrue(ctx.cache.has(f"test_model.{model1._id}"))
+        self.assertFalse(ctx.cache.has(f"test_model.{missing_id}"))
+
+        model1.destroy()
+        self.assertListEqual([model2._id], [x._id for x in TestModel.cache_get_many([model1._id, model2._id])])
+        self.assertListEqual([], TestModel.cache_get_many([]))
+
+    def test_save_many(self):
+        models = [TestModel(field2=f"bulk{i}") for i in range(5)]
+        models.append(TestModel(field1="invalid"))
+        self.assertRaises(FieldRequired, TestModel.save_many, models)
+        self.assertTrue(all(x.is_new for x in models))
+
+        models.pop()
+        saved = TestModel.save_many(models, chunk_size=2)
+        self.assertEqual(5, len(saved))
+        self.assertFalse(any(x.is_new for x in models))
+        self.assertEqual(5, TestModel.find({"field2": {"$regex": "^bulk"}}).count())
+
+        model = models[0]
+        model.cache_get(model._id)
+        self.assertTrue(ctx.cache.has(f"test_model.{model._id}"))
+        for x in models:
+            x.field3 = "updated"
+        TestModel.save_many(models)
+        self.assertFalse(ctx.cache.has(f"test_model.{model._id}"))
+        self.assertEqual(5, TestModel.find({"field3": "updated"}).count())
+
+    def test_save_many_errors(self):
+        ctx.db.meta.conn[TestModel.collection].create_index("field2", unique=True)
+        try:
+            existing = TestModel(field2="dup")
+            existing.save()
+            models = [TestModel(field2="bulk1"), TestModel(field2="dup"), TestModel(field2="bulk2")]
+            with self.assertRaises(BulkSaveError) as cm:
+                TestModel.save_many(models)
+            self.assertEqual(1, cm.exception.payload["errors"][0]["index"])
+            self.assertListEqual([False, True, False], [x.is_new for x in models])
+
+            models = [TestModel(field2="bulk3"), TestModel(field2="dup"), TestModel(field2="bulk4")]
+            self.assertRaises(BulkSaveError, TestModel.save_many, models, ordered=True)
+            self.assertListEqual([False, True, True], [x.is_new for x in models])
+        finally:
+            ctx.db.meta.conn[TestModel.collection].drop_index("field2_1")
+
+    def test_partial_update(self):
+        class PartialModel(TestModel):
+            COLLECTION = "test_model"
+            USE_PARTIAL_UPDATES = True
+
+        model = PartialModel(field1="f1", field2="f2", field3="f3")
+        model.save()
+        model = PartialModel.find_one({"_id": model._id})
+        self.assertEqual({}, model._get_partial_update())
+
+        # the concurrent change must survive as field1 is not modified
+        TestModel.update_many({"_id": model._id}, {"$set": {"field1": "concurrent"}})
+        model.field2 = "updated"
+        del model.callable_default_field
+        self.assertDictEqual({"$set": {"field2": "updated"}, "$unset": {"callable_default_field": ""}},
+                             model._get_partial_update())
+        model.save()
+        data = ctx.db.meta.conn[TestModel.collection].find_one({"_id": model._id})
+        self.assertEqual("concurrent", data["field1"])
+        self.assertEqual("updated", data["field2"])
+        self.assertNotIn("callable_default_field", data)
+
+        # a document deleted in the meantime is restored completely
+        TestModel.destroy_many({"_id": model._id})
+        model.field2 = "restored"
+        model.save()
+        data = ctx.db.meta.conn[TestModel.collection].find_one({"_id": model._id})
+        self.assertEqual("f1", data["field1"])
+        self.assertEqual("restored", data["field2"])
+
+    def test_as_dicts(self):
+        class RestrictedModel(TestModel):
+            COLLECTION = "test_model"
+            RESTRICTED_FIELDS = ["field3"]
+
+            @property
+            def prop(self):
+                return "prop"
+
+        for i in range(3):
+            TestModel(field2=f"f{i}", field3="secret").save()
+        ctx.db.meta.conn[TestModel.collection].update_many({}, {"$unset": {"field1": ""}})
+
+        for fields in (None, ["_id", "field1", "field2", "field3"], ["field2"], ["prop", "field2"]):
+            expected = [x.to_dict(fields) for x in RestrictedModel.find().sort("field2")]
+            self.assertListEqual(expected, list(RestrictedModel.find().sort("field2").as_dicts(fields)))
+
+        data = list(RestrictedModel.find().sort("field2", -1).skip(1).limit(1).as_dicts(["field1", "field2"]))
+        self.assertListEqual([{"field1": "default_value", "field2": "f1"}], data)
+
+    def test_as_dicts_to_dict_override(self):
+        from flask import Flask
+        from uengine.api import paginated, default_transform
+
+        class MaskedModel(TestModel):
+            COLLECTION = "test_model"
+
+            def to_dict(self, fields=None, include_restricted=False):
+                result = super().to_dict(fields, include_restricted)
+                if "field3" in result:
+                    result["field3"] = "masked"
+                return result
+
+        TestModel(field2="f", field3="secret").save()
+        self.assertListEqual(["masked"], [x["field3"] for x in MaskedModel.find().as_dicts()])
+        with Flask(__name__).test_request_context("/"):
+            result = paginated(MaskedModel.find(), transform=default_transform())
+        self.assertEqual("masked", result["data"][0]["field3"])
+
+    def test_cursor_chunks(self):
+        for i in range(10):
+            TestModel(field2=f"f{i}").save()
+        chunks = list(TestModel.find().sort("field2").chunks(4))
+        self.assertListEqual([4, 4, 2], [len(x) for x in chunks])
+        self.assertIsInstance(chunks[0][0], TestModel)
+        self.assertListEqual([f"f{i}" for i in range(10)], [x.field2 for chunk in chunks for x in chunk])
+
+        chunks = list(TestModel.find().batch_size(3).chunks())
+        self.assertListEqual([3, 3, 3, 1], [len(x) for x in chunks])
+
+    def test_cursor_prefetch(self):
+        for i in range(10):
+            TestModel(field2=f"f{i}").save()
+        objs = TestModel.find().sort("field2").batch_size(3).prefetch(2).all()
+        self.assertListEqual([f"f{i}" for i in range(10)], [x.field2 for x in objs])
+
+        chunks = TestModel.find().prefetch().chunks(2)
+        self.assertEqual(2, len(next(chunks)))
+        chunks.close()
+
+        def failing_cursor():
+            yield {"_id": ObjectId(), "field2": "f"}
+            raise AutoReconnect("connection lost")
+
+        # errors raised on the helper thread are re-raised to the caller
+        cursor = TestModel.find().prefetch()
+        cursor.cursor = failing_cursor()
+        self.assertRaises(AutoReconnect, cursor.all)
+
+    def test_count_strategies(self):
+        ctx.cache.clear()
+        for i in range(5):
+            TestModel(field2=f"f{i}").save()
+        # nothing is written to the cache until a count is cached
+        self.assertFalse(ctx.cache.has(f"count_gen.{TestModel.collection}"))
+        self.assertTupleEqual((5, False), TestModel.find().count_with("exact"))
+        self.assertTupleEqual((5, False), TestModel.find().count_with("estimated"))
+        self.assertTupleEqual((2, False), TestModel.find({"field2": {"$gt": "f2"}}).count_with("estimated"))
+        self.assertTupleEqual((3, True), TestModel.find().count_with("capped", cap=3))
+        self.assertTupleEqual((5, False), TestModel.find().count_with("capped", cap=5))
+        self.assertRaises(ValueError, TestModel.find().count_with, "unknown")
+
+        self.assertTupleEqual((5, False), TestModel.find().count_with("cached"))
+        ctx.db.meta.conn[TestModel.collection].insert_one({"field2": "raw"})
+        self.assertTupleEqual((5, False), TestModel.find().count_with("cached"))
+        self.assertTupleEqual((6, False), TestModel.find().count_with("exact"))
+        # any save in the collection drops cached counts
+        TestModel(field2="f5").save()
+        self.assertTupleEqual((7, False), TestModel.find().count_with("cached"))
+        TestModel.destroy_many({"field2": "raw"})
+        self.assertTupleEqual((6, False), TestModel.find().count_with("cached"))
+
+    def test_paginated(self):
+        from flask import Flask
+        from uengine.api import paginated, default_transform
+
+        for i in range(3):
+            TestModel(field2=f"f{i}").save()
+        with Flask(__name__).test_request_context("/?_fields=field2&_limit=2&_page=2"):
+            result = paginated(TestModel.find().sort("field2"), transform=default_transform())
+        self.assertEqual(2, result["total_pages"])
+        self.assertListEqual([{"field2": "f2"}], result["data"])
+        with Flask(__name__).test_request_context("/?_limit=2"):
+            result = paginated(TestModel.find(), count_strategy="capped")
+        self.assertEqual(3, result["count"])
+        self.assertFalse(result["count_capped"])
+
+    def test_json_stream_response(self):
+        from flask import Flask, json
+        from uengine.api import json_stream_response, default_transform
+        from uengine.json_encoder import MongoJSONEncoder
+
+        for i in range(5):
+            TestModel(field2=f"f{i}").save()
+        app = Flask(__name__)
+        app.json_encoder = MongoJSONEncoder
+        expected = [x.to_dict() for x in TestModel.find().sort("field2")]
+        for x in expected:
+            x["_id"] = str(x["_id"])
+
+        with app.test_request_context("/"):
+            response = json_stream_response(TestModel.find().sort("field2"), chunk_size=2)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual("application/json", response.mimetype)
+            self.assertListEqual(expected, json.loads(response.get_data()))
+
+            response = json_stream_response(TestModel.find().sort("field2"), ndjson=True)
+            lines = response.get_data(as_text=True).splitlines()
+            self.assertListEqual(expected, [json.loads(x) for x in lines])
+
+            response = json_stream_response(TestModel.find({"field2": "none"}))
+            self.assertEqual("[]", response.get_data(as_text=True))
+
+        with app.test_request_context("/?_fields=field2"):
+            response = json_stream_response(TestModel.find().sort("field2"), transform=default_transform())
+            self.assertListEqual([{"field2": f"f{i}"} for i in range(5)], json.loads(response.get_data()))
+
+    def test_keyset_paginated(self):
+        from flask import Flask
+        from uengine.api import paginated, default_transform
+        from uengine.errors import InputDataError
+
+        for i in range(7):
+            # duplicate values of the sort field are ordered by _id
+            TestModel(field2=f"f{i // 2}", field3=str(i)).save()
+        app = Flask(__name__)
+
+        for direction in (1, -1):
+            expected = [x.field3 for x in TestModel.find().sort([("field2", direction), ("_id", direction)])]
+            collected = []
+            after = ""
+            while after is not None:
+                with app.test_request_context(f"/?_limit=3&_after={after}"):
+                    result = paginated(TestModel.find({"field1": "default_value"}).sort("field2", direction),
+                                       transform=default_transform(["field3"]))
+                self.assertIsNone(result["count"])
+                self.assertTrue(len(result["data"]) <= 3)
+                collected.extend(x["field3"] for x in result["data"])
+                after = result["next"]
+            self.assertListEqual(expected, collected)
+
+        with app.test_request_context("/?_limit=5&_after=&_count=1"):
+            result = paginated(TestModel.find().sort("field2"))
+        self.assertEqual(7, result["count"])
+        self.assertEqual(5, len(result["data"]))
+        with app.test_request_context(f"/?_limit=5&_after={result['next']}"):
+            self.assertEqual(2, len(paginated(TestModel.find().sort("field2"))["data"]))
+            # the token is bound to the sort order
+            self.assertRaises(InputDataError, paginated, TestModel.find().sort("field3"))
+        with app.test_request_context("/?_after=garbage"):
+            self.assertRaises(InputDataError, paginated, TestModel.find())